@@ -5,7 +5,7 @@ import random
 from ccdc.io import MoleculeReader, MoleculeWriter
 from ccdc.protein import Protein
 from hotspots.hs_io import HotspotWriter, HotspotReader
-from hotspots.hs_ensembles import EnsembleResult, SelectivityResult
+from hs_ensembles import EnsembleResult, SelectivityResult
 from utils import get_subset, process_KLIFS_pdbs, find_bs_residues, shrink_bs_maps, KLIFS_molecular_weight
 from run_hotspots_job import run_parallel_hotspot_jobs
 
@@ -105,6 +105,7 @@ def run_example(ensemble_dict, rseed=123):
         selectivity_settings.apolar_percentile_threshold = 90.0
         selectivity_settings.cluster_distance_cutoff = 3.0
         selectivity_settings.minimal_cluster_score = 10.0
+        selectivity_settings.cache_dir = Path(on_target_dir.parent, 'selectivity_cache')
 
         with HotspotReader(path_dict[on_target]['ensemble_maps']) as tar_reader:
             tar_res = tar_reader.read()
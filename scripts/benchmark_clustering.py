@@ -0,0 +1,106 @@
+"""
+Compares the clustering engines of grid_clustering on the case-study maps: for each map, the points above the
+percentile threshold used for the selectivity maps are clustered with each engine, and the labels are compared with
+the HDBSCAN labels (adjusted Rand index over the thresholded points, noise counted as its own cluster).
+"""
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from ccp4_maps import open_ccp4
+from ensemble_streaming import find_result_file
+from grid_clustering import cluster_map, adjusted_rand_index, CLUSTERING_ENGINES
+from hs_ensembles import SelectivityResult
+
+
+def threshold_map(array, percentile):
+    """
+    Keeps the points above the given percentile of the positive values, as SelectivityResult.make_selectivity_maps does
+    :param array: 3D numpy array
+    :param percentile: float
+    :return: 3D numpy array
+    """
+    positive = array[array > 0]
+    if len(positive) == 0:
+        return np.zeros(array.shape)
+    perc = np.percentile(positive, percentile)
+    return array * (array > perc)
+
+
+def benchmark_map(array, min_cluster_size, engines):
+    """
+    :param array: thresholded 3D numpy array
+    :param min_cluster_size: int
+    :param engines: names of the engines to compare; the first one is the reference
+    :return: list of dictionaries, one per engine
+    """
+    mask = array != 0
+    rows = []
+    reference = None
+    for engine in engines:
+        start = time.perf_counter()
+        labels = cluster_map(array, min_cluster_size, engine=engine)
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = labels[mask]
+        rows.append({'engine': engine,
+                     'n_points': int(mask.sum()),
+                     'n_clusters': len(np.unique(labels[labels > 0])),
+                     'clustered_points': int(np.count_nonzero(labels)),
+                     'time_s': elapsed,
+                     'ARI_vs_{}'.format(engines[0]): adjusted_rand_index(reference, labels[mask]),
+                     'same_noise_fraction': np.mean((reference > 0) == (labels[mask] > 0)) if mask.any() else 1.0})
+    return rows
+
+
+def benchmark_results(result_paths, engines, settings=None, probes=('donor', 'acceptor', 'apolar'), extract_dir=None):
+    """
+    :param result_paths: dictionary of {name: path to an out.zip file or result directory}
+    :param engines: names of the engines to compare; the first one is the reference
+    :param settings: SelectivityResult.Settings, for the percentile thresholds and minimum cluster sizes
+    :param probes: probes to cluster
+    :param extract_dir: directory to extract zipped maps to
+    :return: pandas.DataFrame, one row per (result, probe, engine)
+    """
+    if settings is None:
+        settings = SelectivityResult.Settings()
+    rows = []
+    for name, path in result_paths.items():
+        for probe in probes:
+            map_path = find_result_file(path, '{}.ccp4'.format(probe), Path(extract_dir, name))
+            if map_path is None:
+                print("No {} map in {}".format(probe, path))
+                continue
+            _, values = open_ccp4(map_path)
+            array = np.array(values, dtype=np.float64)
+            del values
+
+            if probe == 'apolar':
+                percentile, min_points = settings.apolar_percentile_threshold, settings.min_points_cluster_apolar
+            else:
+                percentile, min_points = settings.polar_percentile_threshold, settings.min_points_cluster_polar
+            for row in benchmark_map(threshold_map(array, percentile), min_points, engines):
+                row.update({'result': name, 'probe': probe})
+                rows.append(row)
+                print(row)
+    df = pd.DataFrame(rows)
+    return df[['result', 'probe'] + [c for c in df.columns if c not in ('result', 'probe')]]
+
+
+if __name__ == "__main__":
+
+    figures_dir = Path('../paper_figures')
+    result_paths = {'CK2alpha_over_PIM1': Path(figures_dir, 'Figure_4', 'selectivity_CK2alpha_over_PIM1', 'out')}
+    for target in ['BRD1', 'ck2_alpha', 'p38_alpha']:
+        for thresh in ['0', '20', '50', 'median_zeros']:
+            result_paths['{}_threshold_{}'.format(target, thresh)] = Path(figures_dir, 'Figure_5', target,
+                                                                         'ensemble_maps_threshold_{}'.format(thresh),
+                                                                         'out.zip')
+
+    extract_dir = Path('../case_studies/clustering_benchmark')
+    extract_dir.mkdir(parents=True, exist_ok=True)
+    engines = ['hdbscan'] + [e for e in CLUSTERING_ENGINES.keys() if e != 'hdbscan']
+
+    df = benchmark_results(result_paths, engines, extract_dir=extract_dir)
+    df.to_csv(Path(extract_dir, 'clustering_benchmark.csv'))
+    print(df.groupby('engine')[['time_s', 'ARI_vs_hdbscan', 'same_noise_fraction']].mean())
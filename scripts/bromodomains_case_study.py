@@ -1,7 +1,7 @@
 from pathlib import Path
 from ccdc.protein import Protein
 from hotspots.hs_io import HotspotWriter, HotspotReader
-from hotspots.hs_ensembles import EnsembleResult, SelectivityResult
+from hs_ensembles import EnsembleResult, SelectivityResult
 from siena_ensemble import SienaQuery
 from utils import process_siena_pdbs, get_subset, shrink_bs_maps
 from run_hotspots_job import run_parallel_hotspot_jobs
@@ -82,10 +82,12 @@ for ens in ensemble_dict.keys():
    ensemble_settings.combine_mode = 'median'
    ensemble_settings.apolar_frequency_threshold = None
    ensemble_settings.polar_frequency_threshold = 20.0
+   ensemble_settings.cache_dir = Path(ens_dir.parent, 'ensemble_cache')
 
    ensemble = EnsembleResult(hs_results_list=shrunk_hotspots,
                              ensemble_id=ensemble_dict[ens]['target_name'],
-                             settings=ensemble_settings)
+                             settings=ensemble_settings,
+                             result_paths=[Path(p, 'out.zip') for p in shrunk_hot_paths])
 
    ensemble.make_ensemble_maps(save_grid_ensembles=False)
    ensemble_hs_result = ensemble.ensemble_hotspot_result
@@ -99,6 +101,7 @@ for ens in ensemble_dict.keys():
 selectivity_settings = SelectivityResult.Settings()
 selectivity_settings.cluster_distance_cutoff = 3.0
 selectivity_settings.minimal_cluster_score = 10.0
+selectivity_settings.cache_dir = Path(ens_dir.parent, 'selectivity_cache')
 
 with HotspotReader(ensemble_dict['on_target']['ensemble_maps']) as onhr:
     tar_res = onhr.read()
@@ -107,7 +110,8 @@ with HotspotReader(ensemble_dict['off_target']['ensemble_maps']) as offhr:
     off_res = offhr.read()
 
 on_over_off = SelectivityResult(target_result=tar_res,
-                                       other_result=off_res
+                                       other_result=off_res,
+                                       settings=selectivity_settings
                                 )
 on_over_off.make_selectivity_maps()
 
@@ -1,8 +1,10 @@
 from pathlib import Path
 import pandas as pd
-from utils import get_subset, get_clusters_centre_mass
-from hotspots.hs_io import HotspotReader, HotspotWriter
-from hotspots.hs_ensembles import EnsembleResult
+from utils import get_subset
+from labeled_stats import cluster_statistics
+from hotspots.hs_io import HotspotWriter
+from hs_ensembles import EnsembleResult
+from result_loader import load_results
 from hotspots.grid_extension import _GridEnsemble
 import numpy as np
 import matplotlib.pyplot as plt
@@ -79,14 +81,15 @@ def ensemble_cluster_summary(ensemble_res, save_dir):
 
         probe_clust_grid = ensemble_res.grid_ensembles[probe].as_grid(ensemble_probe_clusters)
         probe_clust_grid.write(str(Path(save_dir, f"{probe}_ensemble_clusters_ranges.ccp4")))
-        coords = get_clusters_centre_mass(ensemble_probe_clusters, probe_array)
+        clust_stats = cluster_statistics(ensemble_probe_clusters, probe_array)
+        num_points_map = probe_clust_grid.count_grid()
 
-        for c in coords.keys():
+        for c, st in clust_stats.items():
             clust_ids.append(f"{probe}_{c}")
-            clust_size.append(len(ensemble_probe_clusters[ensemble_probe_clusters == c]))
-            clust_centroid.append(coords[c])
-            clust_medians.append(np.median(probe_array[ensemble_probe_clusters == c]))
-            map_size.append(probe_clust_grid.count_grid())
+            clust_size.append(st.size)
+            clust_centroid.append(st.centroid)
+            clust_medians.append(st.median)
+            map_size.append(num_points_map)
             clust_contributing.append([ensemble_res.index_dict[ci[0]] for ci in contribs[c]])
             clust_contributions.append([ci[1] for ci in contribs[c]])
 
@@ -117,7 +120,8 @@ if __name__ == "__main__":
 
         subset_df = pd.read_csv(ens_df_path)
 
-        hotspot_list = []
+        hotspot_paths = []
+        pnames = []
 
         for idx, row in subset_df.iterrows():
             # Find the protein file:
@@ -134,14 +138,14 @@ if __name__ == "__main__":
             hs_path = Path(ens_df_path.parent, 'hotspot_results', pname, 'fullsize_hotspots_3000', 'binding_site_maps', 'out.zip')
 
             if hs_path.exists():
-                with HotspotReader(str(hs_path)) as hsr:
-                    res = hsr.read()
-                    res.protein.identifier = pname
-                    hotspot_list.append(res)
-                #print('ok')
+                hotspot_paths.append(hs_path)
+                pnames.append(pname)
             else:
                 print(f"No hotspot maps found for {pname}. Re-run the case study script")
 
+        # Read the results in parallel, in the order of the subset
+        hotspot_list = load_results(hotspot_paths, identifiers=pnames, workers=8)
+
         # Now make the ensembles
 
         thresholds = [None, 0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100]
@@ -152,26 +156,30 @@ if __name__ == "__main__":
             image_dir.mkdir()
         # break
 
+        # The zipped ensemble maps of every threshold are large; only the cluster summaries are needed by default
+        write_ensemble_maps = False
+
+        # Index the maps once, then read off the ensemble maps for every threshold
+        ensemble_settings = EnsembleResult.Settings()
+        ensemble_settings.combine_mode = 'median'
+        ensemble_settings.cache_dir = Path('../case_studies/ensemble_cache')
+        ensemble = EnsembleResult(hs_results_list=hotspot_list,
+                                  ensemble_id=ens_name,
+                                  settings=ensemble_settings,
+                                  result_paths=hotspot_paths)
+        ensemble.make_ensemble_index(index_dir=Path(ens_df_path.parent, 'ensemble_index'), save_grid_ensembles=True)
+
         for t in thresholds:
-            ensemble_settings = EnsembleResult.Settings()
-            ensemble_settings.combine_mode = 'median'
-            if t is not None:
-                ensemble_settings.apolar_frequency_threshold = float(t)
-                ensemble_settings.polar_frequency_threshold = float(t)
-            else:
-                print('t is None')
-                ensemble_settings.apolar_frequency_threshold = None
-                ensemble_settings.polar_frequency_threshold = None
-            ensemble = EnsembleResult(hs_results_list=hotspot_list,
-                                      ensemble_id=f"{ens_name}_{t}",
-                                      settings=ensemble_settings)
-            ensemble.make_ensemble_maps(save_grid_ensembles=True)
-            ensemble_hs_result = ensemble.ensemble_hotspot_result
+            ensemble_hs_result = ensemble.query_ensemble_maps(t, t, combine_mode=ensemble_settings.combine_mode)
+            ensemble.ensemble_hotspot_result = ensemble_hs_result
             if t is not None:
                 ens_path = Path(ens_df_path.parent, f'ensemble_maps_threshold_{t}')
             else:
                 ens_path = Path(ens_df_path.parent, f'ensemble_maps_threshold_{ensemble_settings.combine_mode}_zeros')
 
+            if not ens_path.exists():
+                ens_path.mkdir()
+
             try:
                 ens_df = ensemble_cluster_summary(ensemble, save_dir=ens_path)
                 ens_df.to_csv(str(Path(ens_path, "ensemble_cluster_summary.csv")))
@@ -179,6 +187,7 @@ if __name__ == "__main__":
             except ValueError as ve:
                 print(ve)
 
-            with HotspotWriter(str(ens_path), grid_extension=".ccp4", zip_results=True) as w:
-                w.write(ensemble_hs_result)
+            if write_ensemble_maps:
+                with HotspotWriter(str(ens_path), grid_extension=".ccp4", zip_results=True) as w:
+                    w.write(ensemble_hs_result)
 
@@ -1,10 +1,12 @@
 from pathlib import Path
 import numpy as np
 import pandas as pd
-from utils import get_clusters_centre_mass
+from labeled_stats import cluster_statistics
+from ccp4_maps import write_ccp4, grid_from_array
+from grid_geometry import GridFrame, grid_frame
 from hotspots.hs_io import  HotspotReader, HotspotWriter
-from hotspots.hs_ensembles import SelectivityResult
-from hotspots.grid_extension import Grid, _GridEnsemble
+from hs_ensembles import SelectivityResult
+from hotspots.grid_extension import _GridEnsemble
 
 def as_grid(origin_coords, far_corner_coords, array, spacing=0.5):
     """
@@ -13,30 +15,14 @@ def as_grid(origin_coords, far_corner_coords, array, spacing=0.5):
     :param array: 3D numpy array, usually containing processed ensemble data
     :return: a :class: 'ccdc.utilities.Grid' instance
     """
-    # Initialise the Grid
-    grid = Grid(origin=origin_coords,
-                far_corner=far_corner_coords,
-                spacing=spacing,
-                default=0.0,
-                _grid=None)
-
-    # Get the nonzero indices and values of the array
-    nonz = array.nonzero()
-    values = array[nonz]
-    # Get indices per value
-    as_triads = zip(*nonz)
-
-    # Fill in the grid
-    for (i, j, k), v in zip(as_triads, values):
-        grid._grid.set_value(int(i), int(j), int(k), v)
-
-    return grid
+    # Copied in bulk rather than with one set_value call per point
+    return grid_from_array(array, GridFrame(origin=tuple(origin_coords), nsteps=array.shape, spacing=spacing))
 
 def ensemble_cluster_summary(hs_res, save_dir, polar_min_clust=3, apolar_min_clust=20):
     clust_ids = []
     clust_size = []
     total_points_map = []
-    median_clust_value = []
+    clust_medians = []
     clust_centroid = []
 
 
@@ -57,20 +43,18 @@ def ensemble_cluster_summary(hs_res, save_dir, polar_min_clust=3, apolar_min_clu
                                                                         allow_single_cluster=True)
 
 
-            probe_clust_grid = as_grid(hs_res.super_grids[probe].bounding_box[0],
-                                       hs_res.super_grids[probe].bounding_box[1],
-                                       ensemble_probe_clusters,
-                                       hs_res.super_grids[probe].spacing)
-            probe_clust_grid.write(str(Path(save_dir, f"{probe}_clusters_ranges.ccp4")))
-            coords = get_clusters_centre_mass(ensemble_probe_clusters, probe_array)
-            clust_medians = []
+            # Written in one call, on the geometry of the probe map
+            write_ccp4(Path(save_dir, f"{probe}_clusters_ranges.ccp4"), ensemble_probe_clusters,
+                       grid_frame(hs_res.super_grids[probe]))
+            clust_stats = cluster_statistics(ensemble_probe_clusters, probe_array)
+            num_points_map = np.count_nonzero(ensemble_probe_clusters)
 
-            for c in coords.keys():
+            for c, st in clust_stats.items():
                 clust_ids.append(f"{probe}_{c}")
-                clust_size.append(len(ensemble_probe_clusters[ensemble_probe_clusters == c]))
-                total_points_map.append(probe_clust_grid.count_grid())
-                clust_centroid.append(coords[c])
-                clust_medians.append(np.median(probe_array[ensemble_probe_clusters==c]))
+                clust_size.append(st.size)
+                total_points_map.append(num_points_map)
+                clust_centroid.append(st.centroid)
+                clust_medians.append(st.median)
         except ValueError as ve:
             print(ve)
 
@@ -107,24 +91,23 @@ if __name__ == "__main__":
     with HotspotReader(str(off_target_path)) as oftr:
         off_target_ens = oftr.read()
 
-    for c in [5.0, 10.0, 15.0]:
-        for d in [1.0, 1.5, 2.0, 3.0, 4.0, 5.0]:
-
-            selectivity_settings = SelectivityResult.Settings()
-            selectivity_settings.cluster_distance_cutoff = d
-            selectivity_settings.minimal_cluster_score = c
+    # The difference maps are clustered once; each (score, distance) combination only filters the clusters
+    on_over_off = SelectivityResult(target_result=on_target_ens,
+                                    other_result=off_target_ens,
+                                    settings=SelectivityResult.Settings(
+                                        cache_dir=Path('../case_studies/selectivity_cache')))
+    sweep_results, sweep_summary = on_over_off.sweep(scores=[5.0, 10.0, 15.0],
+                                                     distances=[1.0, 1.5, 2.0, 3.0, 4.0, 5.0])
 
-            on_over_off = SelectivityResult(target_result=on_target_ens,
-                                            other_result=off_target_ens,
-                                            settings=selectivity_settings
-                                            )
-            on_over_off.make_selectivity_maps()
+    bromo_dir = Path('../case_studies/select_maps_param_run')
+    bromo_dir.mkdir(parents=True, exist_ok=True)
+    for (c, d), selectivity_result in sweep_results.items():
+        bc_path = Path(bromo_dir, f"selectivity_{on_target}_over_{off_target}_score_{c}_distance_{d}")
 
-            bromo_dir = Path('../case_studies/select_maps_param_run')
-            bc_path = Path(bromo_dir, f"selectivity_{on_target}_over_{off_target}_score_{c}_distance_{d}")
+        with HotspotWriter(str(bc_path),grid_extension=".ccp4", zip_results=False) as w:
+            w.write(selectivity_result)
 
-            with HotspotWriter(str(bc_path),grid_extension=".ccp4", zip_results=False) as w:
-                w.write(on_over_off.selectivity_result)
+        bc_df = ensemble_cluster_summary(selectivity_result, save_dir=bc_path)
+        bc_df.to_csv(Path(bc_path, "ensemble_cluster_summary.csv"))
 
-            bc_df = ensemble_cluster_summary(on_over_off.selectivity_result, save_dir=bc_path)
-            bc_df.to_csv(Path(bc_path, "ensemble_cluster_summary.csv"))
+    sweep_summary.to_csv(Path(bromo_dir, f"selectivity_{on_target}_over_{off_target}_sweep_summary.csv"))
@@ -0,0 +1,220 @@
+import os
+import tempfile
+import numpy as np
+from hotspots.grid_extension import Grid, _GridEnsemble
+from grid_geometry import GridFrame, grid_frame, frame_dimensions
+
+# Data types of the CCP4/MRC map modes
+MAP_MODES = {0: np.int8,
+             1: np.int16,
+             2: np.float32,
+             6: np.uint16,
+             12: np.float16}
+
+HEADER_BYTES = 1024
+
+
+def read_ccp4_header(path):
+    """
+    Reads the parts of a CCP4/MRC header needed to place the map on a lattice.
+    :param path: path to a .ccp4 or .mrc file
+    :return: dictionary with the frame (grid_geometry.GridFrame), the data type, the byte offset of the data, and the
+             axis order (0-based x, y, z axes of the columns, rows and sections)
+    """
+    return parse_ccp4_header(np.fromfile(str(path), dtype=np.uint8, count=HEADER_BYTES), path)
+
+
+def parse_ccp4_header(raw, path=''):
+    """
+    :param raw: the first HEADER_BYTES bytes of a CCP4/MRC map (bytes or numpy uint8 array)
+    :param path: name of the map, for error messages
+    :return: see read_ccp4_header
+    """
+    raw = np.frombuffer(raw, dtype=np.uint8) if isinstance(raw, bytes) else raw
+    ints = raw.view('<i4')
+    byteorder = '<'
+    # MAPC must be 1, 2 or 3; otherwise the map was written big-endian
+    if not 1 <= ints[16] <= 3:
+        byteorder = '>'
+        ints = raw.view('>i4')
+    floats = raw.view(byteorder + 'f4')
+
+    ncrs = ints[0:3]
+    mode = int(ints[3])
+    ncrs_start = ints[4:7]
+    mxyz = ints[7:10]
+    cell = floats[10:13]
+    axes = ints[16:19] - 1
+    n_extended = int(ints[23])
+    # MRC2014 ORIGIN, used by maps whose origin is not on the lattice (see write_ccp4)
+    mrc_origin = floats[49:52]
+
+    if mode not in MAP_MODES:
+        raise ValueError("Unsupported CCP4/MRC map mode {} in {}".format(mode, path))
+
+    spacings = cell / np.where(mxyz > 0, mxyz, 1)
+    if not np.allclose(spacings, spacings[0], rtol=1e-4):
+        raise ValueError("Map {} is not on a cubic lattice: spacings {}".format(path, spacings))
+    spacing = float(spacings[0])
+
+    nsteps = np.zeros(3, dtype=int)
+    start = np.zeros(3, dtype=int)
+    nsteps[axes] = ncrs
+    start[axes] = ncrs_start
+    origin = mrc_origin if np.any(mrc_origin != 0) and not np.any(start) else start * spacing
+
+    return {'frame': GridFrame(origin=tuple(float(x) for x in origin),
+                               nsteps=tuple(int(n) for n in nsteps),
+                               spacing=spacing),
+            'dtype': np.dtype(MAP_MODES[mode]).newbyteorder(byteorder),
+            'offset': HEADER_BYTES + n_extended,
+            'axes': tuple(int(a) for a in axes)}
+
+
+def open_ccp4(path, mode='r'):
+    """
+    Memory-maps the values of a CCP4/MRC map without reading them.
+    :param path: path to a .ccp4 or .mrc file
+    :param mode: numpy.memmap mode
+    :return: tuple of (grid_geometry.GridFrame, (x, y, z) numpy memmap view of the values)
+    """
+    header = read_ccp4_header(path)
+    axes = header['axes']
+    # On disk, the columns vary fastest, then the rows, then the sections
+    shape = tuple(header['frame'].nsteps[a] for a in reversed(axes))
+    data = np.memmap(str(path), dtype=header['dtype'], mode=mode, offset=header['offset'], shape=shape)
+    # Move the section, row and column axes to their x, y and z positions
+    return header['frame'], np.transpose(data, np.argsort(list(reversed(axes))))
+
+
+def _ccp4_header(frame, dtype, values=None):
+    """
+    :param frame: grid_geometry.GridFrame
+    :param dtype: numpy data type of the values (one of MAP_MODES)
+    :param values: numpy array of the values, for the density statistics (optional)
+    :return: numpy array of the 1024 header bytes
+    """
+    modes = {np.dtype(t): m for m, t in MAP_MODES.items()}
+    if np.dtype(dtype) not in modes:
+        raise ValueError("CCP4/MRC maps cannot hold values of type {}".format(dtype))
+
+    nsteps = np.array(frame.nsteps)
+    ints = np.zeros(HEADER_BYTES // 4, dtype='<i4')
+    floats = ints.view('<f4')
+    # The columns are z, the rows y and the sections x, so a C-ordered (x, y, z) array is written as is
+    ints[0:3] = nsteps[::-1]
+    ints[3] = modes[np.dtype(dtype)]
+    start = np.array(frame.origin) / frame.spacing
+    if np.allclose(start, np.rint(start), atol=1e-4):
+        ints[4:7] = np.rint(start).astype(int)[::-1]
+    else:
+        # The origin is not on the lattice: store it in the MRC2014 ORIGIN words instead
+        floats[49:52] = frame.origin
+    ints[7:10] = nsteps - 1
+    floats[10:13] = (nsteps - 1) * frame.spacing
+    floats[13:16] = 90.0
+    ints[16:19] = (3, 2, 1)
+    if values is not None and values.size > 0:
+        floats[19:22] = (values.min(), values.max(), values.mean(dtype=np.float64))
+        floats[54] = values.std(dtype=np.float64)
+    ints[22] = 1
+    ints[52] = np.frombuffer(b'MAP ', dtype='<i4')[0]
+    # Machine stamp for little-endian data
+    ints[53] = np.frombuffer(bytes([0x44, 0x41, 0, 0]), dtype='<i4')[0]
+    return ints.view(np.uint8)
+
+
+def write_ccp4(path, array, frame):
+    """
+    Writes a 3D array as a CCP4/MRC map in one call (no per-voxel loop). The values are written in the order they are
+    held in memory, with no transposition.
+    :param path: path to the .ccp4 or .mrc file
+    :param array: 3D numpy array with shape frame.nsteps
+    :param frame: grid_geometry.GridFrame
+    :return: path
+    """
+    if tuple(array.shape) != tuple(frame.nsteps):
+        raise ValueError("Array of shape {} does not match the frame {}".format(array.shape, frame.nsteps))
+    dtype = array.dtype if array.dtype in [np.dtype(t) for t in MAP_MODES.values()] else np.dtype(np.float32)
+    values = np.ascontiguousarray(array, dtype=np.dtype(dtype).newbyteorder('<'))
+    with open(str(path), 'wb') as f:
+        f.write(_ccp4_header(frame, dtype, values).tobytes())
+        values.tofile(f)
+    return path
+
+
+def ccp4_bytes(array, frame):
+    """
+    Encodes a 3D array as the contents of a CCP4/MRC map (see write_ccp4), for writing to streams and archives.
+    :param array: 3D numpy array with shape frame.nsteps
+    :param frame: grid_geometry.GridFrame
+    :return: bytes
+    """
+    if tuple(array.shape) != tuple(frame.nsteps):
+        raise ValueError("Array of shape {} does not match the frame {}".format(array.shape, frame.nsteps))
+    dtype = array.dtype if array.dtype in [np.dtype(t) for t in MAP_MODES.values()] else np.dtype(np.float32)
+    values = np.ascontiguousarray(array, dtype=np.dtype(dtype).newbyteorder('<'))
+    return _ccp4_header(frame, dtype, values).tobytes() + values.tobytes()
+
+
+def create_ccp4(path, frame, dtype=np.float32):
+    """
+    Creates a CCP4/MRC map of zeros and memory-maps it for writing, so that large maps can be filled slab by slab.
+    (The density statistics of the header are left at 0.)
+    :param path: path to the .ccp4 or .mrc file
+    :param frame: grid_geometry.GridFrame
+    :param dtype: numpy data type of the values (one of MAP_MODES)
+    :return: (x, y, z) numpy memmap of the values
+    """
+    with open(str(path), 'wb') as f:
+        f.write(_ccp4_header(frame, dtype).tobytes())
+    values = np.memmap(str(path), dtype=np.dtype(dtype).newbyteorder('<'), mode='r+', offset=HEADER_BYTES,
+                       shape=tuple(frame.nsteps))
+    return values
+
+
+def write_grid_ccp4(path, grid):
+    """
+    Writes a ccdc.utilities.Grid as a CCP4 map, on the grid's own geometry.
+    :param path: path to the .ccp4 file
+    :param grid: ccdc.utilities.Grid
+    :return: path
+    """
+    return write_ccp4(path, _GridEnsemble.array_from_grid(grid), grid_frame(grid))
+
+
+def grid_from_ccp4(path, frame):
+    """
+    Reads a CCP4 map written by write_ccp4 or create_ccp4 into a ccdc.utilities.Grid with Grid.from_file.
+    :param path: path to the .ccp4 file
+    :param frame: grid_geometry.GridFrame the map was written on
+    :return: a :class: 'ccdc.utilities.Grid' instance
+    """
+    grid = Grid.from_file(str(path))
+
+    # Origins off the lattice are kept in the MRC2014 ORIGIN words, which older readers ignore
+    if not np.allclose(grid_frame(grid).origin, frame.origin, atol=1e-3):
+        print("Map origin {} could not be read back from CCP4; filling the grid point by point".format(frame.origin))
+        _, values = open_ccp4(path)
+        ge = _GridEnsemble(dimensions=frame_dimensions(frame), shape=frame.nsteps)
+        grid = ge.as_grid(np.array(values))
+        del values
+    return grid
+
+
+def grid_from_array(array, frame):
+    """
+    Builds a ccdc.utilities.Grid from a 3D array without one Grid.set_value call per nonzero point (as
+    _GridEnsemble.as_grid does). The ccdc Grid cannot be filled from a buffer, so the array is written to a temporary
+    CCP4 file (as float32) and read back with Grid.from_file; the cost is a file write and read of the whole map.
+    :param array: 3D numpy array with shape frame.nsteps
+    :param frame: grid_geometry.GridFrame
+    :return: a :class: 'ccdc.utilities.Grid' instance
+    """
+    fd, path = tempfile.mkstemp(suffix='.ccp4')
+    os.close(fd)
+    try:
+        write_ccp4(path, array, frame)
+        return grid_from_ccp4(path, frame)
+    finally:
+        os.remove(path)
@@ -0,0 +1,68 @@
+"""
+Checks that the ensemble maps do not depend on the number of workers: for each stacked backend, the maps of an
+ensemble are made with workers=1 and with several workers, and compared value for value (exact equality).
+"""
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from hotspots.grid_extension import _GridEnsemble
+from hs_ensembles import EnsembleResult
+from result_loader import load_results
+
+
+def ensemble_arrays(hotspot_results, settings):
+    """
+    :param hotspot_results: list of hotspots results
+    :param settings: EnsembleResult.Settings
+    :return: dictionary of {probe: 3D numpy array of the ensemble map}
+    """
+    ensemble = EnsembleResult(hs_results_list=hotspot_results, settings=settings)
+    ensemble.make_ensemble_maps(save_grid_ensembles=False)
+    return {probe: _GridEnsemble.array_from_grid(g) for probe, g in ensemble.ensemble_maps.items()}
+
+
+def compare_worker_counts(hotspot_results, workers=4, backends=('memory', 'memmap'), combine_modes=('median',),
+                          stack_dtypes=('float32',)):
+    """
+    :param hotspot_results: list of hotspots results
+    :param workers: number of workers compared with workers=1
+    :param backends: stack backends to check
+    :param combine_modes: combine modes to check
+    :param stack_dtypes: storage types of the stacked maps to check
+    :return: pandas.DataFrame, one row per (backend, combine mode, storage type, probe)
+    """
+    rows = []
+    for backend in backends:
+        for mode in combine_modes:
+            for dtype in stack_dtypes:
+                maps = {}
+                for n in [1, workers]:
+                    settings = EnsembleResult.Settings(combine_mode=mode, stack_backend=backend, stack_dtype=dtype,
+                                                       workers=n)
+                    maps[n] = ensemble_arrays(hotspot_results, settings)
+                for probe, serial in maps[1].items():
+                    parallel = maps[workers][probe]
+                    same_shape = serial.shape == parallel.shape
+                    rows.append({'backend': backend,
+                                 'combine_mode': mode,
+                                 'stack_dtype': dtype,
+                                 'probe': probe,
+                                 'identical': same_shape and serial.tobytes() == parallel.tobytes(),
+                                 'max_abs_diff': float(np.max(np.abs(serial - parallel))) if same_shape else np.nan})
+                    print(rows[-1])
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+
+    ens_dir = Path('../case_studies/bromodomains_protoss_csd2021/BRD1')
+    hotspot_paths = sorted(Path(ens_dir, 'hotspot_results').glob('*/fullsize_hotspots_3000/binding_site_maps/out.zip'))
+    hotspot_list = load_results(hotspot_paths, identifiers=[p.parents[2].name for p in hotspot_paths], workers=8)
+
+    df = compare_worker_counts(hotspot_list, workers=4, combine_modes=('median', 'mean', 'max'),
+                               stack_dtypes=('float32', 'uint8'))
+    df.to_csv(Path(ens_dir, 'parallel_ensemble_maps_check.csv'))
+    if not df['identical'].all():
+        print(df[~df['identical']])
+        raise ValueError("The ensemble maps depend on the number of workers")
+    print("The ensemble maps are identical for 1 and 4 workers")
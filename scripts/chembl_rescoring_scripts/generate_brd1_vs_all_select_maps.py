@@ -1,10 +1,16 @@
+import sys
 from pathlib import Path
 import numpy as np
 import pandas as pd
 from utils import get_clusters_centre_mass
 from hotspots.hs_io import  HotspotReader, HotspotWriter
-from hotspots.hs_ensembles import SelectivityResult
-from hotspots.grid_extension import Grid, _GridEnsemble
+from hotspots.grid_extension import _GridEnsemble
+# The selectivity panel lives with the ensemble code in the parent scripts directory
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from hs_ensembles import SelectivityResult
+from selectivity_panel import selectivity_panel
+from ccp4_maps import write_ccp4, grid_from_array
+from grid_geometry import GridFrame, grid_frame
 
 def as_grid(origin_coords, far_corner_coords, array, spacing=0.5):
     """
@@ -12,24 +18,8 @@ def as_grid(origin_coords, far_corner_coords, array, spacing=0.5):
     :param array: 3D numpy array, usually containing processed ensemble data
     :return: a :class: 'ccdc.utilities.Grid' instance
     """
-    # Initialise the Grid
-    grid = Grid(origin=origin_coords,
-                far_corner=far_corner_coords,
-                spacing=spacing,
-                default=0.0,
-                _grid=None)
-
-    # Get the nonzero indices and values of the array
-    nonz = array.nonzero()
-    values = array[nonz]
-    # Get indices per value
-    as_triads = zip(*nonz)
-
-    # Fill in the grid
-    for (i, j, k), v in zip(as_triads, values):
-        grid._grid.set_value(int(i), int(j), int(k), v)
-
-    return grid
+    # Copied in bulk rather than with one set_value call per point
+    return grid_from_array(array, GridFrame(origin=tuple(origin_coords), nsteps=array.shape, spacing=spacing))
 
 def ensemble_cluster_summary(hs_res, save_dir, polar_min_clust=3, apolar_min_clust=20):
     clust_ids = []
@@ -56,18 +46,16 @@ def ensemble_cluster_summary(hs_res, save_dir, polar_min_clust=3, apolar_min_clu
                                                                         allow_single_cluster=True)
 
 
-            probe_clust_grid = as_grid(hs_res.super_grids[probe].bounding_box[0],
-                                       hs_res.super_grids[probe].bounding_box[1],
-                                       ensemble_probe_clusters,
-                                       hs_res.super_grids[probe].spacing)
-            probe_clust_grid.write(str(Path(save_dir, f"{probe}_clusters_ranges.ccp4")))
+            # Written in one call, on the geometry of the probe map
+            write_ccp4(Path(save_dir, f"{probe}_clusters_ranges.ccp4"), ensemble_probe_clusters,
+                       grid_frame(hs_res.super_grids[probe]))
             coords = get_clusters_centre_mass(ensemble_probe_clusters, probe_array)
             clust_medians = []
 
             for c in coords.keys():
                 clust_ids.append(f"{probe}_{c}")
                 clust_size.append(len(ensemble_probe_clusters[ensemble_probe_clusters == c]))
-                total_points_map.append(probe_clust_grid.count_grid())
+                total_points_map.append(np.count_nonzero(ensemble_probe_clusters))
                 clust_centroid.append(coords[c])
                 clust_medians.append(np.median(probe_array[ensemble_probe_clusters==c]))
         except ValueError as ve:
@@ -94,37 +82,12 @@ if __name__ == "__main__":
     'BRD9' : Path('../ensembles/BRD9/ensemble_maps/out.zip')
     }
     
-    on_target = 'BRD1'
-    for off_target in info_dict.keys():
-        if on_target != off_target:
-            on_target_path = info_dict[on_target]
-            off_target_path = info_dict[off_target]
-            with  HotspotReader(str(on_target_path)) as otr:
-                on_target_ens = otr.read()
-
-            with HotspotReader(str(off_target_path)) as oftr:
-                off_target_ens = oftr.read()
-
-            for c in [10.0]:
-                for d in [1.5]:
-
-                    selectivity_settings = SelectivityResult.Settings()
-                    selectivity_settings.cluster_distance_cutoff = d
-                    selectivity_settings.minimal_cluster_score = c
-
-                    on_over_off = SelectivityResult(target_result=on_target_ens,
-                                                    other_result=off_target_ens,
-                                                    settings=selectivity_settings
-                                                    )
-                    on_over_off.make_selectivity_maps()
-
-                    bromo_dir = Path('../results/select_maps_all')
-                    if not bromo_dir.exists(): bromo_dir.mkdir()
-
-                    bc_path = Path(bromo_dir, f"selectivity_{on_target}_over_{off_target}_score_{c}_distance_{d}")
-
-                    with HotspotWriter(str(bc_path),grid_extension=".ccp4", zip_results=False) as w:
-                        w.write(on_over_off.selectivity_result)
-
-#                         bc_df = ensemble_cluster_summary(on_over_off.selectivity_result, save_dir=bc_path)
-#                         bc_df.to_csv(Path(bc_path, "ensemble_cluster_summary.csv"))
\ No newline at end of file
+    # Every pair of ensembles is compared once, and gives the selectivity maps in both directions
+    bromo_dir = Path('../results/select_maps_all')
+    selectivity_settings = SelectivityResult.Settings()
+    selectivity_settings.cluster_distance_cutoff = 1.5
+    selectivity_settings.minimal_cluster_score = 10.0
+    selectivity_settings.cache_dir = Path('../results/selectivity_cache')
+
+    panel_df = selectivity_panel(info_dict, out_dir=bromo_dir, settings=selectivity_settings, workers=4)
+    panel_df.to_csv(Path(bromo_dir, "selectivity_panel_summary.csv"))
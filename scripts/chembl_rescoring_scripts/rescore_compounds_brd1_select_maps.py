@@ -1,3 +1,4 @@
+import sys
 from pathlib import Path
 import pandas as pd
 from utils import get_subset, get_clusters_centre_mass, shrink_bs_maps
@@ -9,6 +10,12 @@ from hotspots.hs_ensembles import EnsembleResult
 from hotspots.grid_extension import _GridEnsemble, Grid
 import numpy as np
 import matplotlib.pyplot as plt
+# The selectivity code lives with the ensemble code in the parent scripts directory
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from hs_ensembles import SelectivityResult
+from grid_lookup import GridLookup, molecule_features, per_molecule
+from grid_geometry import grid_frame
+from ccp4_maps import grid_from_array
 
 
 def ensemble_cluster_summary(ensemble_res, save_dir):
@@ -38,7 +45,8 @@ def ensemble_cluster_summary(ensemble_res, save_dir):
                                                                     allow_single_cluster=True)
         contribs = probe_ens.get_contributing_maps(ensemble_probe_clusters)
 
-        probe_clust_grid = ensemble_res.grid_ensembles[probe].as_grid(ensemble_probe_clusters)
+        probe_clust_grid = grid_from_array(ensemble_probe_clusters,
+                                           grid_frame(ensemble_res.ensemble_hotspot_result.super_grids[probe]))
         probe_clust_grid.write(str(Path(save_dir, f"{probe}_ensemble_clusters_ranges.ccp4")))
         coords = get_clusters_centre_mass(ensemble_probe_clusters, probe_array)
 
@@ -88,6 +96,29 @@ def make_brd1_summary_ensemble(brd1_selmaps, ensemble_dir):
         hwr.write(ensemble_hs_result)
     return ensemble_df
 
+def make_brd1_multi_selectivity(brd1_path, off_target_paths, save_dir, off_target_combine='max'):
+    """
+    Selectivity maps of BRD1 over all the other bromodomains at once: the off-target ensemble maps are combined at
+    each point (max, or a percentile) and subtracted from the BRD1 map, which is clustered once.
+    """
+    with HotspotReader(str(brd1_path)) as hrd:
+        brd1_res = hrd.read()
+    off_target_results = []
+    for p in off_target_paths:
+        with HotspotReader(str(p)) as hrd:
+            off_target_results.append(hrd.read())
+
+    selectivity_settings = SelectivityResult.Settings(off_target_combine=off_target_combine)
+    brd1_over_all = SelectivityResult(target_result=brd1_res,
+                                      other_result=off_target_results,
+                                      settings=selectivity_settings)
+    brd1_over_all.make_selectivity_maps()
+
+    with HotspotWriter(str(Path(save_dir, f"selectivity_BRD1_over_all_{off_target_combine}")), grid_extension=".ccp4",
+                       zip_results=False) as hwr:
+        hwr.write(brd1_over_all.selectivity_result)
+    return brd1_over_all.selectivity_result
+
 def make_struct_df(selectivity_df, aligned_compounds_dir):
     struct_list = []
     cid_list = []
@@ -142,6 +173,13 @@ if __name__ == "__main__":
     
     ens_df = make_brd1_summary_ensemble(brd1_select_maps_paths, ens_dir)
     ens_df.to_csv(str(Path(ens_dir, "BRD1_sel_cluster_summary.csv")))
+
+    # BRD1 over the whole panel in one pass, rather than ensembling the pairwise selectivity maps
+    ensemble_paths = {t: Path(f'../ensembles/{t}/ensemble_maps/out.zip')
+                      for t in ['BRD1', 'BRPF1', 'BRD7', 'BRD2', 'BRD4', 'BRD9']}
+    make_brd1_multi_selectivity(ensemble_paths['BRD1'],
+                                [p for t, p in ensemble_paths.items() if t != 'BRD1'],
+                                save_dir=ens_dir)
     #ens_df = pd.read_csv(str(Path(ens_dir, "BRD1_sel_cluster_summary.csv")), index_col=0)
         
     
@@ -158,14 +196,11 @@ if __name__ == "__main__":
     
     sub_df = compound_df[compound_df['on_target'] == 'BRD1'].copy()
     
-    cluster_scores_acceptor = []
-    cluster_scores_apolar1 = []
-    
-    
     ens_compounds_dir = Path(ens_dir, 'ensemble_compounds')
     if not ens_compounds_dir.exists():
         ens_compounds_dir.mkdir()
     
+    mols = []
     for i, row in sub_df.iterrows():
         comp_name = row['compound_chembl_id']
         sname = row['structure_name']
@@ -178,19 +213,17 @@ if __name__ == "__main__":
         Draw.MolToFile(rd_mol,str(Path(ens_compounds_dir, f"{sname}.png"))) 
         with MoleculeWriter(str(Path(ens_compounds_dir, f"{sname}.sdf"))) as mwr:
             mwr.write(mol)
-        
-        sum_scores = sum([cropped_acc_grid.value_at_coordinate(a.coordinates, tolerance=1, position=False) for a in mol.heavy_atoms if a.is_acceptor])
-        if sum_scores> 0:
-            cluster_scores_acceptor.append(1)
-        else:
-            cluster_scores_acceptor.append(0)
-            
-        sum_scores_apolar1 = sum([cropped_apolar_grid1.value_at_coordinate(a.coordinates, tolerance=1, position=False) for a in mol.heavy_atoms if (not (a.is_acceptor or a.is_donor)) and (not (a.is_donor and a.is_acceptor))]) 
-        
-        if sum_scores_apolar1> 0:
-            cluster_scores_apolar1.append(1)
-        else:
-            cluster_scores_apolar1.append(0)
+        mols.append(mol)
+
+    # Score all the atoms of all the structures in one lookup per map
+    cluster_lookup = GridLookup({'acceptor': cropped_acc_grid, 'apolar': cropped_apolar_grid1})
+    atom_coords, atom_features, atom_mols = molecule_features(mols)
+    atom_scores = cluster_lookup.values(atom_coords, atom_features, tolerance=1)
+
+    sum_scores = per_molecule(atom_scores * (atom_features == 'acceptor'), atom_mols, len(mols))
+    sum_scores_apolar1 = per_molecule(atom_scores * (atom_features == 'apolar'), atom_mols, len(mols))
+    cluster_scores_acceptor = (sum_scores > 0).astype(int)
+    cluster_scores_apolar1 = (sum_scores_apolar1 > 0).astype(int)
                 
     sub_df['BRD1_acceptor_hit'] = cluster_scores_acceptor
     sub_df['BRD1_apolar_hit'] = cluster_scores_apolar1
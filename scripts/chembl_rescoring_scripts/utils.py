@@ -1,16 +1,21 @@
+import sys
 from pathlib import Path
 from ccdc.io import MoleculeWriter, MoleculeReader
 from ccdc.protein import Protein
-from hotspots.hs_io import HotspotReader, HotspotWriter
+from hotspots.hs_io import HotspotReader
 from hotspots.wrapper_protoss import *
 from hotspots.hs_utilities import Helper
-from hotspots.hs_ensembles import EnsembleResult
 from hotspots.result import _Scorer
 from hotspots.data import common_solvents
 from hotspots.grid_extension import Grid, _GridEnsemble
 import numpy as np
 import pandas as pd
 from collections import Counter
+# The result loader and hs_ensembles live in the parent scripts directory
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from hs_ensembles import EnsembleResult
+from result_loader import iter_results
+from result_writer import StreamingHotspotWriter
 
 def get_clusters_centre_mass(cluster_array, hotspot_map):
     """
@@ -335,23 +340,26 @@ def shrink_bs_maps(hotspot_paths, ligand_paths, padding=4.0):
     shrunk_hs_result_paths = []
     
 
-    for hs_path in hotspot_paths:
+    # Read the results in parallel, in order
+    loaded = iter_results(hotspot_paths, workers=4, bbox=(min_coords, max_coords))
+    for hs_path, hs_res in zip(hotspot_paths, loaded):
         print(hs_path)
         #if not Path(hs_path.parent, 'binding_site_maps', 'out.zip').exists():
-        with HotspotReader(str(hs_path)) as hs_reader:
-            hs_res = hs_reader.read()
-        probes = hs_res.super_grids.keys()
-
-        # now to shrink the grids for each probe
-        for p in probes:
-            hs_res.super_grids[p] = EnsembleResult.shrink_to_binding_site(in_grid=hs_res.super_grids[p],
-                                                                          new_origin=min_coords,
-                                                                          new_far_corner=max_coords)
+        # Chunked (.hsc) results are cropped to the binding site while they are read
+        if Path(hs_path).suffix != '.hsc':
+            probes = hs_res.super_grids.keys()
+
+            # now to shrink the grids for each probe
+            for p in probes:
+                hs_res.super_grids[p] = EnsembleResult.shrink_to_binding_site(in_grid=hs_res.super_grids[p],
+                                                                              new_origin=min_coords,
+                                                                              new_far_corner=max_coords)
         shrunk_hs_results.append(hs_res)
 
         h_out_dir = Path(hs_path.parent, 'binding_site_maps')
         if not h_out_dir.exists(): h_out_dir.mkdir()
-        with HotspotWriter(str(h_out_dir.resolve()), grid_extension=".ccp4", zip_results=True) as writer:
+        with StreamingHotspotWriter(str(h_out_dir.resolve()), grid_extension=".ccp4", zip_results=True,
+                                    compression_level=1) as writer:
             writer.write(hs_res)
 
         shrunk_hs_result_paths.append(h_out_dir)
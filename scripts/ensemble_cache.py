@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+import numpy as np
+from grid_geometry import GridFrame
+from ensemble_stack import VoxelStack
+
+
+def file_digest(path, block_size=2**20):
+    """
+    :param path: path to a file (e.g. a hotspots out.zip)
+    :return: sha256 hex digest of the file contents
+    """
+    h = hashlib.sha256()
+    with open(str(path), 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class EnsembleCache(object):
+    """
+    On-disk cache of stacked ensembles (ensemble_stack.VoxelStack), so that scripts working on the same hotspot results
+    do not restack them. Entries are keyed by a hash of the contents of the member result files and of the geometry
+    of their grids, and are evicted least-recently-used first once the cache grows beyond max_bytes.
+
+    Each entry is a directory holding meta.json (probes, frame, structures, storage type and chunks) and one compressed
+    (structure, x, y, z) chunk per probe and slab of x-planes, so that an entry can be loaded into a memory-mapped
+    stack one chunk at a time.
+    """
+
+    def __init__(self, cache_dir, max_bytes=20 * 2**30):
+        """
+        :param cache_dir: path to the cache directory (created if needed)
+        :param max_bytes: size limit of the cache on disk
+        """
+        self.path = Path(cache_dir)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def make_key(result_paths, frames, probes, dtype='float32', scale=None):
+        """
+        :param result_paths: paths to the member results (e.g. out.zip files), in ensemble order
+        :param frames: grid_geometry.GridFrame of each member grid, in ensemble order
+        :param probes: stacked probes
+        :param dtype: storage type of the stack (see ensemble_stack.VoxelStack)
+        :param scale: scale of uint8 stacks
+        :return: str
+        """
+        h = hashlib.sha256()
+        for p in result_paths:
+            h.update(file_digest(p).encode())
+        h.update(json.dumps([list(probes), [[list(f.origin), list(f.nsteps), f.spacing] for f in frames],
+                             dtype, scale]).encode())
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return Path(self.path, key)
+
+    def __contains__(self, key):
+        return Path(self._entry(key), 'meta.json').exists()
+
+    def load(self, key, in_memory=True, stack_dir=None, shared=False):
+        """
+        :param key: cache key
+        :param in_memory: if False, the entry is loaded into a memory-mapped VoxelStack in stack_dir
+        :param shared: if True (and in_memory), the stack is loaded into shared memory
+        :return: ensemble_stack.VoxelStack, or None if the key is not in the cache
+        """
+        if key not in self:
+            return None
+        entry = self._entry(key)
+        meta = json.loads(Path(entry, 'meta.json').read_text())
+        frame = GridFrame(origin=tuple(meta['origin']), nsteps=tuple(meta['nsteps']), spacing=meta['spacing'])
+        stack = VoxelStack(meta['probes'], meta['n_structures'], frame, stack_dir=stack_dir, in_memory=in_memory,
+                           shared=shared, dtype=meta.get('dtype', 'float32'), scale=meta.get('scale'))
+        for p_idx, p in enumerate(stack.probes):
+            for start, stop in meta['chunks']:
+                with np.load(str(Path(entry, '{}_{}.npz'.format(p, start)))) as chunk:
+                    stack.array[p_idx, :, start:stop] = chunk['values']
+        if stack.path is not None:
+            stack.array.flush()
+        # Mark the entry as recently used
+        os.utime(str(Path(entry, 'meta.json')))
+        return stack
+
+    def store(self, key, stack):
+        """
+        Adds a stack to the cache, then evicts old entries if the cache is over its size limit.
+        :param key: cache key
+        :param stack: ensemble_stack.VoxelStack
+        :return:
+        """
+        if key in self:
+            return
+        tmp = Path(tempfile.mkdtemp(prefix='.tmp_', dir=str(self.path)))
+        chunks = stack.slabs()
+        for p_idx, p in enumerate(stack.probes):
+            for start, stop in chunks:
+                np.savez_compressed(str(Path(tmp, '{}_{}.npz'.format(p, start))),
+                                    values=np.asarray(stack.array[p_idx, :, start:stop]))
+        meta = {'probes': stack.probes,
+                'n_structures': stack.n_structures,
+                'origin': list(stack.frame.origin),
+                'nsteps': list(stack.frame.nsteps),
+                'spacing': stack.frame.spacing,
+                'dtype': stack.dtype.name,
+                'scale': stack.scale,
+                'chunks': [list(c) for c in chunks]}
+        Path(tmp, 'meta.json').write_text(json.dumps(meta, indent=4))
+        try:
+            tmp.rename(self._entry(key))
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(str(tmp), ignore_errors=True)
+        self.evict()
+
+    @staticmethod
+    def _size(entry):
+        return sum(f.stat().st_size for f in entry.iterdir())
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits into max_bytes. Entries still being written
+        (the .tmp_ directories of store()) belong to other processes and are never removed.
+        :return:
+        """
+        entries = [e for e in self.path.iterdir()
+                   if not e.name.startswith('.tmp_') and Path(e, 'meta.json').exists()]
+        entries.sort(key=lambda e: Path(e, 'meta.json').stat().st_mtime)
+        sizes = {e: self._size(e) for e in entries}
+        total = sum(sizes.values())
+        for e in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(str(e), ignore_errors=True)
+            total -= sizes[e]
@@ -0,0 +1,123 @@
+from pathlib import Path
+import numpy as np
+from grid_geometry import GridFrame
+from sparse_grids import SparseStack
+
+
+class EnsembleIndex(object):
+    """
+    Compact per-point index of an ensemble, written to disk once. For each probe it holds, at each point where at
+    least one structure has a nonzero value, the number of such structures and their sorted nonzero values (with the
+    structure each value came from). Any ensemble map (any frequency threshold, median, mean or max) is then read off
+    the index in a single vectorised pass over the occupied points, without the member maps.
+
+    The index is stored as index.npz in the index directory, uncompressed so that it loads quickly.
+    """
+
+    def __init__(self, frame, n_structures, stacks, identifiers=None):
+        """
+        :param frame: grid_geometry.GridFrame shared by all the probes
+        :param n_structures: number of structures in the ensemble
+        :param stacks: dictionary of {probe: sparse_grids.SparseStack}
+        :param identifiers: structure identifiers, in ensemble order
+        """
+        self.frame = frame
+        self.n_structures = n_structures
+        self.stacks = stacks
+        self.identifiers = list(identifiers) if identifiers is not None else [str(i) for i in range(n_structures)]
+
+    @property
+    def probes(self):
+        return list(self.stacks.keys())
+
+    @staticmethod
+    def from_voxel_stack(stack, identifiers=None):
+        """
+        Indexes a stacked ensemble, one slab at a time.
+        :param stack: ensemble_stack.VoxelStack
+        :param identifiers: structure identifiers, in ensemble order
+        :return: EnsembleIndex
+        """
+        stacks = {}
+        for p_idx, probe in enumerate(stack.probes):
+            structures = []
+            indices = []
+            values = []
+            for start, stop in stack.slabs():
+                block = stack.dequantize(stack.array[p_idx, :, start:stop])
+                s, x, y, z = np.nonzero(block)
+                structures.append(s.astype(np.int32))
+                indices.append(np.ravel_multi_index((x + start, y, z), stack.frame.nsteps))
+                values.append(block[s, x, y, z])
+            stacks[probe] = SparseStack(stack.frame, stack.n_structures, np.concatenate(structures),
+                                        np.concatenate(indices), np.concatenate(values))
+        return EnsembleIndex(stack.frame, stack.n_structures, stacks, identifiers)
+
+    @staticmethod
+    def from_sparse_stacks(stacks, identifiers=None):
+        """
+        :param stacks: dictionary of {probe: sparse_grids.SparseStack}, on the same frame
+        :param identifiers: structure identifiers, in ensemble order
+        :return: EnsembleIndex
+        """
+        frames = set(st.frame for st in stacks.values())
+        if len(frames) > 1:
+            raise ValueError("The sparse stacks of an ensemble index must be on the same frame")
+        first = list(stacks.values())[0]
+        return EnsembleIndex(first.frame, first.n_structures, stacks, identifiers)
+
+    def save(self, index_dir):
+        """
+        :param index_dir: path to the index directory (created if needed)
+        :return: path to the index file
+        """
+        Path(index_dir).mkdir(parents=True, exist_ok=True)
+        arrays = {'origin': np.array(self.frame.origin),
+                  'nsteps': np.array(self.frame.nsteps),
+                  'spacing': np.array(self.frame.spacing),
+                  'n_structures': np.array(self.n_structures),
+                  'identifiers': np.array(self.identifiers, dtype=str),
+                  'probes': np.array(self.probes, dtype=str)}
+        for probe, st in self.stacks.items():
+            arrays['{}_structures'.format(probe)] = st.structures.astype(np.int32)
+            arrays['{}_indices'.format(probe)] = st.indices
+            arrays['{}_values'.format(probe)] = st.values
+        path = Path(index_dir, 'index.npz')
+        np.savez(str(path), **arrays)
+        return path
+
+    @staticmethod
+    def load(index_dir):
+        """
+        :param index_dir: path to the index directory
+        :return: EnsembleIndex
+        """
+        with np.load(str(Path(index_dir, 'index.npz'))) as f:
+            frame = GridFrame(origin=tuple(float(x) for x in f['origin']),
+                              nsteps=tuple(int(n) for n in f['nsteps']),
+                              spacing=float(f['spacing']))
+            n_structures = int(f['n_structures'])
+            stacks = {}
+            for probe in f['probes']:
+                probe = str(probe)
+                stacks[probe] = SparseStack.from_sorted(frame, n_structures, f['{}_structures'.format(probe)],
+                                                        f['{}_indices'.format(probe)], f['{}_values'.format(probe)])
+            identifiers = [str(i) for i in f['identifiers']]
+        return EnsembleIndex(frame, n_structures, stacks, identifiers)
+
+    def query(self, probe, threshold=None, mode='median'):
+        """
+        Reads an ensemble map off the index (see ensemble_stack.summarise_block for the thresholds and modes).
+        :param probe: probe name
+        :param threshold: frequency threshold (percentage), or None
+        :param mode: "median", "mean" or "max"
+        :return: 3D numpy array on self.frame
+        """
+        return self.stacks[probe].summary(threshold=threshold, mode=mode).to_array()
+
+    def frequency(self, probe):
+        """
+        :param probe: probe name
+        :return: 3D numpy array on self.frame, percentage of structures with a nonzero value at each point
+        """
+        return self.stacks[probe].frequency().to_array()
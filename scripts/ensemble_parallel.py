@@ -0,0 +1,90 @@
+from multiprocessing import Pool, shared_memory
+import numpy as np
+from ensemble_stack import SortedBlock, summarise_block, slab_ranges, shared_array, storage_to_scores
+
+# Arrays attached by each worker process (see _init_worker)
+_worker_arrays = {}
+
+
+def _array_spec(stack):
+    """
+    :param stack: ensemble_stack.VoxelStack, memory-mapped or in shared memory
+    :return: tuple describing how a worker process attaches to the stack array
+    """
+    if stack.path is not None:
+        return 'memmap', stack.path, stack.array.shape, stack.dtype.name
+    if stack.shared_memory is not None:
+        return 'shared', stack.shared_memory.name, stack.array.shape, stack.dtype.name
+    raise ValueError("Parallel ensemble maps need a memory-mapped or shared-memory stack")
+
+
+def _attach(spec):
+    kind, name, shape, dtype = spec
+    if kind == 'memmap':
+        return None, np.memmap(name, dtype=dtype, mode='r', shape=shape)
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _init_worker(stack_spec, out_spec):
+    # Keep the shared memory handles alive for the lifetime of the worker
+    _worker_arrays['stack'] = _attach(stack_spec)
+    _worker_arrays['out'] = _attach(out_spec)
+
+
+def _summarise_chunk(task):
+    """
+    Combines one chunk of x-planes of one probe, and writes the result to the shared output array. A single
+    (threshold, mode) pair goes through summarise_block and several pairs through one SortedBlock, as in
+    VoxelStack.summary_map and VoxelStack.summary_map_sweep, so the output is identical to the serial stacked path
+    with workers=1.
+    """
+    p_idx, out_indices, parameters, scale, start, stop = task
+    stack = _worker_arrays['stack'][1]
+    out = _worker_arrays['out'][1]
+    block = np.asarray(stack[p_idx, :, start:stop])
+    if len(parameters) == 1:
+        threshold, mode = parameters[0]
+        out[out_indices[0], start:stop] = storage_to_scores(summarise_block(block, threshold, mode), stack.dtype, scale)
+    else:
+        sorted_block = SortedBlock(block)
+        for o, (threshold, mode) in zip(out_indices, parameters):
+            out[o, start:stop] = storage_to_scores(sorted_block.summary(threshold, mode), stack.dtype, scale)
+
+
+def parallel_summary_maps(stack, probe_parameters, workers):
+    """
+    Combines the maps of several probes of a stack on a pool of worker processes. The work is split into
+    (probe, chunk of x-planes) tasks; the stack is shared with the workers (through the memmap file or shared memory)
+    rather than copied, and every worker writes its chunks into one shared output array.
+    :param stack: ensemble_stack.VoxelStack, memory-mapped or in shared memory
+    :param probe_parameters: dictionary of {probe: list of (threshold, mode) tuples} (see summarise_block)
+    :param workers: number of worker processes
+    :return: dictionary of {probe: list of 3D numpy arrays on stack.frame, in the order of the parameters}
+    """
+    stack_spec = _array_spec(stack)
+    nx = stack.frame.nsteps[0]
+    # Chunks fit the slab memory budget, and there are several per worker to balance the load
+    chunk = min(max(1, nx // (4 * workers)), stack.slabs()[0][1])
+    chunks = slab_ranges(nx, 1, chunk)
+
+    out_indices = {}
+    tasks = []
+    n_out = 0
+    for probe, parameters in probe_parameters.items():
+        out_indices[probe] = list(range(n_out, n_out + len(parameters)))
+        n_out += len(parameters)
+        p_idx = stack.probes.index(probe)
+        tasks.extend([(p_idx, out_indices[probe], parameters, stack.scale, start, stop) for start, stop in chunks])
+
+    out_shm, out = shared_array((n_out,) + tuple(stack.frame.nsteps))
+    try:
+        out_spec = ('shared', out_shm.name, out.shape, 'float32')
+        with Pool(processes=workers, initializer=_init_worker, initargs=(stack_spec, out_spec)) as pool:
+            pool.map(_summarise_chunk, tasks, chunksize=1)
+        results = {probe: [np.array(out[o]) for o in idx] for probe, idx in out_indices.items()}
+    finally:
+        del out
+        out_shm.close()
+        out_shm.unlink()
+    return results
@@ -0,0 +1,220 @@
+import numpy as np
+from ensemble_stack import VoxelStack, summarise_block, slab_ranges
+
+
+def bootstrap_weights(n_structures, n_replicates, seed=None):
+    """
+    Draws bootstrap replicates of an ensemble, as the number of times each structure is picked in each replicate.
+    :param n_structures: number of structures in the ensemble
+    :param n_replicates: number of bootstrap replicates
+    :param seed: seed for the random number generator
+    :return: (n_replicates, n_structures) numpy array of integer weights, each row summing to n_structures
+    """
+    rng = np.random.RandomState(seed)
+    picks = rng.randint(n_structures, size=(n_replicates, n_structures))
+    weights = np.zeros((n_replicates, n_structures), dtype=np.int32)
+    np.add.at(weights, (np.arange(n_replicates)[:, np.newaxis], picks), 1)
+    return weights
+
+
+class RankedBlock(object):
+    """
+    A block of stacked maps sorted once along the structure (first) axis, keeping the rank of every structure's value
+    at each point. Resampled ensemble maps are then read off the sorted values without re-sorting:
+
+    - leaving structure s out shifts every rank above the rank of s down by one, so a leave-one-out median is a lookup
+      of a neighbouring value in the sorted order;
+    - a bootstrap replicate weights each sorted value by the number of times its structure was picked, so its median
+      is a lookup at a cumulative weight.
+    """
+
+    def __init__(self, block):
+        """
+        :param block: numpy array, shape (n_structures, ...)
+        """
+        self.block = block
+        self.n_structures = block.shape[0]
+        self.counts = np.count_nonzero(block, axis=0)
+        self._sorted = {}
+
+    def _sorted_block(self, nonzero_first):
+        """
+        :param nonzero_first: if True, the nonzero values come first, in ascending order, followed by the zeros (the
+                              order of ensemble_stack.SortedBlock). Otherwise all values are in ascending order.
+        :return: tuple of (sorted values, structure at each sorted position, sorted position of each structure)
+        """
+        if nonzero_first not in self._sorted:
+            n = self.n_structures
+            keys = np.where(self.block == 0, np.inf, self.block) if nonzero_first else self.block
+            order = np.argsort(keys, axis=0, kind='stable').astype(np.int32)
+            values = np.take_along_axis(self.block, order, axis=0)
+            ranks = np.empty_like(order)
+            positions = np.arange(n, dtype=np.int32).reshape((n,) + (1,) * (self.block.ndim - 1))
+            np.put_along_axis(ranks, order, np.broadcast_to(positions, order.shape), axis=0)
+            self._sorted[nonzero_first] = (values, order, ranks)
+        return self._sorted[nonzero_first]
+
+    @staticmethod
+    def _uses_nonzero_order(threshold, mode):
+        return mode == 'median' and threshold is not None
+
+    def _without(self, values, rank, k):
+        """
+        :param values: sorted values
+        :param rank: sorted position of the structure left out, at each point
+        :param k: rank among the remaining values
+        :return: the k-th remaining value at each point
+        """
+        k = np.minimum(k + (k >= rank), self.n_structures - 1)
+        return np.take_along_axis(values, np.broadcast_to(k, rank.shape)[np.newaxis], axis=0)[0]
+
+    def full_map(self, threshold=None, mode='median'):
+        """
+        :return: the ensemble map of the whole block (see ensemble_stack.summarise_block)
+        """
+        return summarise_block(self.block, threshold, mode)
+
+    def leave_one_out_frequency(self):
+        """
+        :return: numpy array, shape block.shape; frequency (percentage) at each point with each structure left out
+        """
+        n = self.n_structures
+        return (self.counts[np.newaxis] - (self.block != 0)) * 100.0 / (n - 1)
+
+    def leave_one_out(self, threshold=None, mode='median'):
+        """
+        Ensemble maps with each structure left out in turn (see ensemble_stack.summarise_block for the modes).
+        :param threshold: frequency threshold (percentage), or None
+        :param mode: "median", "mean" or "max"
+        :return: numpy array, shape block.shape; the map without structure s is at index s
+        """
+        n = self.n_structures
+        if n < 2:
+            raise ValueError("Leave-one-out maps need at least two structures in the ensemble")
+        if mode not in ['median', 'mean', 'max']:
+            raise ValueError("Unrecognised mode for combining grids: {}".format(mode))
+
+        if mode == 'mean':
+            total = self.block.sum(axis=0, dtype=np.float64)
+            return ((total[np.newaxis] - self.block) / (n - 1)).astype(np.float32)
+
+        out = np.zeros(self.block.shape, dtype=np.float32)
+        if self._uses_nonzero_order(threshold, mode):
+            values, _, ranks = self._sorted_block(nonzero_first=True)
+            for s in range(n):
+                # Zeros are ranked after the nonzero values, so they don't move the ranks of the nonzero values
+                remaining = self.counts - (ranks[s] < self.counts)
+                med = 0.5 * (self._without(values, ranks[s], np.maximum(remaining - 1, 0) // 2) +
+                             self._without(values, ranks[s], remaining // 2))
+                passes = (remaining * 100.0 / (n - 1) >= threshold) & (remaining > 0)
+                out[s] = np.where(passes, med, 0.0)
+        else:
+            values, _, ranks = self._sorted_block(nonzero_first=False)
+            if mode == 'median':
+                targets = [(n - 2) // 2, (n - 1) // 2]
+            else:
+                targets = [n - 2, n - 2]
+            for s in range(n):
+                out[s] = 0.5 * (self._without(values, ranks[s], targets[0]) +
+                                self._without(values, ranks[s], targets[1]))
+        return out
+
+    def bootstrap(self, weights, threshold=None, mode='median'):
+        """
+        Ensemble maps of bootstrap replicates of the block.
+        :param weights: (n_replicates, n_structures) numpy array of integer weights (see bootstrap_weights)
+        :param threshold: frequency threshold (percentage), or None
+        :param mode: "median", "mean" or "max"
+        :return: numpy array, shape (n_replicates,) + block.shape[1:]
+        """
+        n = self.n_structures
+        if mode not in ['median', 'mean', 'max']:
+            raise ValueError("Unrecognised mode for combining grids: {}".format(mode))
+        out = np.zeros((len(weights),) + self.block.shape[1:], dtype=np.float32)
+
+        if mode == 'mean':
+            for b, w in enumerate(weights):
+                out[b] = np.tensordot(w, self.block, axes=1) / n
+            return out
+
+        nonzero_first = self._uses_nonzero_order(threshold, mode)
+        values, order, _ = self._sorted_block(nonzero_first)
+        if nonzero_first:
+            positions = np.arange(n).reshape((n,) + (1,) * (self.block.ndim - 1))
+            is_nonzero = positions < self.counts[np.newaxis]
+
+        for b, w in enumerate(weights):
+            sorted_weights = w[order]
+            if nonzero_first:
+                sorted_weights = np.where(is_nonzero, sorted_weights, 0)
+            cumulative = np.cumsum(sorted_weights, axis=0)
+            total = cumulative[-1]
+            if mode == 'median':
+                targets = [np.maximum(total - 1, 0) // 2, total // 2]
+            else:
+                targets = [total - 1, total - 1]
+            picked = []
+            for k in targets:
+                pos = np.minimum(np.count_nonzero(cumulative <= k, axis=0), n - 1)
+                picked.append(np.take_along_axis(values, pos[np.newaxis], axis=0)[0])
+            replicate = 0.5 * (picked[0] + picked[1])
+            if nonzero_first:
+                replicate = np.where((total * 100.0 / n >= threshold) & (total > 0), replicate, 0.0)
+            out[b] = replicate
+        return out
+
+
+def _ranked_slabs(stack, n_maps):
+    """
+    Slabs of the stack sized for a RankedBlock (the block, its sorted copy, and the order and ranks of the sort) and
+    'n_maps' resampled maps.
+    """
+    nx, ny, nz = stack.frame.nsteps
+    return slab_ranges(nx, 4 * (5 * stack.n_structures + n_maps) * ny * nz, stack.slab_bytes)
+
+
+def leave_one_out_influence(stack, probe_parameters, stack_dir=None):
+    """
+    Computes, for every structure of a stacked ensemble, how much the ensemble maps change when that structure is left
+    out. The stack is read one slab at a time and each slab is sorted once per probe.
+    :param stack: ensemble_stack.VoxelStack
+    :param probe_parameters: dictionary of {probe: (frequency threshold or None, combine mode)}
+    :param stack_dir: directory for the memmap holding the result, if the input stack is memory-mapped
+    :return: ensemble_stack.VoxelStack with the same structures and frame as the input. The influence of structure s
+             on the maps of a probe (ensemble map minus the map without s) is at [probe index, s].
+    """
+    probes = [p for p in stack.probes if p in probe_parameters]
+    influence = VoxelStack(probes, stack.n_structures, stack.frame, stack_dir=stack_dir, slab_bytes=stack.slab_bytes,
+                           in_memory=stack.path is None)
+    for i, probe in enumerate(probes):
+        threshold, mode = probe_parameters[probe]
+        p_idx = stack.probes.index(probe)
+        for start, stop in _ranked_slabs(stack, stack.n_structures):
+            block = RankedBlock(stack.dequantize(stack.array[p_idx, :, start:stop]))
+            full = block.full_map(threshold, mode)
+            influence.array[i, :, start:stop] = full[np.newaxis] - block.leave_one_out(threshold, mode)
+    if influence.path is not None:
+        influence.array.flush()
+    return influence
+
+
+def bootstrap_statistics(stack, probe, weights, threshold=None, mode='median'):
+    """
+    Summarises the ensemble maps of bootstrap replicates of a stacked ensemble, without holding the replicates.
+    :param stack: ensemble_stack.VoxelStack
+    :param probe: probe name
+    :param weights: (n_replicates, n_structures) numpy array of integer weights (see bootstrap_weights)
+    :param threshold: frequency threshold (percentage), or None
+    :param mode: "median", "mean" or "max"
+    :return: dictionary of 3D numpy arrays on stack.frame: "mean" and "std" of the replicate maps, and "support", the
+             percentage of replicates in which each point is nonzero
+    """
+    p_idx = stack.probes.index(probe)
+    stats = {s: np.zeros(stack.frame.nsteps, dtype=np.float32) for s in ['mean', 'std', 'support']}
+    for start, stop in _ranked_slabs(stack, len(weights)):
+        block = RankedBlock(stack.dequantize(stack.array[p_idx, :, start:stop]))
+        replicates = block.bootstrap(weights, threshold, mode)
+        stats['mean'][start:stop] = replicates.mean(axis=0)
+        stats['std'][start:stop] = replicates.std(axis=0)
+        stats['support'][start:stop] = np.count_nonzero(replicates, axis=0) * 100.0 / len(weights)
+    return stats
@@ -0,0 +1,428 @@
+import shutil
+import tempfile
+from multiprocessing import shared_memory
+from os.path import join
+import numpy as np
+from hotspots.grid_extension import _GridEnsemble
+from grid_geometry import grid_frame, common_frame, frame_dimensions, place_array
+from ccp4_maps import grid_from_array
+
+# Storage types of VoxelStack. float16 keeps ~3 significant digits; uint8 stores multiples of a fixed scale.
+STACK_DTYPES = {'float32': np.float32,
+                'float16': np.float16,
+                'uint8': np.uint8}
+
+# Default scale of uint8 stacks: scores up to 254 * 0.2 = 50.8, to the nearest 0.1
+UINT8_SCALE = 0.2
+
+
+class SortedBlock(object):
+    """
+    A block of stacked maps sorted once along the structure (first) axis, so that any frequency threshold or combine
+    mode can be read off it without re-sorting. At each point the nonzero values come first, in ascending order,
+    followed by the zeros. uint8 (quantized) blocks are sorted as they are, without converting them to floats.
+    """
+
+    def __init__(self, block):
+        """
+        :param block: numpy array, shape (n_structures, ...)
+        """
+        self.n_structures = block.shape[0]
+        self.counts = np.count_nonzero(block, axis=0)
+        if block.dtype == np.uint8:
+            # Subtracting 1 wraps the zeros round to 255, above every stored value (see VoxelStack.quantize)
+            values = np.sort(block - np.uint8(1), axis=0)
+            values += np.uint8(1)
+        else:
+            values = np.where(block == 0, np.inf, block).astype(np.float32, copy=False)
+            values.sort(axis=0)
+            values[values == np.inf] = 0.0
+        self.values = values
+
+    @staticmethod
+    def from_sorted(values, counts):
+        """
+        Wraps values that are already sorted in the SortedBlock order (nonzero values ascending, then zeros).
+        :param values: numpy array, shape (n_structures, ...)
+        :param counts: number of nonzero values at each point
+        :return: SortedBlock
+        """
+        block = SortedBlock.__new__(SortedBlock)
+        block.n_structures = values.shape[0]
+        block.counts = counts
+        block.values = values
+        return block
+
+    def _at_rank(self, ranks):
+        """
+        :param ranks: integer array, shape self.counts.shape; position along the sorted structure axis
+        :return: the values at those positions
+        """
+        return np.take_along_axis(self.values, ranks[np.newaxis], axis=0)[0].astype(np.float32, copy=False)
+
+    def frequency(self):
+        """
+        :return: percentage of structures with a nonzero value at each point
+        """
+        return self.counts * 100.0 / self.n_structures
+
+    def nonzero_median(self):
+        """
+        :return: median of the nonzero values at each point (0 where there are none)
+        """
+        lo = np.maximum(self.counts - 1, 0) // 2
+        hi = np.minimum(self.counts // 2, self.n_structures - 1)
+        med = 0.5 * (self._at_rank(lo) + self._at_rank(hi))
+        return np.where(self.counts > 0, med, 0.0)
+
+    def median(self):
+        """
+        :return: median of all values at each point, zeros included
+        """
+        # In ascending order of all values, the negatives come first, then the zeros, then the positives
+        negatives = np.count_nonzero(self.values < 0, axis=0)
+        zeros = self.n_structures - self.counts
+        med = 0.0
+        for r in [(self.n_structures - 1) // 2, self.n_structures // 2]:
+            ranks = np.where(r < negatives, r, np.maximum(r - zeros, 0))
+            med = med + 0.5 * np.where((r >= negatives) & (r < negatives + zeros), 0.0, self._at_rank(ranks))
+        return med
+
+    def mean(self):
+        """
+        :return: mean of all values at each point, zeros included
+        """
+        return self.values.sum(axis=0, dtype=np.float64) / self.n_structures
+
+    def max(self):
+        """
+        :return: maximum of all values at each point, zeros included
+        """
+        top = self._at_rank(np.maximum(self.counts - 1, 0))
+        top = np.where(self.counts < self.n_structures, np.maximum(top, 0.0), top)
+        return np.where(self.counts > 0, top, 0.0)
+
+    def summary(self, threshold=None, mode='median'):
+        """
+        See summarise_block.
+        """
+        if mode == 'median':
+            if threshold is None:
+                return self.median()
+            return np.where(self.frequency() >= threshold, self.nonzero_median(), 0.0)
+        elif mode == 'mean':
+            return self.mean()
+        elif mode == 'max':
+            return self.max()
+        else:
+            raise ValueError("Unrecognised mode for combining grids: {}".format(mode))
+
+
+def summarise_block(block, threshold=None, mode='median'):
+    """
+    Combines a block of stacked maps along the structure axis, in the same way as EnsembleResult.make_ensemble_maps:
+
+    - mode 'median' with a frequency threshold: median of the nonzero values, at points where at least 'threshold'
+      percent of the structures have a nonzero value.
+    - mode 'median' without a threshold: median of all values (zeros included).
+    - modes 'mean' and 'max': computed over all values, ignoring the threshold.
+
+    :param block: numpy array, shape (n_structures, ...)
+    :param threshold: frequency threshold (percentage), or None
+    :param mode: "median", "mean" or "max"
+    :return: numpy array, shape block.shape[1:]
+    """
+    if block.dtype == np.float16:
+        block = block.astype(np.float32)
+    if mode == 'median':
+        if threshold is None:
+            return np.median(block, axis=0)
+        return SortedBlock(block).summary(threshold, mode)
+    elif mode == 'mean':
+        return np.mean(block, axis=0)
+    elif mode == 'max':
+        return np.max(block, axis=0)
+    else:
+        raise ValueError("Unrecognised mode for combining grids: {}".format(mode))
+
+
+def slab_ranges(n_planes, plane_bytes, max_bytes):
+    """
+    Splits the first spatial axis into slabs of whole planes that each fit into max_bytes.
+    :param n_planes: number of planes (grid points along x)
+    :param plane_bytes: bytes needed to hold one plane for every structure
+    :param max_bytes: memory budget for one slab
+    :return: list of (start, stop) tuples
+    """
+    step = max(1, int(max_bytes // max(plane_bytes, 1)))
+    return [(start, min(start + step, n_planes)) for start in range(0, n_planes, step)]
+
+
+def storage_to_scores(values, dtype, scale):
+    """
+    Converts values read off a stack (e.g. a summary map) from the storage units of the stack to scores.
+    :param values: numpy array
+    :param dtype: numpy dtype of the stack
+    :param scale: scale of the stack
+    :return: numpy array
+    """
+    if np.dtype(dtype) == np.uint8:
+        return values * scale
+    return values
+
+
+def shared_array(shape, dtype=np.float32):
+    """
+    Allocates a zeroed numpy array in shared memory, so that worker processes can attach to it by name.
+    :param shape: shape of the array
+    :param dtype: numpy dtype
+    :return: tuple of (multiprocessing.shared_memory.SharedMemory, numpy array on its buffer)
+    """
+    nbytes = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    array[...] = 0
+    return shm, array
+
+
+class VoxelStack(object):
+    """
+    Holds the maps of every probe and every structure of an ensemble in a single
+    (probe, structure, x, y, z) numpy memmap on local disk. Summary maps are computed one slab at a time,
+    so peak memory depends on the slab size rather than on the number of structures in the ensemble.
+
+    The maps are stored as float32 by default. Quantized storage cuts memory and disk use:
+
+    - "float16" (2x smaller): relative error of each value at most 2**-11, i.e. at most 0.016 for scores up to 64.
+    - "uint8" (4x smaller): values are stored as multiples of 'scale' (UINT8_SCALE by default), rounded to the
+      nearest step, with an error of at most scale / 2 up to 254 * scale; larger values are clipped. Nonzero values
+      are never rounded to zero, so that frequencies are exact: values in (0, scale / 2) are stored as one step, with
+      an error of up to one step (scale). Only non-negative maps can be stored.
+
+    Medians (and frequencies) are computed on the stored values, and converted to scores at the end; as the median is
+    taken of stored values, the error bound of the ensemble maps is the same as that of the stored values.
+    """
+
+    def __init__(self, probes, n_structures, frame, stack_dir=None, slab_bytes=2**26, in_memory=False, shared=False,
+                 dtype='float32', scale=None):
+        """
+        :param probes: list of probe names, in the order they are stored in the stack
+        :param n_structures: number of maps per probe
+        :param frame: grid_geometry.GridFrame shared by all the maps in the stack
+        :param stack_dir: directory in which to create the memmap (defaults to the system temporary directory)
+        :param slab_bytes: approximate memory budget (bytes) for the slabs processed at once
+        :param in_memory: if True, the stack is held in a plain numpy array instead of a memmap
+        :param shared: if True (and in_memory), the array is allocated in shared memory, so that worker processes can
+                       read it without copying (see ensemble_parallel)
+        :param dtype: storage type, "float32", "float16" or "uint8"
+        :param scale: step of the uint8 quantization (defaults to UINT8_SCALE); ignored for the float types
+        """
+        if dtype not in STACK_DTYPES:
+            raise ValueError("Unrecognised stack dtype: {}".format(dtype))
+        self.dtype = np.dtype(STACK_DTYPES[dtype])
+        if self.dtype == np.uint8:
+            self.scale = UINT8_SCALE if scale is None else float(scale)
+        else:
+            self.scale = 1.0
+        self.n_clipped = 0
+        self.probes = list(probes)
+        self.n_structures = n_structures
+        self.frame = frame
+        self.slab_bytes = slab_bytes
+        shape = (len(self.probes), n_structures) + tuple(frame.nsteps)
+        self.shared_memory = None
+        if in_memory:
+            self._dir = None
+            self.path = None
+            if shared:
+                self.shared_memory, self.array = shared_array(shape, dtype=self.dtype)
+            else:
+                self.array = np.zeros(shape, dtype=self.dtype)
+        else:
+            self._dir = tempfile.mkdtemp(prefix='voxel_stack_', dir=stack_dir)
+            self.path = join(self._dir, 'stack.{}'.format(self.dtype.name))
+            self.array = np.memmap(self.path, dtype=self.dtype, mode='w+', shape=shape)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    @staticmethod
+    def from_hotspot_results(hs_results, probes, stack_dir=None, slab_bytes=2**26, in_memory=False, shared=False,
+                             dtype='float32', scale=None):
+        """
+        Creates the stack from a list of hotspot results. Grids are converted to arrays and written to disk one at a time.
+        :param hs_results: list of hotspots results
+        :param probes: probes to stack; every result must have a map for each of them
+        :return: VoxelStack
+        """
+        frame = common_frame([grid_frame(hs.super_grids[p]) for hs in hs_results for p in probes])
+        stack = VoxelStack(probes, len(hs_results), frame, stack_dir=stack_dir, slab_bytes=slab_bytes,
+                           in_memory=in_memory, shared=shared, dtype=dtype, scale=scale)
+        for s, hs in enumerate(hs_results):
+            for p_idx, p in enumerate(stack.probes):
+                grid = hs.super_grids[p]
+                place_array(stack.quantize(_GridEnsemble.array_from_grid(grid)), grid_frame(grid), frame,
+                            stack.array[p_idx, s])
+        if stack.path is not None:
+            stack.array.flush()
+        if stack.n_clipped > 0:
+            print("{} values above {} were clipped when quantizing the stack".format(stack.n_clipped,
+                                                                                     254 * stack.scale))
+        return stack
+
+    def quantize(self, array):
+        """
+        Converts a map to the storage type of the stack. uint8 values are rounded to the nearest multiple of
+        self.scale (error at most scale / 2), except that values in (0, scale / 2) are stored as one step rather than
+        zero (error below scale).
+        :param array: numpy array of scores
+        :return: numpy array of self.dtype
+        """
+        if self.dtype != np.uint8:
+            return array.astype(self.dtype, copy=False)
+        if np.any(array < 0):
+            raise ValueError("uint8 stacks can only hold non-negative maps")
+        q = np.rint(array / self.scale)
+        # Keep small nonzero values nonzero, so that the frequencies are not changed by the quantization
+        q[(q == 0) & (array != 0)] = 1
+        # 255 is kept free for SortedBlock
+        self.n_clipped += int(np.count_nonzero(q > 254))
+        return np.minimum(q, 254).astype(np.uint8)
+
+    def dequantize(self, array):
+        """
+        :param array: numpy array read from the stack
+        :return: float32 numpy array of scores
+        """
+        return storage_to_scores(np.asarray(array).astype(np.float32, copy=False), self.dtype, self.scale)
+
+    def slabs(self):
+        """
+        :return: list of (start, stop) ranges along x that fit into the slab memory budget
+        """
+        nx, ny, nz = self.frame.nsteps
+        # The sort in nonzero_median needs a working copy of the slab in addition to the slab itself
+        plane_bytes = 2 * 4 * self.n_structures * ny * nz
+        return slab_ranges(nx, plane_bytes, self.slab_bytes)
+
+    def summary_map(self, probe, threshold=None, mode='median'):
+        """
+        Combines the maps of one probe, slab by slab (see summarise_block).
+        :param probe: probe name
+        :param threshold: frequency threshold (percentage), or None
+        :param mode: "median", "mean" or "max"
+        :return: 3D numpy array on self.frame
+        """
+        p_idx = self.probes.index(probe)
+        out = np.zeros(self.frame.nsteps, dtype=np.float32)
+        for start, stop in self.slabs():
+            summary = summarise_block(np.asarray(self.array[p_idx, :, start:stop]), threshold, mode)
+            out[start:stop] = storage_to_scores(summary, self.dtype, self.scale)
+        return out
+
+    def summary_map_sweep(self, probe, parameters):
+        """
+        Combines the maps of one probe for several (threshold, mode) pairs. Each slab is sorted only once, and every
+        requested map is read off the same sorted values.
+        :param probe: probe name
+        :param parameters: list of (threshold, mode) tuples (see summarise_block)
+        :return: list of 3D numpy arrays on self.frame, in the order of 'parameters'
+        """
+        p_idx = self.probes.index(probe)
+        outs = [np.zeros(self.frame.nsteps, dtype=np.float32) for _ in parameters]
+        for start, stop in self.slabs():
+            sorted_block = SortedBlock(np.asarray(self.array[p_idx, :, start:stop]))
+            for out, (threshold, mode) in zip(outs, parameters):
+                out[start:stop] = storage_to_scores(sorted_block.summary(threshold, mode), self.dtype, self.scale)
+        return outs
+
+    def probe_ensemble(self, probe):
+        """
+        :param probe: probe name
+        :return: _StackedProbe, a _GridEnsemble-like view of one probe of the stack
+        """
+        return _StackedProbe(self, probe)
+
+    def close(self):
+        """
+        Releases the memmap (or shared memory) and deletes it.
+        """
+        if self.path is not None and self.array is not None:
+            self.array._mmap.close()
+        self.array = None
+        if self.shared_memory is not None:
+            self.shared_memory.close()
+            self.shared_memory.unlink()
+            self.shared_memory = None
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+
+
+class _StackedProbe(object):
+    """
+    Stands in for a _GridEnsemble in EnsembleResult.grid_ensembles when the maps are held in a VoxelStack.
+    """
+
+    def __init__(self, stack, probe):
+        self.stack = stack
+        self.probe = probe
+        self.dimensions = frame_dimensions(stack.frame)
+        self.shape = stack.frame.nsteps
+        self.spacing = stack.frame.spacing
+
+    @property
+    def ensemble_array(self):
+        """
+        (x, y, z, structure) view of the memmap, the same layout as _GridEnsemble.ensemble_array. Quantized stacks
+        are converted back to float32 scores (a copy).
+        """
+        array = self.stack.array[self.stack.probes.index(self.probe)]
+        if self.stack.dtype != np.float32:
+            array = self.stack.dequantize(array)
+        return np.moveaxis(array, 0, -1)
+
+    def as_grid(self, array):
+        """
+        :param array: 3D numpy array on the stack frame
+        :return: a :class: 'ccdc.utilities.Grid' instance
+        """
+        return grid_from_array(array, self.stack.frame)
+
+    def get_median_frequency_map(self, threshold=0):
+        """
+        :param threshold: frequency threshold (percentage)
+        :return: 3D numpy array, median of the nonzero values at points that pass the threshold
+        """
+        return self.stack.summary_map(self.probe, threshold=threshold, mode='median')
+
+    def make_summary_grid(self, mode='median'):
+        """
+        :param mode: "median", "mean" or "max", computed over all values (zeros included)
+        :return: a :class: 'ccdc.utilities.Grid' instance
+        """
+        return self.as_grid(self.stack.summary_map(self.probe, threshold=None, mode=mode))
+
+    def get_contributing_maps(self, cluster_array):
+        """
+        For each cluster, counts the points at which each structure has a nonzero value.
+        :param cluster_array: 3D numpy array, labelled by cluster
+        :return: dictionary of {cluster: [(structure index, number of points), ...]}, most common first
+        """
+        p_idx = self.stack.probes.index(self.probe)
+        n_labels = int(cluster_array.max()) + 1
+        counts = np.zeros((n_labels, self.stack.n_structures), dtype=np.int64)
+        for start, stop in self.stack.slabs():
+            labels = cluster_array[start:stop].astype(np.int64)
+            for s in range(self.stack.n_structures):
+                hit = labels[(self.stack.array[p_idx, s, start:stop] != 0) & (labels > 0)]
+                counts[:, s] += np.bincount(hit, minlength=n_labels)
+
+        contribs = {}
+        for c in set(cluster_array[cluster_array > 0]):
+            row = counts[int(c)]
+            order = np.argsort(-row, kind='stable')
+            contribs[c] = [(int(s), int(row[s])) for s in order if row[s] > 0]
+        return contribs
@@ -0,0 +1,349 @@
+import json
+from pathlib import Path
+import numpy as np
+from ccdc.io import MoleculeWriter
+from ccdc.protein import Protein
+from hotspots.grid_extension import _GridEnsemble
+from grid_geometry import GridFrame, grid_frame, common_frame, pad_frame, place_array, frame_offset, is_aligned
+from ensemble_stack import SortedBlock
+
+
+class EnsembleStore(object):
+    """
+    Persistent, incrementally updatable per-point state of an ensemble, kept on disk. For each probe the store holds:
+
+    - counts: the number of structures with a nonzero value at each grid point
+    - values: for each grid point, a buffer holding the sorted nonzero values of all structures
+
+    plus a sparse record (indices and values) of every member's maps, so that a member can be removed again.
+    Adding or removing a structure only touches the points at which its maps are nonzero, and the ensemble maps can
+    be read off the sorted buffers without restacking the ensemble.
+
+    Layout of the store directory:
+        store.json                      probes, frame, capacity and member identifiers
+        {probe}_counts.i32              (n_points,) memmap
+        {probe}_values.f32              (n_points, capacity) memmap
+        members/{identifier}.npz        sparse record of each member's maps
+        protein.pdb                     protein of the first member, used for the ensemble hotspot result
+    """
+
+    def __init__(self, store_dir):
+        """
+        Opens an existing store. Use EnsembleStore.create() to make a new one.
+        :param store_dir: path to the store directory
+        """
+        self.path = Path(store_dir)
+        meta = json.loads(Path(self.path, 'store.json').read_text())
+        self.probes = meta['probes']
+        self.frame = GridFrame(origin=tuple(meta['origin']), nsteps=tuple(meta['nsteps']), spacing=meta['spacing'])
+        self.capacity = meta['capacity']
+        self.members = meta['members']
+        self.n_points = int(np.prod(self.frame.nsteps))
+        # Ensemble maps read so far, by (probe, threshold, mode), kept up to date by add() and remove()
+        self._summaries = {}
+        # Per-point sums of the values (for mode "mean") and whether a point has a negative value, by probe
+        self._sums = {}
+        self._negative = {}
+        self._open_arrays()
+
+    @staticmethod
+    def create(store_dir, frame, probes=('donor', 'acceptor', 'apolar'), capacity=32):
+        """
+        Creates an empty store.
+        :param store_dir: path to a (new or empty) directory
+        :param frame: grid_geometry.GridFrame that all members will be placed on
+        :param probes: probes held in the store
+        :param capacity: initial number of values buffered per point (grows as needed)
+        :return: EnsembleStore
+        """
+        path = Path(store_dir)
+        Path(path, 'members').mkdir(parents=True, exist_ok=True)
+        n_points = int(np.prod(frame.nsteps))
+        for p in probes:
+            np.memmap(str(Path(path, '{}_counts.i32'.format(p))), dtype=np.int32, mode='w+', shape=(n_points,)).flush()
+            np.memmap(str(Path(path, '{}_values.f32'.format(p))), dtype=np.float32, mode='w+',
+                      shape=(n_points, capacity)).flush()
+        EnsembleStore._write_meta(path, list(probes), frame, capacity, [])
+        return EnsembleStore(path)
+
+    @staticmethod
+    def from_hotspot_results(store_dir, hs_results, probes=('donor', 'acceptor', 'apolar'), padding=1):
+        """
+        Creates a store and adds a list of hotspot results to it.
+        :param store_dir: path to a (new or empty) directory
+        :param hs_results: list of hotspots results, with unique protein identifiers
+        :param probes: probes held in the store
+        :param padding: grid points added around the common frame of the results, to leave room for new members
+        :return: EnsembleStore
+        """
+        frame = pad_frame(common_frame([grid_frame(hs.super_grids[p]) for hs in hs_results for p in probes],
+                                       padding=0), padding)
+        store = EnsembleStore.create(store_dir, frame, probes=probes, capacity=max(32, len(hs_results)))
+        for hs in hs_results:
+            store.add(hs)
+        return store
+
+    @staticmethod
+    def _write_meta(path, probes, frame, capacity, members):
+        meta = {'probes': probes,
+                'origin': list(frame.origin),
+                'nsteps': list(frame.nsteps),
+                'spacing': frame.spacing,
+                'capacity': capacity,
+                'members': members}
+        Path(path, 'store.json').write_text(json.dumps(meta, indent=4))
+
+    def _open_arrays(self):
+        self.counts = {p: np.memmap(str(Path(self.path, '{}_counts.i32'.format(p))), dtype=np.int32, mode='r+',
+                                    shape=(self.n_points,)) for p in self.probes}
+        self.values = {p: np.memmap(str(Path(self.path, '{}_values.f32'.format(p))), dtype=np.float32, mode='r+',
+                                    shape=(self.n_points, self.capacity)) for p in self.probes}
+
+    def _flush(self):
+        for p in self.probes:
+            self.counts[p].flush()
+            self.values[p].flush()
+        self._write_meta(self.path, self.probes, self.frame, self.capacity, self.members)
+
+    def _grow(self, capacity):
+        """
+        Enlarges the per-point value buffers to 'capacity' values.
+        """
+        for p in self.probes:
+            old = self.values[p]
+            new_path = Path(self.path, '{}_values.f32.tmp'.format(p))
+            new = np.memmap(str(new_path), dtype=np.float32, mode='w+', shape=(self.n_points, capacity))
+            step = max(1, 2**24 // (4 * capacity))
+            for start in range(0, self.n_points, step):
+                new[start:start + step, :self.capacity] = old[start:start + step]
+            new.flush()
+            del new
+            old._mmap.close()
+            new_path.replace(Path(self.path, '{}_values.f32'.format(p)))
+        self.capacity = capacity
+        self._open_arrays()
+
+    @property
+    def n_structures(self):
+        return len(self.members)
+
+    def _member_path(self, identifier):
+        return Path(self.path, 'members', '{}.npz'.format(identifier))
+
+    def _check_member_map(self, probe, array, frame):
+        """
+        Checks that a member's map can be placed on the store's frame without losing any of its values: it must lie on
+        the same lattice (same spacing, origin a whole number of grid points away), and all of its nonzero points must
+        fall within the frame. Zero points outside the frame don't change the ensemble maps, so they may be dropped.
+        :param probe: str
+        :param array: 3D numpy array of the map
+        :param frame: GridFrame of the map
+        :return:
+        """
+        if not is_aligned(frame, self.frame):
+            raise ValueError("The {} map (origin {}, spacing {}) is not on the lattice of the ensemble store "
+                             "(origin {}, spacing {})".format(probe, frame.origin, frame.spacing, self.frame.origin,
+                                                             self.frame.spacing))
+        offset = frame_offset(frame, self.frame)
+        inside = []
+        for o, n, cn in zip(offset, frame.nsteps, self.frame.nsteps):
+            start = max(-o, 0)
+            inside.append(slice(start, max(min(cn - o, n), start)))
+        if np.count_nonzero(array[tuple(inside)]) != np.count_nonzero(array):
+            raise ValueError("The {} map has nonzero points outside the frame of the ensemble store; create the store "
+                             "with more padding".format(probe))
+
+    def add(self, hs_result, identifier=None):
+        """
+        Adds the maps of a hotspots result to the store. Only the points at which the maps are nonzero are updated.
+        The maps must lie on the store's lattice, with all their nonzero points within the store's frame (see
+        _check_member_map), so that the store's ensemble maps stay the same as those of the ensemble made from scratch.
+        :param hs_result: hotspots result
+        :param identifier: unique name of the member; defaults to hs_result.protein.identifier
+        :return:
+        """
+        if identifier is None:
+            identifier = hs_result.protein.identifier
+        if identifier in self.members:
+            raise ValueError("Structure {} is already in the ensemble store".format(identifier))
+
+        # Check all the maps before the store is changed
+        maps = {}
+        for p in self.probes:
+            grid = hs_result.super_grids[p]
+            maps[p] = (_GridEnsemble.array_from_grid(grid), grid_frame(grid))
+            self._check_member_map(p, *maps[p])
+
+        n = self.n_structures
+        if n + 1 > self.capacity:
+            self._grow(2 * self.capacity)
+
+        record = {}
+        for p in self.probes:
+            arr = np.zeros(self.frame.nsteps, dtype=np.float32)
+            place_array(maps[p][0], maps[p][1], self.frame, arr)
+            idx = np.flatnonzero(arr)
+            vals = arr.ravel()[idx]
+            record['{}_indices'.format(p)] = idx
+            record['{}_values'.format(p)] = vals
+            if len(idx) == 0:
+                continue
+
+            rows = self.values[p][idx, :n + 1]
+            c = np.asarray(self.counts[p][idx])
+            cols = np.arange(n + 1)[np.newaxis]
+            # Position of the new value in the sorted nonzero values of each point
+            pos = np.count_nonzero((rows < vals[:, np.newaxis]) & (cols < c[:, np.newaxis]), axis=1)
+            src = np.where(cols < pos[:, np.newaxis], cols, np.maximum(cols - 1, 0))
+            new_rows = np.where(cols == pos[:, np.newaxis], vals[:, np.newaxis],
+                                np.take_along_axis(rows, src, axis=1))
+            self.values[p][idx, :n + 1] = new_rows
+            self.counts[p][idx] = c + 1
+            if p in self._sums:
+                self._sums[p][idx] += vals
+            if p in self._negative:
+                self._negative[p][idx] |= vals < 0
+
+        np.savez_compressed(str(self._member_path(identifier)), **record)
+        if not Path(self.path, 'protein.pdb').exists() and hs_result.protein is not None:
+            with MoleculeWriter(str(Path(self.path, 'protein.pdb'))) as writer:
+                writer.write(hs_result.protein)
+        self.members.append(identifier)
+        self._flush()
+        self._update_summaries({p: record['{}_indices'.format(p)] for p in self.probes}, n, n + 1)
+
+    def remove(self, identifier):
+        """
+        Removes a member from the store. Only the points at which its maps are nonzero are updated.
+        :param identifier: name of the member
+        :return:
+        """
+        if identifier not in self.members:
+            raise ValueError("Structure {} is not in the ensemble store".format(identifier))
+
+        n = self.n_structures
+        record = np.load(str(self._member_path(identifier)))
+        for p in self.probes:
+            idx = record['{}_indices'.format(p)]
+            vals = record['{}_values'.format(p)]
+            if len(idx) == 0:
+                continue
+
+            rows = self.values[p][idx, :n]
+            c = np.asarray(self.counts[p][idx])
+            cols = np.arange(n)[np.newaxis]
+            pos = np.argmax((rows == vals[:, np.newaxis]) & (cols < c[:, np.newaxis]), axis=1)
+            src = np.where(cols < pos[:, np.newaxis], cols, np.minimum(cols + 1, n - 1))
+            new_rows = np.take_along_axis(rows, src, axis=1)
+            new_rows[cols >= (c - 1)[:, np.newaxis]] = 0.0
+            self.values[p][idx, :n] = new_rows
+            self.counts[p][idx] = c - 1
+            if p in self._sums:
+                self._sums[p][idx] -= vals
+            if p in self._negative:
+                self._negative[p][idx] = new_rows[:, 0] < 0
+
+        touched = {p: np.array(record['{}_indices'.format(p)]) for p in self.probes}
+        record.close()
+        self._member_path(identifier).unlink()
+        self.members.remove(identifier)
+        self._flush()
+        self._update_summaries(touched, n, n - 1)
+
+    @property
+    def protein(self):
+        """
+        :return: ccdc.protein.Protein of the first member added to the store, or None
+        """
+        if Path(self.path, 'protein.pdb').exists():
+            return Protein.from_file(str(Path(self.path, 'protein.pdb')))
+        return None
+
+    def _point_summary(self, probe, points, threshold, mode):
+        """
+        :param points: flat indices of grid points
+        :return: the ensemble map values at those points, read off their sorted values
+        """
+        n = self.n_structures
+        out = np.zeros(len(points), dtype=np.float32)
+        step = max(1, 2**24 // (4 * max(n, 1)))
+        for start in range(0, len(points), step):
+            pts = points[start:start + step]
+            block = SortedBlock.from_sorted(self.values[probe][pts, :n].T, np.asarray(self.counts[probe][pts]))
+            out[start:start + step] = block.summary(threshold, mode)
+        return out
+
+    def _update_summaries(self, touched, n_old, n_new):
+        """
+        Brings the ensemble maps read so far up to date after a member was added or removed. The values change at the
+        points the member touched; elsewhere only the number of structures changes, which matters at:
+
+        - mode "median" with a threshold: points whose count crosses the frequency threshold
+        - mode "median" without a threshold: points where the median may be nonzero, i.e. with at least half of the
+          structures nonzero, or with a negative value
+        - mode "max": points at which every structure was (or now is) nonzero
+        - mode "mean": every occupied point, recalculated from the per-point sums
+
+        :param touched: dictionary of {probe: flat indices of the points the member's maps are nonzero at}
+        :param n_old: number of structures before the update
+        :param n_new: number of structures after the update
+        :return:
+        """
+        if n_new == 0:
+            self._summaries = {}
+            return
+        for (probe, threshold, mode), out in self._summaries.items():
+            if mode == 'mean':
+                out[:] = self._sums[probe] / n_new
+                continue
+
+            counts = np.asarray(self.counts[probe])
+            if mode == 'median' and threshold is not None:
+                changed = (counts * 100.0 / n_old >= threshold) != (counts * 100.0 / n_new >= threshold)
+            elif mode == 'median':
+                changed = (counts >= (min(n_old, n_new) + 1) // 2) | self._negative[probe]
+            elif mode == 'max':
+                changed = (counts == n_old) | (counts == n_new)
+            else:
+                raise ValueError("Unrecognised mode for combining grids: {}".format(mode))
+            changed[touched[probe]] = True
+            points = np.flatnonzero(changed & (counts > 0))
+            out[touched[probe]] = 0.0
+            out[points] = self._point_summary(probe, points, threshold, mode)
+
+    def summary_map(self, probe, threshold=None, mode='median'):
+        """
+        Reads an ensemble map off the sorted per-point values (see ensemble_stack.summarise_block). The map is read in
+        full the first time it is asked for; after that, add() and remove() update it only where it can change (see
+        _update_summaries).
+        :param probe: probe name
+        :param threshold: frequency threshold (percentage), or None
+        :param mode: "median", "mean" or "max"
+        :return: 3D numpy array on self.frame
+        """
+        key = (probe, threshold, mode)
+        if key in self._summaries:
+            return self._summaries[key].reshape(self.frame.nsteps).copy()
+
+        out = np.zeros(self.n_points, dtype=np.float32)
+        n = self.n_structures
+        if n == 0:
+            return out.reshape(self.frame.nsteps)
+        sums = np.zeros(self.n_points, dtype=np.float64) if mode == 'mean' and probe not in self._sums else None
+        negative = np.zeros(self.n_points, dtype=bool) if probe not in self._negative else None
+        step = max(1, 2**24 // (4 * n))
+        for start in range(0, self.n_points, step):
+            rows = self.values[probe][start:start + step, :n]
+            block = SortedBlock.from_sorted(rows.T, np.asarray(self.counts[probe][start:start + step]))
+            out[start:start + step] = block.summary(threshold, mode)
+            if sums is not None:
+                sums[start:start + step] = rows.sum(axis=1, dtype=np.float64)
+            if negative is not None:
+                # The smallest nonzero value of each point comes first
+                negative[start:start + step] = rows[:, 0] < 0
+        if sums is not None:
+            self._sums[probe] = sums
+        if negative is not None:
+            self._negative[probe] = negative
+        self._summaries[key] = out
+        return out.reshape(self.frame.nsteps).copy()
@@ -0,0 +1,213 @@
+import shutil
+import tempfile
+import zipfile
+from pathlib import Path
+import numpy as np
+from ccp4_maps import read_ccp4_header, parse_ccp4_header, open_ccp4, create_ccp4, HEADER_BYTES
+from grid_geometry import GridFrame, common_frame, place_array
+from ensemble_stack import SortedBlock, slab_ranges
+
+
+def locate_result_file(result_path, filename):
+    """
+    Locates a file of a hotspots result without extracting anything.
+    :param result_path: path to an out.zip file, or to a directory holding the result files
+    :param filename: name of the file (e.g. "donor.ccp4")
+    :return: tuple of (path, None) for a file in a result directory, (path to the zip, name in the zip) for a zipped
+             result, or None if the result has no such file
+    """
+    result_path = Path(result_path)
+    if result_path.is_dir():
+        for candidate in [Path(result_path, filename), Path(result_path, 'hotspot', filename),
+                          Path(result_path, 'out', 'hotspot', filename)]:
+            if candidate.exists():
+                return candidate, None
+        return None
+
+    with zipfile.ZipFile(str(result_path)) as z:
+        for name in z.namelist():
+            if Path(name).name == filename:
+                return result_path, name
+    return None
+
+
+def find_result_file(result_path, filename, extract_dir):
+    """
+    Locates a file of a hotspots result, either in a result directory or in a zipped result (out.zip). Files in zipped
+    results are extracted to extract_dir, one file at a time; the caller deletes them when done.
+    :param result_path: path to an out.zip file, or to a directory holding the result files
+    :param filename: name of the file (e.g. "donor.ccp4")
+    :param extract_dir: directory to extract zipped files to
+    :return: pathlib.Path, or None if the result has no such file
+    """
+    location = locate_result_file(result_path, filename)
+    if location is None:
+        return None
+    path, name = location
+    if name is None:
+        return path
+    with zipfile.ZipFile(str(path)) as z:
+        return Path(z.extract(name, str(extract_dir)))
+
+
+def read_result_ccp4_header(location):
+    """
+    Reads the header of a CCP4 map of a result, without extracting the map from a zipped result.
+    :param location: tuple returned by locate_result_file
+    :return: see ccp4_maps.read_ccp4_header
+    """
+    path, name = location
+    if name is None:
+        return read_ccp4_header(path)
+    with zipfile.ZipFile(str(path)) as z:
+        with z.open(name) as f:
+            return parse_ccp4_header(f.read(HEADER_BYTES), '{}:{}'.format(path, name))
+
+
+class StreamedEnsemble(object):
+    """
+    Computes ensemble maps straight from the map files of the members (CCP4 format), without ever holding the whole
+    ensemble in memory. The common frame is split into slabs of x-planes; for each slab, the same planes are read from
+    every member map (the maps are memory-mapped, so only those planes are read from disk), combined, and the slab of
+    the ensemble map is written to a memory-mapped CCP4 file (see ccp4_maps.create_ccp4) before moving on to the next
+    slab. Peak memory is O(n_structures x slab); the output maps are on disk, in the extraction directory, until the
+    StreamedEnsemble is closed.
+
+    Maps in result directories are read in place. Zipped maps are compressed, so they cannot be memory-mapped: the
+    maps of one probe are extracted when that probe is combined and deleted as soon as it is done. Peak disk use is
+    therefore one full map per member (of the probe being combined), in extract_dir.
+    """
+
+    def __init__(self, result_paths, probes=('donor', 'acceptor', 'apolar'), extract_dir=None, slab_bytes=2**26):
+        """
+        :param result_paths: paths to the member results (out.zip files or result directories), in ensemble order
+        :param probes: probes to combine; probes missing from any member are skipped
+        :param extract_dir: directory to extract zipped maps to (defaults to the system temporary directory)
+        :param slab_bytes: approximate memory budget (bytes) for the slabs processed at once
+        """
+        self.result_paths = list(result_paths)
+        self.n_structures = len(self.result_paths)
+        self.slab_bytes = slab_bytes
+        self._dir = tempfile.mkdtemp(prefix='streamed_ensemble_', dir=extract_dir)
+
+        # Where each map is (see locate_result_file); zipped maps are only extracted by _open_probe
+        self.locations = {}
+        for p in probes:
+            locations = [locate_result_file(r, '{}.ccp4'.format(p)) for r in self.result_paths]
+            if all(location is not None for location in locations):
+                self.locations[p] = locations
+            else:
+                print("Probe {} is missing from some of the results; skipping it".format(p))
+        self.probes = list(self.locations.keys())
+        self.map_paths = {}
+
+        self.frames = {p: [read_result_ccp4_header(location)['frame'] for location in locations]
+                       for p, locations in self.locations.items()}
+        self.frame = common_frame([f for frames in self.frames.values() for f in frames])
+
+        protein_path = find_result_file(self.result_paths[0], 'protein.pdb', Path(self._dir, '0'))
+        self.protein_path = str(protein_path) if protein_path is not None else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def slabs(self):
+        """
+        :return: list of (start, stop) ranges along x that fit into the slab memory budget
+        """
+        nx, ny, nz = self.frame.nsteps
+        # The slab, the sorted working copy in SortedBlock, and the outputs
+        plane_bytes = 2 * 4 * self.n_structures * ny * nz
+        return slab_ranges(nx, plane_bytes, self.slab_bytes)
+
+    def _slab_frame(self, start, stop):
+        origin = np.array(self.frame.origin)
+        origin[0] += start * self.frame.spacing
+        return GridFrame(origin=tuple(float(x) for x in origin),
+                         nsteps=(stop - start,) + tuple(self.frame.nsteps[1:]),
+                         spacing=self.frame.spacing)
+
+    def _open_probe(self, probe):
+        """
+        Extracts the zipped maps of a probe (maps in result directories are used in place).
+        """
+        paths = []
+        for i, (path, name) in enumerate(self.locations[probe]):
+            if name is None:
+                paths.append(path)
+            else:
+                with zipfile.ZipFile(str(path)) as z:
+                    paths.append(Path(z.extract(name, str(Path(self._dir, probe, str(i))))))
+        self.map_paths[probe] = paths
+
+    def _close_probe(self, probe):
+        """
+        Deletes the extracted maps of a probe.
+        """
+        self.map_paths.pop(probe, None)
+        shutil.rmtree(str(Path(self._dir, probe)), ignore_errors=True)
+
+    def read_slab(self, probe, start, stop):
+        """
+        Reads x-planes start to stop (on the common frame) of every member map of a probe.
+        :return: numpy array, shape (n_structures, stop - start, ny, nz)
+        """
+        if probe not in self.map_paths:
+            self._open_probe(probe)
+        slab_frame = self._slab_frame(start, stop)
+        block = np.zeros((self.n_structures,) + tuple(slab_frame.nsteps), dtype=np.float32)
+        for s, (path, frame) in enumerate(zip(self.map_paths[probe], self.frames[probe])):
+            # Only read the member planes that overlap the slab
+            first = int(np.rint((slab_frame.origin[0] - frame.origin[0]) / frame.spacing))
+            lo = max(first, 0)
+            hi = min(first + stop - start, frame.nsteps[0])
+            if hi <= lo:
+                continue
+            origin = np.array(frame.origin)
+            origin[0] += lo * frame.spacing
+            part_frame = GridFrame(origin=tuple(float(x) for x in origin),
+                                   nsteps=(hi - lo,) + tuple(frame.nsteps[1:]),
+                                   spacing=frame.spacing)
+            _, values = open_ccp4(path)
+            place_array(np.asarray(values[lo:hi], dtype=np.float32), part_frame, slab_frame, block[s])
+            del values
+        return block
+
+    def summary_maps(self, probe, parameters):
+        """
+        Combines the member maps of one probe, slab by slab, for one or more (threshold, mode) pairs (see
+        ensemble_stack.summarise_block). Each slab is read and sorted once, and the slabs of the outputs are written
+        straight into CCP4 files on self.frame, which are deleted by close().
+        :param probe: probe name
+        :param parameters: list of (threshold, mode) tuples
+        :return: tuple of (list of paths to the CCP4 maps in the order of 'parameters', path to the frequency map)
+        """
+        out_dir = Path(self._dir, 'ensemble_maps')
+        out_dir.mkdir(exist_ok=True)
+        out_paths = [Path(out_dir, '{}_{}.ccp4'.format(probe, i)) for i in range(len(parameters))]
+        frequency_path = Path(out_dir, '{}_frequency.ccp4'.format(probe))
+        outs = [create_ccp4(path, self.frame) for path in out_paths]
+        frequency = create_ccp4(frequency_path, self.frame)
+        self._open_probe(probe)
+        try:
+            for start, stop in self.slabs():
+                sorted_block = SortedBlock(self.read_slab(probe, start, stop))
+                frequency[start:stop] = sorted_block.frequency()
+                for out, (threshold, mode) in zip(outs, parameters):
+                    out[start:stop] = sorted_block.summary(threshold, mode)
+        finally:
+            self._close_probe(probe)
+            for values in outs + [frequency]:
+                values.flush()
+            del outs, frequency
+        return out_paths, frequency_path
+
+    def close(self):
+        """
+        Deletes the extracted map files.
+        """
+        self.map_paths = {}
+        shutil.rmtree(self._dir, ignore_errors=True)
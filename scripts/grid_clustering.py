@@ -0,0 +1,135 @@
+import numpy as np
+from scipy import ndimage
+from hotspots.grid_extension import _GridEnsemble
+
+
+def _neighbourhood(connectivity):
+    """
+    :param connectivity: 6 (faces), 18 (faces and edges) or 26 (faces, edges and corners)
+    :return: 3x3x3 boolean structuring element
+    """
+    rank = {6: 1, 18: 2, 26: 3}
+    if connectivity not in rank:
+        raise ValueError("Connectivity must be 6, 18 or 26, not {}".format(connectivity))
+    return ndimage.generate_binary_structure(3, rank[connectivity])
+
+
+def filter_cluster_sizes(labels, min_cluster_size):
+    """
+    Removes the clusters smaller than min_cluster_size and renumbers the others from 1, with a single lookup-table
+    relabel.
+    :param labels: integer numpy array, labelled by cluster (0 is unlabelled)
+    :param min_cluster_size: int
+    :return: numpy array of labels, in the same format as _GridEnsemble.HDBSCAN_cluster
+    """
+    sizes = np.bincount(labels.ravel())
+    keep = sizes >= min_cluster_size
+    keep[0] = False
+    lut = np.zeros(len(sizes), dtype=np.int64)
+    lut[keep] = np.arange(1, np.count_nonzero(keep) + 1)
+    return lut[labels].astype(float)
+
+
+def hdbscan_cluster(array, min_cluster_size, **kwargs):
+    """
+    Clusters the nonzero points of a map with HDBSCAN (_GridEnsemble.HDBSCAN_cluster).
+    :param array: 3D numpy array
+    :param min_cluster_size: minimum number of points in a cluster
+    :return: numpy array of the same shape, labelled by cluster (noise is 0)
+    """
+    return _GridEnsemble.HDBSCAN_cluster(array, min_cluster_size=min_cluster_size, allow_single_cluster=True,
+                                         **kwargs)
+
+
+def connected_components_cluster(array, min_cluster_size, connectivity=26):
+    """
+    Clusters the nonzero points of a map into the connected components of the lattice: two points are in the same
+    cluster if they can be joined by a path of nonzero neighbours. Runs in a single pass over the grid.
+    :param array: 3D numpy array
+    :param min_cluster_size: components with fewer points are removed
+    :param connectivity: 6, 18 or 26 neighbours per point
+    :return: numpy array of the same shape, labelled by cluster (0 where unclustered)
+    """
+    labels, _ = ndimage.label(array != 0, structure=_neighbourhood(connectivity))
+    return filter_cluster_sizes(labels, min_cluster_size)
+
+
+def watershed_cluster(array, min_cluster_size, connectivity=26, peak_footprint=5):
+    """
+    Splits the nonzero points of a map into basins around its peaks, by flooding the lattice from the local maxima of
+    the absolute values (a watershed on the voxel graph). Unlike connected_components_cluster, touching hotspots with
+    separate peaks end up in separate clusters.
+    :param array: 3D numpy array
+    :param min_cluster_size: basins with fewer points are removed
+    :param connectivity: 6, 18 or 26 neighbours per point
+    :param peak_footprint: width (in grid points) of the cube in which a peak must be the maximum; larger values
+                           merge nearby peaks
+    :return: numpy array of the same shape, labelled by cluster (0 where unclustered)
+    """
+    mask = array != 0
+    if not np.any(mask):
+        return np.zeros(array.shape)
+    height = np.abs(array)
+
+    peaks = mask & (height == ndimage.maximum_filter(height, size=peak_footprint))
+    markers, n_peaks = ndimage.label(peaks, structure=_neighbourhood(26))
+    # The background is seeded as one more basin, so that flooding can't cross it
+    markers[~mask] = n_peaks + 1
+
+    # watershed_ift floods from low to high costs: invert the heights and scale them to uint16
+    cost = np.zeros(array.shape, dtype=np.uint16)
+    top = height.max()
+    cost[mask] = np.rint((1.0 - height[mask] / top) * 65534).astype(np.uint16)
+    basins = ndimage.watershed_ift(cost, markers.astype(np.int32), structure=_neighbourhood(connectivity))
+    basins[~mask] = 0
+    return filter_cluster_sizes(basins, min_cluster_size)
+
+
+CLUSTERING_ENGINES = {'hdbscan': hdbscan_cluster,
+                      'connected_components': connected_components_cluster,
+                      'watershed': watershed_cluster}
+
+
+def cluster_map(array, min_cluster_size, engine='hdbscan', **kwargs):
+    """
+    Clusters the nonzero points of a map with one of the CLUSTERING_ENGINES, or with a user-supplied function.
+    :param array: 3D numpy array
+    :param min_cluster_size: minimum number of points in a cluster
+    :param engine: name of an engine in CLUSTERING_ENGINES, or a function with the signature
+                   engine(array, min_cluster_size, **kwargs) returning an array of cluster labels (0 is unclustered)
+    :param kwargs: passed on to the engine
+    :return: numpy array of the same shape, labelled by cluster
+    """
+    if callable(engine):
+        return engine(array, min_cluster_size, **kwargs)
+    if engine not in CLUSTERING_ENGINES:
+        raise ValueError("Unrecognised clustering engine: {}".format(engine))
+    return CLUSTERING_ENGINES[engine](array, min_cluster_size, **kwargs)
+
+
+def adjusted_rand_index(labels_a, labels_b):
+    """
+    Agreement between two labellings of the same points (1 for identical clusterings, ~0 for random ones). Noise
+    (label 0) counts as a cluster of its own.
+    :param labels_a: numpy array of labels
+    :param labels_b: numpy array of labels, same shape
+    :return: float
+    """
+    _, a = np.unique(labels_a.ravel(), return_inverse=True)
+    _, b = np.unique(labels_b.ravel(), return_inverse=True)
+    n = len(a)
+    if n < 2:
+        return 1.0
+    contingency = np.bincount(a * (b.max() + 1) + b).astype(np.float64)
+
+    def pairs(x):
+        return (x * (x - 1) / 2).sum()
+
+    index = pairs(contingency)
+    pairs_a = pairs(np.bincount(a).astype(np.float64))
+    pairs_b = pairs(np.bincount(b).astype(np.float64))
+    expected = pairs_a * pairs_b / pairs(np.array([n], dtype=np.float64))
+    maximum = (pairs_a + pairs_b) / 2
+    if maximum == expected:
+        return 1.0
+    return (index - expected) / (maximum - expected)
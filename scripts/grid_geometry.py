@@ -0,0 +1,220 @@
+import collections
+import functools
+import numpy as np
+
+GridFrame = collections.namedtuple('GridFrame', ['origin', 'nsteps', 'spacing'])
+
+# How to bring an array on one frame onto another frame: out[dst] = array[src], with tuples of slices
+ResamplingPlan = collections.namedtuple('ResamplingPlan', ['frame', 'common', 'src', 'dst'])
+
+
+def grid_frame(grid):
+    """
+    Describes the lattice of a grid (origin, number of steps and spacing) without reading any of its values.
+    :param grid: a ccdc.utilities.Grid
+    :return: GridFrame
+    """
+    return GridFrame(origin=tuple(float(x) for x in grid.bounding_box[0]),
+                     nsteps=tuple(int(n) for n in grid.nsteps),
+                     spacing=float(grid.spacing))
+
+
+def far_corner(frame):
+    """
+    :param frame: GridFrame
+    :return: numpy array((x, y, z)) of the last grid point
+    """
+    return np.array(frame.origin) + (np.array(frame.nsteps) - 1) * frame.spacing
+
+
+def frame_dimensions(frame):
+    """
+    Returns the frame in the format used by _GridEnsemble(dimensions=...)
+    :param frame: GridFrame
+    :return: numpy array((origin, far_corner))
+    """
+    return np.array([frame.origin, far_corner(frame)])
+
+
+def dimensions_frame(dimensions, nsteps):
+    """
+    The inverse of frame_dimensions: the frame of a _GridEnsemble(dimensions=...) holding arrays of shape nsteps
+    :param dimensions: numpy array((origin, far_corner))
+    :param nsteps: (nx, ny, nz)
+    :return: GridFrame
+    """
+    dimensions = np.asarray(dimensions, dtype=float)
+    nsteps = np.array(nsteps, dtype=int)
+    spans = (dimensions[1] - dimensions[0])[nsteps > 1] / (nsteps[nsteps > 1] - 1)
+    spacing = float(np.mean(spans)) if len(spans) else 0.5
+    return GridFrame(origin=tuple(float(x) for x in dimensions[0]),
+                     nsteps=tuple(int(n) for n in nsteps),
+                     spacing=spacing)
+
+
+def common_frame(frames, padding=1):
+    """
+    Finds a frame that can hold all the input frames. Mirrors Grid.common_grid(): if all the frames are identical,
+    that frame is returned as is; otherwise the union of the frames is padded by 'padding' grid points on each side.
+    :param frames: list of GridFrame
+    :param padding: int
+    :return: GridFrame
+    """
+    frames = list(frames)
+    if len(set(frames)) == 1:
+        return frames[0]
+
+    spacings = set(f.spacing for f in frames)
+    if len(spacings) > 1:
+        raise ValueError("Cannot combine grids with different spacings: {}".format(sorted(spacings)))
+    spacing = frames[0].spacing
+
+    origin = np.min([f.origin for f in frames], axis=0) - padding * spacing
+    far = np.max([far_corner(f) for f in frames], axis=0) + padding * spacing
+    nsteps = np.rint((far - origin) / spacing).astype(int) + 1
+
+    return GridFrame(origin=tuple(float(x) for x in origin),
+                     nsteps=tuple(int(n) for n in nsteps),
+                     spacing=spacing)
+
+
+def pad_frame(frame, padding):
+    """
+    Adds 'padding' grid points on each side of a frame.
+    :param frame: GridFrame
+    :param padding: int
+    :return: GridFrame
+    """
+    return GridFrame(origin=tuple(float(x) for x in np.array(frame.origin) - padding * frame.spacing),
+                     nsteps=tuple(int(n) + 2 * padding for n in frame.nsteps),
+                     spacing=frame.spacing)
+
+
+def frame_offset(frame, common):
+    """
+    Index of the origin of 'frame' within 'common'. Grids are snapped to the nearest point of the common lattice.
+    :param frame: GridFrame
+    :param common: GridFrame
+    :return: numpy array((i, j, k))
+    """
+    return np.rint((np.array(frame.origin) - np.array(common.origin)) / common.spacing).astype(int)
+
+
+def place_array(array, frame, common, out):
+    """
+    Copies an array on 'frame' into the array 'out' on the 'common' frame. Points outside 'common' are dropped.
+    :param array: 3D numpy array with shape frame.nsteps
+    :param frame: GridFrame
+    :param common: GridFrame
+    :param out: 3D numpy array (or memmap view) with shape common.nsteps
+    :return: out
+    """
+    offset = frame_offset(frame, common)
+    src = []
+    dst = []
+    for o, n, cn in zip(offset, frame.nsteps, common.nsteps):
+        start = max(o, 0)
+        stop = min(o + n, cn)
+        if stop <= start:
+            return out
+        dst.append(slice(start, stop))
+        src.append(slice(start - o, stop - o))
+    out[tuple(dst)] = array[tuple(src)]
+    return out
+
+
+def is_aligned(frame, common, tolerance=1e-3):
+    """
+    :param frame: GridFrame
+    :param common: GridFrame
+    :param tolerance: allowed deviation from a whole number of grid points
+    :return: True if the two frames have the same spacing and their origins differ by whole grid points
+    """
+    if frame.spacing != common.spacing:
+        return False
+    steps = (np.array(frame.origin) - np.array(common.origin)) / common.spacing
+    return bool(np.all(np.abs(steps - np.rint(steps)) < tolerance))
+
+
+def resampling_plan(frame, common):
+    """
+    Works out which block of an array on 'frame' goes to which block of an array on 'common' (as place_array does),
+    so that the plan can be applied to any number of arrays on the same frame.
+    :param frame: GridFrame
+    :param common: GridFrame
+    :return: ResamplingPlan, or None if the frames do not overlap
+    """
+    offset = frame_offset(frame, common)
+    src = []
+    dst = []
+    for o, n, cn in zip(offset, frame.nsteps, common.nsteps):
+        start = max(o, 0)
+        stop = min(o + n, cn)
+        if stop <= start:
+            return None
+        dst.append(slice(int(start), int(stop)))
+        src.append(slice(int(start - o), int(stop - o)))
+    return ResamplingPlan(frame=frame, common=common, src=tuple(src), dst=tuple(dst))
+
+
+@functools.lru_cache(maxsize=256)
+def pair_resampling_plans(frame_a, frame_b, padding=1):
+    """
+    Common frame of two frames (see common_frame) and the plans that bring each of them onto it. Cached, as all the
+    probes of a pair of results usually share the same two frames.
+    :param frame_a: GridFrame
+    :param frame_b: GridFrame
+    :param padding: int
+    :return: tuple of (common GridFrame, ResamplingPlan of frame_a, ResamplingPlan of frame_b), or None if the frames
+             are not on the same lattice (different spacings, or origins that differ by a fraction of a grid point)
+    """
+    if not is_aligned(frame_a, frame_b):
+        return None
+    common = common_frame([frame_a, frame_b], padding)
+    return common, resampling_plan(frame_a, common), resampling_plan(frame_b, common)
+
+
+def apply_resampling_plan(array, plan):
+    """
+    Brings an array onto the common frame of a plan. No data is copied when the common frame lies within the array's
+    frame (the result is a view of the array); otherwise the array is copied once into a zero-padded array.
+    :param array: 3D numpy array with shape plan.frame.nsteps
+    :param plan: ResamplingPlan
+    :return: 3D numpy array with shape plan.common.nsteps
+    """
+    common_shape = tuple(plan.common.nsteps)
+    if all(d.start == 0 and d.stop == n for d, n in zip(plan.dst, common_shape)):
+        return array[plan.src]
+    out = np.zeros(common_shape, dtype=array.dtype)
+    out[plan.dst] = array[plan.src]
+    return out
+
+
+def box_slices(frame, lower, upper):
+    """
+    Slices of the points of a frame that crop it to a box: from the grid point nearest the lower corner of the box to
+    the grid point nearest the upper corner, both included, clipped to the frame. Points up to half a grid step outside
+    the box can therefore be kept. EnsembleResult.shrink_to_binding_site and the .hsc reader both crop by this rule.
+    :param frame: GridFrame
+    :param lower: numpy array((x, y, z)), lower corner of the box
+    :param upper: numpy array((x, y, z)), upper corner of the box
+    :return: tuple of slices, or None if the box does not overlap the frame
+    """
+    origin = np.array(frame.origin)
+    start = np.maximum(np.floor((np.array(lower) - origin) / frame.spacing + 0.5).astype(int), 0)
+    stop = np.minimum(np.floor((np.array(upper) - origin) / frame.spacing + 0.5).astype(int) + 1, frame.nsteps)
+    if np.any(stop <= start):
+        return None
+    return tuple(slice(int(a), int(b)) for a, b in zip(start, stop))
+
+
+def slice_frame(frame, slices):
+    """
+    :param frame: GridFrame
+    :param slices: tuple of slices of the frame's points (e.g. from box_slices)
+    :return: GridFrame of the sliced points
+    """
+    start = np.array([s.start for s in slices])
+    return GridFrame(origin=tuple(float(x) for x in np.array(frame.origin) + start * frame.spacing),
+                     nsteps=tuple(int(s.stop - s.start) for s in slices),
+                     spacing=frame.spacing)
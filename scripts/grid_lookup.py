@@ -0,0 +1,157 @@
+import numpy as np
+from scipy import ndimage
+from hotspots.grid_extension import _GridEnsemble
+from grid_geometry import grid_frame, pad_frame
+
+# Atom features, and the probe maps they are scored against
+FEATURES = ('donor', 'acceptor', 'apolar')
+
+
+def molecule_features(molecules):
+    """
+    Lists the heavy atoms of a set of molecules with their features, for batch lookups. Atoms that are both donors and
+    acceptors are listed once for each feature; atoms that are neither are apolar.
+    :param molecules: list of ccdc molecules
+    :return: tuple of (numpy array (N, 3) of coordinates, numpy array (N,) of feature labels, numpy array (N,) of the
+             index of the molecule each row comes from)
+    """
+    coords = []
+    labels = []
+    mol_index = []
+    for m, mol in enumerate(molecules):
+        for a in mol.heavy_atoms:
+            features = [f for f, is_f in [('donor', a.is_donor), ('acceptor', a.is_acceptor)] if is_f] or ['apolar']
+            for f in features:
+                coords.append(a.coordinates)
+                labels.append(f)
+                mol_index.append(m)
+    return np.array(coords, dtype=float).reshape(-1, 3), np.array(labels, dtype=str), np.array(mol_index, dtype=int)
+
+
+def per_molecule(values, mol_index, n_molecules, mode='sum'):
+    """
+    Aggregates per-atom values by molecule.
+    :param values: numpy array (N,)
+    :param mol_index: numpy array (N,) of molecule indices (see molecule_features)
+    :param n_molecules: int
+    :param mode: "sum" or "max"
+    :return: numpy array (n_molecules,)
+    """
+    if mode == 'sum':
+        return np.bincount(mol_index, weights=values, minlength=n_molecules)
+    elif mode == 'max':
+        out = np.zeros(n_molecules)
+        np.maximum.at(out, mol_index, values)
+        return out
+    else:
+        raise ValueError("Unrecognised mode: {}".format(mode))
+
+
+class GridLookup(object):
+    """
+    Looks up the values of a set of probe grids (e.g. the maps of a hotspots, ensemble or selectivity result) at many
+    coordinates at once. The grids are read into numpy arrays once; each lookup is then a single vectorised gather per
+    probe, rather than one Grid.value_at_coordinate call per atom.
+    """
+
+    def __init__(self, grids):
+        """
+        :param grids: dictionary of {probe: ccdc.utilities.Grid}
+        """
+        self.arrays = {p: _GridEnsemble.array_from_grid(g) for p, g in grids.items()}
+        self.frames = {p: grid_frame(g) for p, g in grids.items()}
+        # Maximum-filtered arrays, by (probe, tolerance)
+        self._max_filtered = {}
+
+    @staticmethod
+    def from_result(result):
+        """
+        :param result: hotspots result, or an EnsembleResult or SelectivityResult whose maps have been made
+        :return: GridLookup of the result's maps
+        """
+        for name in ['ensemble_hotspot_result', 'selectivity_result']:
+            if getattr(result, name, None) is not None:
+                result = getattr(result, name)
+        return GridLookup(result.super_grids)
+
+    @property
+    def probes(self):
+        return list(self.arrays.keys())
+
+    def _array(self, probe, tolerance):
+        """
+        With a tolerance, each point holds the value that hotspots' Grid.value_at_coordinate(tolerance=...) returns for
+        a coordinate nearest to it: the maximum of the cube of (2 * tolerance + 1) points around it, leaving out points
+        outside the grid and, as value_at_coordinate does, the points with index 0 along any axis; maxima below 0.1
+        (and cubes with no points left) give 0. The array is padded by tolerance points on each side, so that
+        coordinates just outside the grid still see the points within tolerance of them. The filtered array is
+        computed once per probe and tolerance.
+        :return: tuple of (3D numpy array, grid_geometry.GridFrame)
+        """
+        if tolerance == 0:
+            return self.arrays[probe], self.frames[probe]
+        if (probe, tolerance) not in self._max_filtered:
+            array = np.pad(np.asarray(self.arrays[probe], dtype=float), tolerance, mode='constant',
+                           constant_values=-np.inf)
+            for axis in range(3):
+                edge = [slice(None)] * 3
+                edge[axis] = tolerance
+                array[tuple(edge)] = -np.inf
+            filtered = ndimage.maximum_filter(array, size=2 * tolerance + 1, mode='constant', cval=-np.inf)
+            filtered[filtered < 0.1] = 0
+            self._max_filtered[(probe, tolerance)] = filtered, pad_frame(self.frames[probe], tolerance)
+        return self._max_filtered[(probe, tolerance)]
+
+    def probe_values(self, probe, coords, method='nearest', tolerance=0):
+        """
+        :param probe: probe name
+        :param coords: numpy array (N, 3) of coordinates
+        :param method: "nearest" (value at the nearest grid point) or "trilinear" (interpolated between the 8
+                       surrounding grid points)
+        :param tolerance: int, if > 0 the value is the maximum within this many grid points of each coordinate, by the
+                          rules of Grid.value_at_coordinate (see _array)
+        :return: numpy array (N,); coordinates outside the grid (or more than tolerance points outside it) get 0
+        """
+        array, frame = self._array(probe, tolerance)
+        nsteps = np.array(frame.nsteps)
+        fractional = (np.asarray(coords, dtype=float) - np.array(frame.origin)) / frame.spacing
+
+        if method == 'nearest':
+            idx = np.rint(fractional).astype(int)
+            inside = np.all((idx >= 0) & (idx < nsteps), axis=1)
+            values = np.zeros(len(idx))
+            values[inside] = array[tuple(idx[inside].T)]
+            return values
+
+        elif method == 'trilinear':
+            lower = np.floor(fractional).astype(int)
+            weights = fractional - lower
+            values = np.zeros(len(lower))
+            for corner in np.ndindex(2, 2, 2):
+                idx = lower + np.array(corner)
+                inside = np.all((idx >= 0) & (idx < nsteps), axis=1)
+                w = np.prod(np.where(np.array(corner), weights, 1 - weights), axis=1)
+                values[inside] += w[inside] * array[tuple(idx[inside].T)]
+            return values
+
+        else:
+            raise ValueError("Unrecognised lookup method: {}".format(method))
+
+    def values(self, coords, labels, method='nearest', tolerance=0):
+        """
+        Looks up each coordinate in the map of its label's probe.
+        :param coords: numpy array (N, 3) of coordinates
+        :param labels: numpy array (N,) of probe names (e.g. from molecule_features); rows whose label has no map get 0
+        :param method: "nearest" or "trilinear" (see probe_values)
+        :param tolerance: int (see probe_values)
+        :return: numpy array (N,)
+        """
+        coords = np.asarray(coords, dtype=float)
+        labels = np.asarray(labels)
+        values = np.zeros(len(coords))
+        for probe in np.unique(labels):
+            if probe not in self.arrays:
+                continue
+            rows = labels == probe
+            values[rows] = self.probe_values(probe, coords[rows], method=method, tolerance=tolerance)
+        return values
@@ -3,7 +3,27 @@ from hotspots.result import Results
 from hotspots.hs_utilities import Helper
 from hotspots.grid_extension import Grid, _GridEnsemble
 from ccdc.protein import Protein
+from ccdc.io import MoleculeWriter
+from ensemble_stack import VoxelStack
+from ensemble_store import EnsembleStore
+from sparse_grids import SparseGrid, SparseStack
+from ensemble_cache import EnsembleCache
+from selectivity_cache import SelectivityCache, grids_digest
+from ensemble_resampling import leave_one_out_influence, bootstrap_weights, bootstrap_statistics
+from ensemble_streaming import StreamedEnsemble
+from ensemble_parallel import parallel_summary_maps
+from ensemble_index import EnsembleIndex
+from grid_geometry import GridFrame, grid_frame, common_frame, frame_dimensions, dimensions_frame, place_array, \
+    is_aligned, box_slices, slice_frame, pair_resampling_plans, apply_resampling_plan
+from ccp4_maps import grid_from_array, grid_from_ccp4
+from labeled_stats import cluster_statistics, point_cluster_statistics, clusters_centre_of_mass
+from grid_clustering import cluster_map
 import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+import copy
+import os
+from os.path import join
 
 class EnsembleResult(Helper):
     """
@@ -14,7 +34,9 @@ class EnsembleResult(Helper):
         """
         Class that allows for the adjustment of the various Ensemble map parameters. 
         """
-        def __init__(self, polar_freq_threshold=20.0, apolar_freq_threshold=0.0, combine_mode="median"):
+        def __init__(self, polar_freq_threshold=20.0, apolar_freq_threshold=0.0, combine_mode="median",
+                     stack_backend="memory", stack_dir=None, cache_dir=None, cache_max_bytes=20 * 2**30, workers=1,
+                     stack_dtype="float32", stack_scale=None):
             """
             Frequency: ((number of times score observed at point)/ (number of maps in ensemble))*100
             For the polar maps, using a frequency threshold is used to remove artefacts of the alignment and "noisy"
@@ -41,17 +63,79 @@ class EnsembleResult(Helper):
             
             :param combine_mode: "median", "mean", or maximum
             :type str
+
+            :param stack_backend: "memory" stacks all probes into a single (probe, structure, x, y, z) array held in
+                                  RAM. "memmap" writes the same array into a memory-mapped file and computes the
+                                  ensemble maps slab by slab, so that memory use does not grow with the ensemble size.
+                                  Both combine the maps with the same code, serially or on a process pool (see workers).
+                                  "grid_ensemble" stacks each probe in a _GridEnsemble held in RAM and combines the
+                                  maps with _GridEnsemble (serial only; workers is not used).
+                                  "sparse" stores only the nonzero points of each map, so that memory and time scale
+                                  with the number of occupied points rather than the box volume.
+                                  "stream" reads the member maps from the result files (see result_paths in
+                                  EnsembleResult) a slab of x-planes at a time, and writes each slab of the
+                                  ensemble maps to a CCP4 file on disk before reading the next, so that the combining
+                                  step needs O(N x slab) memory rather than O(N x volume). The finished maps are then
+                                  read into ccdc Grids, which hold the full volume of each ensemble and frequency map
+                                  in RAM. The stacked maps are not kept.
+            :type str
+
+            :param stack_dir: directory for the "memmap" stack files and the maps extracted by the "stream" backend.
+                              Should be on local disk. Defaults to the system temporary directory.
+            :type str
+
+            :param cache_dir: if set (and the paths of the member results are given to EnsembleResult), stacked
+                              ensembles are cached on disk here, keyed by the contents of the member result files and
+                              their grid geometry, and reused by later runs. Used by the "memory", "memmap" and
+                              "grid_ensemble" backends.
+            :type str
+
+            :param cache_max_bytes: size limit of the cache; least recently used ensembles are evicted first
+            :type int
+
+            :param workers: number of processes used to combine the maps. With more than one worker, the "memory" and
+                            "memmap" backends stack all probes once (in shared memory, or in the memmap file) and
+                            split the probes and chunks of x-planes across a process pool. Every point is combined by
+                            the same code as with workers=1, so the maps do not depend on the number of workers. The
+                            other backends are serial.
+            :type int
+
+            :param stack_dtype: storage type of the stacked maps (and of cached ensembles): "float32", or quantized to
+                                "float16" (2x smaller; relative error at most 2**-11, i.e. at most 0.016 for scores up
+                                to 64) or "uint8" (4x smaller; error at most stack_scale / 2 for scores from
+                                stack_scale / 2 up to 254 * stack_scale, larger scores are clipped; nonzero scores below
+                                stack_scale / 2 are stored as one step, with an error below stack_scale, so that
+                                frequencies are exact). Medians and frequencies are computed on the quantized values,
+                                so the ensemble maps have the same error bound. Only the "memory" and "memmap"
+                                backends support quantization.
+            :type str
+
+            :param stack_scale: step of the uint8 quantization; defaults to ensemble_stack.UINT8_SCALE (0.2), which
+                                covers scores up to 50.8 to within 0.1
+            :type float
             """
             self.polar_frequency_threshold = polar_freq_threshold
             self.apolar_frequency_threshold =  apolar_freq_threshold
             self.combine_mode = combine_mode
-
-    def __init__(self,  hs_results_list, ensemble_id = 'protein', reference_structure=None, settings=None):
+            self.stack_backend = stack_backend
+            self.stack_dir = stack_dir
+            self.cache_dir = cache_dir
+            self.cache_max_bytes = cache_max_bytes
+            self.workers = workers
+            self.stack_dtype = stack_dtype
+            self.stack_scale = stack_scale
+
+    def __init__(self,  hs_results_list, ensemble_id = 'protein', reference_structure=None, settings=None, result_paths=None):
         """
         :param ensemble_id: An identifier for the ensemble (e.g. name of the protein)
         
         :param hs_results_list: list of  hotspots results. The protein models used to calculate the maps should be aligned 
-                                prior to the hotspots calculation
+                                prior to the hotspots calculation. May be empty for the "stream" backend, which
+                                reads the maps from result_paths.
+        :type list
+
+        :param result_paths: optional list of the paths the hotspot results were read from (e.g. out.zip files), in the
+                             same order. Needed to key the ensemble cache (see Settings.cache_dir).
         :type list
         """
         # Use default settings if no settings have been provided.
@@ -62,45 +146,549 @@ class EnsembleResult(Helper):
 
         self.ensemble_id = ensemble_id
         self.hotspot_results = hs_results_list
+        self.result_paths = result_paths
         self.grid_ensembles = {}
         self.ensemble_maps = {}
         self.reference_pdb = reference_structure
         self.ensemble_hotspot_result = None
+        self.voxel_stack = None
+        self.ensemble_store = None
+        self.ensemble_index = None
+        self.influence_stack = None
+        self.frequency_maps = {}
+        self.ensemble_protein = None
 
 
         # Holds information about which maps belong to which protein. Important for downstream analysis.
         self.index_dict = {i: hs.protein.identifier for i, hs, in enumerate(self.hotspot_results)}
 
+    @staticmethod
+    def from_ensemble_store(store_dir, ensemble_id='protein', settings=None):
+        """
+        Opens an EnsembleResult on a store created by make_ensemble_store(), without re-reading the member results.
+        :param store_dir: path to the store directory
+        :return: EnsembleResult
+        """
+        ens = EnsembleResult(hs_results_list=[], ensemble_id=ensemble_id, settings=settings)
+        ens.ensemble_store = EnsembleStore(store_dir)
+        ens.index_dict = {i: m for i, m in enumerate(ens.ensemble_store.members)}
+        return ens
+
+    @staticmethod
+    def from_ensemble_index(index_dir, ensemble_id='protein', settings=None):
+        """
+        Opens an EnsembleResult on an index written by make_ensemble_index(), without re-reading the member results.
+        Ensemble maps for any settings can then be read off the index with query_ensemble_maps().
+        :param index_dir: path to the index directory
+        :return: EnsembleResult
+        """
+        ens = EnsembleResult(hs_results_list=[], ensemble_id=ensemble_id, settings=settings)
+        ens.ensemble_index = EnsembleIndex.load(index_dir)
+        ens.index_dict = {i: m for i, m in enumerate(ens.ensemble_index.identifiers)}
+        ens.grid_ensembles = dict(ens.ensemble_index.stacks)
+        protein_path = join(str(index_dir), 'protein.pdb')
+        if os.path.exists(protein_path):
+            ens.ensemble_protein = Protein.from_file(protein_path)
+        return ens
+
+    def make_ensemble_index(self, index_dir=None, save_grid_ensembles=False):
+        """
+        Builds a compact per-point index of the ensemble (the nonzero count and the sorted nonzero values at each
+        occupied point, see ensemble_index.EnsembleIndex), from which the ensemble maps for any frequency threshold
+        and combine mode can be read on demand with query_ensemble_maps(). Once an index is attached,
+        make_ensemble_maps() reads the ensemble maps from it.
+        :param index_dir: if given, the index (and the protein of the first structure) is written to this directory
+        :param save_grid_ensembles: if True, keeps the stacked maps the index was built from in self.grid_ensembles
+        :return: ensemble_index.EnsembleIndex
+        """
+        identifiers = [self.index_dict[i] for i in sorted(self.index_dict.keys())]
+        sparse_stacks = {p: ge for p, ge in self.grid_ensembles.items() if isinstance(ge, SparseStack)}
+        if self.settings.stack_backend == 'sparse' and len(sparse_stacks) > 0:
+            self.ensemble_index = EnsembleIndex.from_sparse_stacks(sparse_stacks, identifiers)
+        else:
+            stack = self._get_voxel_stack()
+            self.ensemble_index = EnsembleIndex.from_voxel_stack(stack, identifiers)
+            if save_grid_ensembles:
+                for probe in stack.probes:
+                    if probe not in self.grid_ensembles.keys():
+                        self.grid_ensembles[probe] = stack.probe_ensemble(probe)
+
+        if index_dir is not None:
+            self.ensemble_index.save(index_dir)
+            if len(self.hotspot_results) > 0 and self.hotspot_results[0].protein is not None:
+                with MoleculeWriter(join(str(index_dir), 'protein.pdb')) as writer:
+                    writer.write(self.hotspot_results[0].protein)
+        return self.ensemble_index
+
+    def query_ensemble_maps(self, polar_frequency_threshold, apolar_frequency_threshold, combine_mode='median'):
+        """
+        Reads the ensemble maps for the given settings off the ensemble index (see make_ensemble_index), without
+        changing self.settings or self.ensemble_maps. The thresholds and combine mode have the same meaning as in
+        EnsembleResult.Settings.
+        :param polar_frequency_threshold: frequency threshold (percentage) of the polar maps, or None
+        :param apolar_frequency_threshold: frequency threshold (percentage) of the apolar maps, or None
+        :param combine_mode: "median", "mean" or "max"
+        :return: hotspots.result.Results
+        """
+        if self.ensemble_index is None:
+            self.make_ensemble_index()
+        settings = copy.copy(self.settings)
+        settings.polar_frequency_threshold = polar_frequency_threshold
+        settings.apolar_frequency_threshold = apolar_frequency_threshold
+        settings.combine_mode = combine_mode
+        return self._as_hotspot_result(self._ensemble_maps_from_index(settings))
+
+    def _ensemble_maps_from_index(self, settings=None):
+        """
+        :param settings: EnsembleResult.Settings; defaults to self.settings
+        :return: dictionary of {probe: ccdc.utilities.Grid}
+        """
+        index = self.ensemble_index
+        ensemble_maps = {}
+        for probe in index.probes:
+            params = self._summary_parameters(probe, settings)
+            if params is None:
+                continue
+            threshold, mode = params
+            ensemble_maps[probe] = grid_from_array(index.query(probe, threshold=threshold, mode=mode), index.frame)
+        return ensemble_maps
+
+    def make_ensemble_store(self, store_dir, padding=1):
+        """
+        Writes the per-point state of the ensemble (nonzero counts and sorted nonzero values) to disk, so that
+        structures can later be added or removed with append_result() and remove_result() without rebuilding the
+        ensemble. Once a store is attached, make_ensemble_maps() reads the ensemble maps from it.
+        :param store_dir: path to a new directory
+        :param padding: grid points added around the common frame of the maps, to leave room for new members
+        :return: ensemble_store.EnsembleStore
+        """
+        self.ensemble_store = EnsembleStore.from_hotspot_results(store_dir, self.hotspot_results, padding=padding)
+        return self.ensemble_store
+
+    def append_result(self, hs_result, update_maps=True):
+        """
+        Adds a structure to the ensemble store. The update only touches the points at which its maps are nonzero, and
+        the store's ensemble maps are only recalculated where they can change (see EnsembleStore._update_summaries).
+        :param hs_result: hotspots result; hs_result.protein.identifier must be unique within the ensemble
+        :param update_maps: if True, updates the ensemble maps
+        :return:
+        """
+        self.ensemble_store.add(hs_result)
+        self.hotspot_results.append(hs_result)
+        self.index_dict = {i: m for i, m in enumerate(self.ensemble_store.members)}
+        if update_maps:
+            self.make_ensemble_maps()
+
+    def remove_result(self, identifier, update_maps=True):
+        """
+        Removes a structure from the ensemble store.
+        :param identifier: protein identifier of the structure
+        :param update_maps: if True, updates the ensemble maps
+        :return:
+        """
+        self.ensemble_store.remove(identifier)
+        self.hotspot_results = [hs for hs in self.hotspot_results if hs.protein.identifier != identifier]
+        self.index_dict = {i: m for i, m in enumerate(self.ensemble_store.members)}
+        if update_maps:
+            self.make_ensemble_maps()
+
     @staticmethod
     def shrink_to_binding_site(in_grid, new_origin, new_far_corner):
         """
-        Given an input grid, will reduce it to the area defined by the new origin and far corner
+        Given an input grid, will reduce it to the area defined by the new origin and far corner, by the rule of
+        grid_geometry.box_slices (the same rule chunked .hsc results are cropped by when they are read)
         :param in_grid: a ccdc.utilities.Grid
         :param new_origin: numpy array((x, y, z))
         :param new_far_corner: numpy array((x, y, z))
-        :return: ccdc.utilities.Grid
+        :return: ccdc.utilities.Grid, or None if the area does not overlap the grid
         """
         # Check that the new coordinates fall within the grid:
         ori = np.array(in_grid.bounding_box[0])
         far_c = np.array(in_grid.bounding_box[1])
 
-        if (new_origin >= ori).all() and (new_far_corner <= far_c).all():
-            ori_idxs = in_grid.point_to_indices(tuple(new_origin))
-            far_idxs = in_grid.point_to_indices(tuple(new_far_corner))
-            region = ori_idxs + far_idxs
-            # Get only the sub-grid defined by the 6 indices in region
-            new_g = in_grid.sub_grid(region)
-            return new_g
-
-        else:
+        if not ((new_origin >= ori).all() and (new_far_corner <= far_c).all()):
             print("Selected area larger than grid; try reducing the padding in shrink_hotspots()")
             # TODO: Log as error
 
+        frame = grid_frame(in_grid)
+        slices = box_slices(frame, new_origin, new_far_corner)
+        if slices is None:
+            return None
+        # Get only the sub-grid defined by the slices (clipped to the grid)
+        return grid_from_array(_GridEnsemble.array_from_grid(in_grid)[slices], slice_frame(frame, slices))
+
+    def _summary_parameters(self, probe, settings=None):
+        """
+        Works out how the maps of a probe are combined, based on the settings.
+        :param probe: str
+        :param settings: EnsembleResult.Settings; defaults to self.settings
+        :return: tuple of (frequency threshold or None, combine mode), or None if the probe or mode are not recognised
+        """
+        if settings is None:
+            settings = self.settings
+
+        if probe in ['donor', 'acceptor']:
+            if settings.combine_mode == 'median':
+                return settings.polar_frequency_threshold, 'median'
+            # The mean and max modes don't currently take into account the frequency
+            elif settings.combine_mode in ['mean', 'max']:
+                return None, settings.combine_mode
+            else:
+                print('Unrecognised mode for combining grids in {} {}: {}'.format(self.ensemble_id, probe, settings.combine_mode))
+                return None
+
+        elif probe == 'apolar':
+            if settings.apolar_frequency_threshold is not None:
+                return settings.apolar_frequency_threshold, 'median'
+            else:
+                return None, settings.combine_mode
+
+        else:
+            print("Probe type {} in ensemble {} not recognised as polar or apolar".format(probe, self.ensemble_id))
+            return None
+
+    def _make_sparse_ensemble_maps(self, save_grid_ensembles=True):
+        """
+        Creates the ensemble maps from sparse stacks of the nonzero points of each map (stack_backend="sparse").
+        :return:
+        """
+        for probe in ['donor', 'acceptor', 'apolar']:
+            try:
+                if probe in self.grid_ensembles.keys():
+                    ge = self.grid_ensembles[probe]
+                else:
+                    ge = SparseStack.from_grids([hs.super_grids[probe] for hs in self.hotspot_results])
+            # In case of no charged probes
+            except KeyError:
+                continue
+
+            params = self._summary_parameters(probe)
+            if params is None:
+                continue
+            threshold, mode = params
+
+            if save_grid_ensembles:
+                self.grid_ensembles[probe] = ge
+
+            ens_grid = ge.summary(threshold=threshold, mode=mode).as_grid()
+            print(probe, ens_grid.nsteps)
+            self.ensemble_maps[probe] = ens_grid
+
+    def _use_cache(self):
+        """
+        :return: True if the stacked maps should be read from / written to the ensemble cache
+        """
+        return self.settings.cache_dir is not None and self.result_paths is not None
+
+    def _get_voxel_stack(self):
+        """
+        Stacks the donor, acceptor and apolar maps of all structures into a VoxelStack (once), held on disk if
+        stack_backend is "memmap" and in memory otherwise. If the ensemble cache is used, the stack is loaded from the
+        cache when possible, and added to it otherwise.
+        :return: ensemble_stack.VoxelStack
+        """
+        if self.voxel_stack is None:
+            probes = [p for p in ['donor', 'acceptor', 'apolar']
+                      if all(p in hs.super_grids.keys() for hs in self.hotspot_results)]
+            in_memory = self.settings.stack_backend != 'memmap'
+            shared = in_memory and self.settings.workers > 1
+            use_cache = self._use_cache()
+
+            if use_cache:
+                cache = EnsembleCache(self.settings.cache_dir, max_bytes=self.settings.cache_max_bytes)
+                frames = [grid_frame(hs.super_grids[p]) for hs in self.hotspot_results for p in probes]
+                key = cache.make_key(self.result_paths, frames, probes, dtype=self.settings.stack_dtype,
+                                     scale=self.settings.stack_scale)
+                self.voxel_stack = cache.load(key, in_memory=in_memory, stack_dir=self.settings.stack_dir,
+                                              shared=shared)
+                if self.voxel_stack is not None:
+                    print("Loaded stacked maps for ensemble {} from the cache".format(self.ensemble_id))
+
+            if self.voxel_stack is None:
+                self.voxel_stack = VoxelStack.from_hotspot_results(self.hotspot_results, probes,
+                                                                   stack_dir=self.settings.stack_dir,
+                                                                   in_memory=in_memory, shared=shared,
+                                                                   dtype=self.settings.stack_dtype,
+                                                                   scale=self.settings.stack_scale)
+                if use_cache:
+                    cache.store(key, self.voxel_stack)
+
+        return self.voxel_stack
+
+    def _stack_summary_maps(self, stack, probe_parameters):
+        """
+        Combines the stacked maps, on a process pool if settings.workers > 1.
+        :param stack: ensemble_stack.VoxelStack
+        :param probe_parameters: dictionary of {probe: list of (threshold, mode) tuples}
+        :return: dictionary of {probe: list of 3D numpy arrays, in the order of the parameters}
+        """
+        if self.settings.workers > 1:
+            return parallel_summary_maps(stack, probe_parameters, self.settings.workers)
+
+        summary_maps = {}
+        for probe, parameters in probe_parameters.items():
+            if len(parameters) == 1:
+                threshold, mode = parameters[0]
+                summary_maps[probe] = [stack.summary_map(probe, threshold=threshold, mode=mode)]
+            else:
+                summary_maps[probe] = stack.summary_map_sweep(probe, parameters)
+        return summary_maps
+
+    def _make_stacked_ensemble_maps(self, save_grid_ensembles=True):
+        """
+        Creates the ensemble maps from a single VoxelStack holding all probes (stack_backend="memory" or "memmap").
+        The stack is kept in self.voxel_stack if save_grid_ensembles is True, and
+        deleted otherwise.
+        :return:
+        """
+        self._get_voxel_stack()
+
+        probe_parameters = {}
+        for probe in self.voxel_stack.probes:
+            params = self._summary_parameters(probe)
+            if params is not None:
+                probe_parameters[probe] = [params]
+        summary_maps = self._stack_summary_maps(self.voxel_stack, probe_parameters)
+
+        for probe in probe_parameters.keys():
+            ge = self.voxel_stack.probe_ensemble(probe)
+
+            if save_grid_ensembles:
+                self.grid_ensembles[probe] = ge
+
+            ens_grid = ge.as_grid(summary_maps[probe][0])
+            print(probe, ens_grid.nsteps)
+            self.ensemble_maps[probe] = ens_grid
+
+        if not save_grid_ensembles:
+            self.voxel_stack.close()
+            self.voxel_stack = None
+
+    def _make_ensemble_maps_from_store(self):
+        """
+        Reads the ensemble maps off the sorted per-point values in self.ensemble_store.
+        :return:
+        """
+        store = self.ensemble_store
+        for probe in store.probes:
+            params = self._summary_parameters(probe)
+            if params is None:
+                continue
+            threshold, mode = params
+            self.ensemble_maps[probe] = grid_from_array(store.summary_map(probe, threshold=threshold, mode=mode),
+                                                        store.frame)
+
+    def _make_streamed_ensemble_maps(self):
+        """
+        Creates the ensemble maps straight from the member map files, one slab at a time (stack_backend="stream"),
+        and reads the CCP4 files they are written to into Grids. The frequency maps of each probe are kept in
+        self.frequency_maps.
+        :return:
+        """
+        if self.result_paths is None:
+            raise ValueError("The stream backend reads the maps from the result files: "
+                             "pass result_paths to EnsembleResult")
+
+        with StreamedEnsemble(self.result_paths, extract_dir=self.settings.stack_dir) as streamed:
+            if len(self.hotspot_results) == 0:
+                self.index_dict = {i: str(p) for i, p in enumerate(self.result_paths)}
+                if streamed.protein_path is not None:
+                    self.ensemble_protein = Protein.from_file(streamed.protein_path)
+
+            for probe in streamed.probes:
+                params = self._summary_parameters(probe)
+                if params is None:
+                    continue
+                (ens_path,), freq_path = streamed.summary_maps(probe, [params])
+                ens_grid = grid_from_ccp4(ens_path, streamed.frame)
+                print(probe, ens_grid.nsteps)
+                self.ensemble_maps[probe] = ens_grid
+                self.frequency_maps[probe] = grid_from_ccp4(freq_path, streamed.frame)
+
+    def _as_hotspot_result(self, ensemble_maps):
+        """
+        Wraps a dictionary of ensemble maps in a hotspots result.
+        :param ensemble_maps: dictionary of {probe: ccdc.utilities.Grid}
+        :return: hotspots.result.Results
+        """
+        try:
+            if self.ensemble_store is not None:
+                # The store keeps the protein of its first member, also after results are appended
+                protein = self.ensemble_store.protein
+            elif len(self.hotspot_results) == 0:
+                # Results read from an ensemble index or streamed from the result files
+                protein = self.ensemble_protein
+            else:
+                protein = self.hotspot_results[0].protein
+            return Results(super_grids=ensemble_maps,
+                           protein=protein,
+                           buriedness=None,
+                           pharmacophore=False)
+        except TypeError:
+            return Results(super_grids=ensemble_maps,
+                           protein=None,
+                           buriedness=None,
+                           pharmacophore=False)
+
+    def _set_ensemble_hotspot_result(self):
+        """
+        Wraps the ensemble maps in a hotspots result.
+        :return:
+        """
+        self.ensemble_hotspot_result = self._as_hotspot_result(self.ensemble_maps)
+
+    def make_ensemble_map_sweep(self, thresholds, save_grid_ensembles=True):
+        """
+        Creates the ensemble maps for several frequency thresholds in one pass. The maps of each probe are stacked
+        once and the values at each point are sorted once; the map for every threshold is then read off the shared
+        nonzero counts and sorted values, rather than restacking and recomputing the medians for each threshold.
+
+        Each threshold is used as both the polar and the apolar frequency threshold; the combine mode is taken from
+        the settings. A threshold of None gives the median of all values (zeros included).
+
+        :param thresholds: list of frequency thresholds (percentages) or None
+        :param save_grid_ensembles: if True, keeps the stacked maps in self.grid_ensembles
+        :return: dictionary of {threshold: hotspots.result.Results}
+        """
+        stack = self._get_voxel_stack()
+        sweep_maps = {t: {} for t in thresholds}
+
+        probe_parameters = {}
+        for probe in stack.probes:
+            parameters = []
+            for t in thresholds:
+                t_settings = copy.copy(self.settings)
+                t_settings.polar_frequency_threshold = t
+                t_settings.apolar_frequency_threshold = t
+                parameters.append(self._summary_parameters(probe, t_settings))
+            if any(p is None for p in parameters):
+                continue
+            probe_parameters[probe] = parameters
+        summary_maps = self._stack_summary_maps(stack, probe_parameters)
+
+        for probe in probe_parameters.keys():
+            ge = stack.probe_ensemble(probe)
+            if save_grid_ensembles:
+                self.grid_ensembles[probe] = ge
+
+            for t, arr in zip(thresholds, summary_maps[probe]):
+                sweep_maps[t][probe] = ge.as_grid(arr)
+
+        if not save_grid_ensembles:
+            stack.close()
+            self.voxel_stack = None
+
+        return {t: self._as_hotspot_result(maps) for t, maps in sweep_maps.items()}
+
+    def _resampling_parameters(self, stack):
+        """
+        :return: dictionary of {probe: (frequency threshold or None, combine mode)} for the stacked probes
+        """
+        probe_parameters = {}
+        for probe in stack.probes:
+            params = self._summary_parameters(probe)
+            if params is not None:
+                probe_parameters[probe] = params
+        return probe_parameters
+
+    def make_leave_one_out_maps(self, out_dir=None):
+        """
+        Works out how much each structure drives the ensemble maps, by computing the ensemble maps with each structure
+        left out in turn. All the leave-one-out maps are read off one sorted stack of the ensemble (see
+        ensemble_resampling.RankedBlock), rather than rebuilding the ensemble once per structure.
+
+        The influence of a structure is the ensemble map minus the map without that structure: positive where the
+        structure raises the ensemble score, negative where it lowers it. The influence maps are kept in
+        self.influence_stack (an ensemble_stack.VoxelStack).
+
+        :param out_dir: if given, the influence grids are written to out_dir/{structure identifier}/{probe}_influence.ccp4
+        :return: dictionary of {structure identifier: {probe: sum of the absolute influence over the map}}
+        """
+        stack = self._get_voxel_stack()
+        probe_parameters = self._resampling_parameters(stack)
+        if self.influence_stack is not None:
+            self.influence_stack.close()
+        self.influence_stack = leave_one_out_influence(stack, probe_parameters, stack_dir=self.settings.stack_dir)
+
+        influence = {}
+        for s in range(stack.n_structures):
+            identifier = self.index_dict[s]
+            influence[identifier] = {}
+            for p_idx, probe in enumerate(self.influence_stack.probes):
+                arr = np.asarray(self.influence_stack.array[p_idx, s])
+                influence[identifier][probe] = float(np.abs(arr).sum())
+                if out_dir is not None:
+                    struct_dir = join(out_dir, str(identifier))
+                    if not os.path.exists(struct_dir):
+                        os.makedirs(struct_dir)
+                    grid = stack.probe_ensemble(probe).as_grid(arr)
+                    grid.write(join(struct_dir, '{}_influence.ccp4'.format(probe)))
+        return influence
+
+    def make_bootstrap_maps(self, n_replicates=100, seed=None, out_dir=None):
+        """
+        Estimates the uncertainty of the ensemble maps from bootstrap replicates of the ensemble (structures drawn
+        with replacement). The replicate maps are read off one sorted stack of the ensemble, by weighting each
+        structure by the number of times it was drawn.
+
+        :param n_replicates: number of bootstrap replicates
+        :param seed: seed for drawing the replicates
+        :param out_dir: if given, the grids are written to out_dir/{probe}_bootstrap_{statistic}.ccp4
+        :return: dictionary of {probe: {statistic: ccdc.utilities.Grid}}, where the statistics are the "mean" and
+                 "std" of the replicate maps and the "support" (percentage of replicates in which a point is nonzero)
+        """
+        stack = self._get_voxel_stack()
+        weights = bootstrap_weights(stack.n_structures, n_replicates, seed=seed)
+
+        bootstrap_maps = {}
+        for probe, (threshold, mode) in self._resampling_parameters(stack).items():
+            ge = stack.probe_ensemble(probe)
+            stats = bootstrap_statistics(stack, probe, weights, threshold=threshold, mode=mode)
+            bootstrap_maps[probe] = {stat: ge.as_grid(arr) for stat, arr in stats.items()}
+            if out_dir is not None:
+                if not os.path.exists(out_dir):
+                    os.makedirs(out_dir)
+                for stat, grid in bootstrap_maps[probe].items():
+                    grid.write(join(out_dir, '{}_bootstrap_{}.ccp4'.format(probe, stat)))
+        return bootstrap_maps
+
     def make_ensemble_maps(self, save_grid_ensembles=True):
         """
         Creates summary maps for the ensemble based on the settings provided.
         :return: 
         """
+        if self.ensemble_store is not None:
+            self._make_ensemble_maps_from_store()
+            self._set_ensemble_hotspot_result()
+            return
+
+        if self.ensemble_index is not None:
+            self.ensemble_maps = self._ensemble_maps_from_index()
+            self._set_ensemble_hotspot_result()
+            return
+
+        if self.settings.stack_backend in ['memory', 'memmap']:
+            self._make_stacked_ensemble_maps(save_grid_ensembles)
+            self._set_ensemble_hotspot_result()
+            return
+
+        if self.settings.stack_backend == 'sparse':
+            self._make_sparse_ensemble_maps(save_grid_ensembles)
+            self._set_ensemble_hotspot_result()
+            return
+
+        if self.settings.stack_backend == 'stream':
+            self._make_streamed_ensemble_maps()
+            self._set_ensemble_hotspot_result()
+            return
+
+        # Load the stacked maps from the ensemble cache, if one is used
+        if self._use_cache():
+            stack = self._get_voxel_stack()
+            for probe in stack.probes:
+                if probe not in self.grid_ensembles.keys():
+                    self.grid_ensembles[probe] = stack.probe_ensemble(probe)
+
         probes_list = ['donor', 'acceptor', 'apolar']
         polar_probes = ['donor', 'acceptor']
         apolar_probes = ['apolar']
@@ -124,7 +712,8 @@ class EnsembleResult(Helper):
                 if probe in polar_probes:
                     if self.settings.combine_mode == 'median':
                         if self.settings.polar_frequency_threshold is not None:
-                            ens_grid = ge.as_grid(ge.get_median_frequency_map(threshold=self.settings.polar_frequency_threshold))
+                            ens_arr = ge.get_median_frequency_map(threshold=self.settings.polar_frequency_threshold)
+                            ens_grid = grid_from_array(ens_arr, dimensions_frame(ge.dimensions, ens_arr.shape))
                         else:
                             print('entered polar else')
                             ens_grid = ge.make_summary_grid(mode=self.settings.combine_mode)
@@ -139,8 +728,8 @@ class EnsembleResult(Helper):
 
                 elif probe in apolar_probes:
                     if self.settings.apolar_frequency_threshold is not None:
-                        ens_grid = ge.as_grid(
-                            ge.get_median_frequency_map(threshold=self.settings.apolar_frequency_threshold))
+                        ens_arr = ge.get_median_frequency_map(threshold=self.settings.apolar_frequency_threshold)
+                        ens_grid = grid_from_array(ens_arr, dimensions_frame(ge.dimensions, ens_arr.shape))
                     else:
 
                         ens_grid = ge.make_summary_grid(mode=self.settings.combine_mode)
@@ -156,16 +745,7 @@ class EnsembleResult(Helper):
             # In case of no charged probes
             except KeyError:
                 continue
-        try:
-            self.ensemble_hotspot_result = Results(super_grids=self.ensemble_maps,
-                                                 protein=self.hotspot_results[0].protein,
-                                                 buriedness=None,
-                                                 pharmacophore=False)
-        except TypeError:
-            self.ensemble_hotspot_result = Results(super_grids=self.ensemble_maps,
-                                                 protein=None,
-                                                 buriedness=None,
-                                                 pharmacophore=False)
+        self._set_ensemble_hotspot_result()
 
 
 
@@ -177,7 +757,10 @@ class SelectivityResult(Helper):
         """
         Settings for the selectivity maps
         """
-        def __init__(self, minimal_cluster_score=10.0, cluster_distance_cutoff=1.5,  apolar_percentile_threshold=95.0, polar_percentile_threshold=0.0, minimum_points_cluster_polar=7, minimum_points_cluster_apolar=27):
+        def __init__(self, minimal_cluster_score=10.0, cluster_distance_cutoff=1.5,  apolar_percentile_threshold=95.0, polar_percentile_threshold=0.0, minimum_points_cluster_polar=7, minimum_points_cluster_apolar=27,
+                     backend="dense", clustering_engine="hdbscan", off_target_combine="max",
+                     off_target_percentile=75.0, region_of_interest=None, roi_padding=4.0, cache_dir=None,
+                     cache_max_bytes=2**30):
             """
             :param minimal_cluster_score: the minimal score needed for a cluster to be considered selective
             :type: float 
@@ -200,6 +783,46 @@ class SelectivityResult(Helper):
                                                 
             :param minimum_points_cluster_apolar: The apolar maps tend to have larger clusters, so the minimum HDBSCAN cluster size is correspondingly larger.
             :type int:
+
+            :param backend: "dense" works on numpy arrays of the whole common grid. "sparse" works on the nonzero points
+                            of the difference maps only (sparse_grids.SparseGrid), so that memory and time scale with
+                            the number of occupied points rather than the box volume.
+            :type str:
+
+            :param clustering_engine: How the thresholded difference maps are split into clusters. "hdbscan" (default)
+                                      clusters the points with HDBSCAN. "connected_components" labels the connected
+                                      regions of the grid, and "watershed" splits them further around their peaks
+                                      (see grid_clustering); both work directly on the 3D lattice in a single pass and
+                                      drop clusters smaller than the minimum_points_cluster_* sizes. A function
+                                      engine(array, min_cluster_size) returning cluster labels can also be given.
+            :type str:
+
+            :param off_target_combine: With a list of off-target results, how their maps are combined at each point
+                                       before being subtracted from the target map. "max" keeps the regions where the
+                                       target beats every off-target; "percentile" uses the off_target_percentile of
+                                       the off-target scores, so that a region only needs to beat most of them.
+            :type str:
+
+            :param off_target_percentile: Percentile of the off-target scores used by off_target_combine="percentile".
+            :type float:
+
+            :param region_of_interest: If specified, the difference maps are cropped to this region before the
+                                       percentile thresholds and the clustering, and the selectivity maps are put back
+                                       on the full common grid. Either a list of ligands (ccdc molecules) or residues,
+                                       whose heavy atoms (padded by roi_padding) define the region, or a box given as
+                                       (lower corner, upper corner) coordinates.
+            :type list:
+
+            :param roi_padding: Padding (in angstroms) around the ligands or residues of region_of_interest.
+            :type float:
+
+            :param cache_dir: if set, selectivity maps are cached on disk here (see selectivity_cache), keyed by the
+                              contents of the target and off-target maps and by these settings, and reused by later
+                              runs.
+            :type str:
+
+            :param cache_max_bytes: size limit of the cache; least recently used maps are evicted first
+            :type int:
             """
             self.minimal_cluster_score = minimal_cluster_score
             self.cluster_distance_cutoff = cluster_distance_cutoff
@@ -207,11 +830,20 @@ class SelectivityResult(Helper):
             self.polar_percentile_threshold = polar_percentile_threshold
             self.min_points_cluster_polar = minimum_points_cluster_polar
             self.min_points_cluster_apolar = minimum_points_cluster_apolar
+            self.backend = backend
+            self.clustering_engine = clustering_engine
+            self.off_target_combine = off_target_combine
+            self.off_target_percentile = off_target_percentile
+            self.region_of_interest = region_of_interest
+            self.roi_padding = roi_padding
+            self.cache_dir = cache_dir
+            self.cache_max_bytes = cache_max_bytes
 
     def __init__(self, target_result, other_result, settings=None):
         """
         :param target_result: hotspots result (may come from an ensemble) for on-target protein
-        :param other_result: hotspots result (may come from ensemble) for off-target protein
+        :param other_result: hotspots result (may come from ensemble) for off-target protein, or a list of results for
+                             several off-targets (see Settings.off_target_combine)
         """
         if settings is None:
             self.settings = self.Settings()
@@ -225,6 +857,8 @@ class SelectivityResult(Helper):
         self.selectivity_result = None
         self.common_grid_dimensions = None
         self.common_grid_nsteps = None
+        self.roi_slices = None
+        self._input_digests = None
 
 
     @staticmethod
@@ -242,6 +876,61 @@ class SelectivityResult(Helper):
         map[map == clust_num] = 0.0
         return map
 
+    @staticmethod
+    def remove_clusters(map, clust_nums):
+        """
+        Removes several clusters from an array in one pass, by relabelling it through a lookup table (removed labels
+        map to 0). Unlike remove_cluster, returns a new array.
+
+        :param map: a numpy array, with points labelled by cluster
+        :param clust_nums: labels of the clusters to remove
+        :return: numpy array of the same dtype, with those clusters removed
+        """
+        labels = map.astype(np.int64)
+        lut = np.arange(labels.max() + 1 if labels.size else 1)
+        removed = [int(c) for c in clust_nums if 0 < c < len(lut)]
+        lut[removed] = 0
+        return lut[labels].astype(map.dtype)
+
+    @staticmethod
+    def pair_clusters(coords, minus_coords, cutoff, spacing=0.5):
+        """
+        Finds every pair of target and off-target clusters whose centres are closer than the cutoff, with a single
+        KD-tree query rather than comparing every pair of centres.
+
+        :param coords: dictionary of {cluster: centre (in grid indices)} of the target clusters
+        :param minus_coords: dictionary of {cluster: centre (in grid indices)} of the off-target clusters
+        :param cutoff: distance cutoff, in angstroms
+        :param spacing: grid spacing, in angstroms
+        :return: tuple of (set of paired target clusters, set of paired off-target clusters)
+        """
+        if len(coords) == 0 or len(minus_coords) == 0:
+            return set(), set()
+        on_labels = list(coords.keys())
+        off_labels = list(minus_coords.keys())
+        on_tree = cKDTree(np.array([coords[k] for k in on_labels]) * spacing)
+        off_tree = cKDTree(np.array([minus_coords[i] for i in off_labels]) * spacing)
+        pairs = on_tree.sparse_distance_matrix(off_tree, cutoff, output_type='ndarray')
+        pairs = pairs[pairs['v'] < cutoff]
+        return set(on_labels[k] for k in pairs['i']), set(off_labels[i] for i in pairs['j'])
+
+    def cluster_difference_map(self, dmap, min_cluster_size):
+        """
+        Clusters the nonzero points of a thresholded difference map with settings.clustering_engine.
+
+        :param dmap: numpy array, or sparse_grids.SparseGrid (sparse backend)
+        :param min_cluster_size: minimum number of points in a cluster
+        :return: numpy array labelled by cluster (noise is 0), or a SparseGrid of the labels of the clustered points
+        """
+        engine = self.settings.clustering_engine
+        if not isinstance(dmap, SparseGrid):
+            return cluster_map(dmap, min_cluster_size, engine=engine)
+        if engine == 'hdbscan':
+            return dmap.hdbscan_cluster(min_cluster_size=min_cluster_size, allow_single_cluster=True)
+        # The lattice engines need the neighbourhood of each point, so they run on the dense array
+        labels = cluster_map(dmap.to_array(), min_cluster_size, engine=engine)
+        return SparseGrid.from_array(labels, dmap.frame)
+
     def get_clusters_center_mass(self, dmap, clust_map):
         """
         
@@ -250,11 +939,62 @@ class SelectivityResult(Helper):
         :param clust_map: numpy array, labelled by cluster
         :return: 
         """
-        coords = {}
-        for c in set(clust_map[clust_map > 0]):
-            arr = dmap * (clust_map == c)
-            coords[c] = _GridEnsemble.get_center_of_mass(arr)
-        return coords
+        return clusters_centre_of_mass(clust_map, dmap)
+
+    @staticmethod
+    def combine_off_targets(off_stack, mode='max', percentile=75.0):
+        """
+        Combines the maps of several off-targets, point by point, in a single vectorised pass.
+
+        :param off_stack: numpy array of shape (n_off_targets, nx, ny, nz)
+        :param mode: "max" or "percentile"
+        :param percentile: percentile of the off-target scores, for mode="percentile"
+        :return: 3D numpy array
+        """
+        if mode == 'max':
+            return off_stack.max(axis=0)
+        elif mode == 'percentile':
+            return np.percentile(off_stack, percentile, axis=0)
+        else:
+            raise ValueError("Unrecognised off-target combine mode: {}".format(mode))
+
+    def make_multi_difference_maps(self):
+        """
+        Subtracts the combined maps of several off-targets (see combine_off_targets) from the target maps. For each
+        probe, the target and off-target grids are brought onto one common frame and the off-targets are stacked into
+        a single array. Off-targets without a map for a probe are left out of that probe.
+        :return: dictionary of {probe: numpy array}
+        """
+        diff_maps = {}
+
+        for probe, gr in self.target.super_grids.items():
+            off_grs = [r.super_grids[probe] for r in self.off_target if probe in r.super_grids.keys()]
+            if len(off_grs) == 0:
+                continue
+
+            frames = [grid_frame(g) for g in [gr] + off_grs]
+            if all(is_aligned(f, frames[0]) for f in frames):
+                frame = common_frame(frames)
+                arrays = [_GridEnsemble.array_from_grid(g) for g in [gr] + off_grs]
+            else:
+                # Grids that are not on the same lattice have to be interpolated
+                common_grids = Grid.common_grid([gr] + off_grs)
+                frame = grid_frame(common_grids[0])
+                frames = [frame] * len(common_grids)
+                arrays = [_GridEnsemble.array_from_grid(g) for g in common_grids]
+
+            target_array = place_array(arrays[0], frames[0], frame, np.zeros(frame.nsteps))
+            off_stack = np.zeros((len(off_grs),) + tuple(frame.nsteps), dtype=np.float32)
+            for i, (array, f) in enumerate(zip(arrays[1:], frames[1:])):
+                place_array(array, f, frame, off_stack[i])
+
+            diff_maps[probe] = target_array - self.combine_off_targets(off_stack, self.settings.off_target_combine,
+                                                                       self.settings.off_target_percentile)
+
+        self.common_grid_dimensions = frame_dimensions(frame)
+        self.common_grid_nsteps = frame.nsteps
+
+        return diff_maps
 
     def make_difference_maps(self):
         """
@@ -262,6 +1002,9 @@ class SelectivityResult(Helper):
         TODO - think about cases of results with different numbers of probe grids (charged vs not)
         :return: ccdc grids
         """
+        if isinstance(self.off_target, (list, tuple)):
+            return self.make_multi_difference_maps()
+
         diff_maps = {}
 
         for probe, gr in self.target.super_grids.items():
@@ -273,92 +1016,418 @@ class SelectivityResult(Helper):
                 continue
 
             if gr.check_same_size_and_coords(off_gr):
-                c_gr = gr
-                c_off = off_gr
-            else:
-                print("Input grids of different size. Converting to same coordinates.")
+                frame = grid_frame(gr)
+                diff_maps[probe] = _GridEnsemble.array_from_grid(gr - off_gr)
+                continue
+
+            print("Input grids of different size. Converting to same coordinates.")
+            # The plans are cached by pair of frames, so they are only worked out once for all the probes
+            plans = pair_resampling_plans(grid_frame(gr), grid_frame(off_gr))
+            if plans is None:
+                # Grids that are not on the same lattice have to be interpolated
                 c_gr, c_off = Grid.common_grid([gr, off_gr])
+                frame = grid_frame(c_gr)
+                diff_maps[probe] = _GridEnsemble.array_from_grid(c_gr - c_off)
+                continue
 
-            diff_maps[probe] = _GridEnsemble.array_from_grid(c_gr - c_off)
+            frame, on_plan, off_plan = plans
+            diff_maps[probe] = apply_resampling_plan(_GridEnsemble.array_from_grid(gr), on_plan) - \
+                               apply_resampling_plan(_GridEnsemble.array_from_grid(off_gr), off_plan)
 
-        self.common_grid_dimensions = np.array(c_gr.bounding_box)
-        self.common_grid_nsteps = c_gr.nsteps
+        self.common_grid_dimensions = frame_dimensions(frame)
+        self.common_grid_nsteps = frame.nsteps
 
         return diff_maps
 
-    def make_selectivity_maps(self):
+    def make_sparse_difference_maps(self):
         """
-        Creates the selectivity maps for the polar and apolar probes. 
-        :return: 
+        Brings the two results to the same frame and subtracts them, keeping only the nonzero points.
+        :return: dictionary of {probe: sparse_grids.SparseGrid}
         """
-        diff_maps = self.make_difference_maps()
+        if isinstance(self.off_target, (list, tuple)):
+            # The off-targets are combined on the dense common frame
+            diff_maps = self.make_multi_difference_maps()
+            frame = self._common_frame()
+            return {probe: SparseGrid.from_array(d, frame) for probe, d in diff_maps.items()}
 
-        probes_list = ['donor', 'acceptor', 'apolar', 'positive', 'negative']
-        polar_probes = ['donor', 'acceptor', 'positive', 'negative']
-        apolar_probes = ['apolar']
+        diff_maps = {}
 
-        for probe in probes_list:
-            try:
-                dmap = diff_maps[probe]
+        for probe, gr in self.target.super_grids.items():
 
-                if probe in polar_probes:
-                    # Find the percentile threshold, if specified
-                    perc = np.percentile(dmap[dmap>0], self.settings.polar_percentile_threshold)
+            try:
+                off_gr = self.off_target.super_grids[probe]
+            # In case the off-target hotspot result doesn't have a map for that probe
+            except KeyError:
+                continue
 
-                    # Find clusters in the target and off-target maps
-                    clust_map_on = _GridEnsemble.HDBSCAN_cluster(dmap * (dmap > perc), min_cluster_size=self.settings.min_points_cluster_polar, allow_single_cluster=True)
-                    clust_map_off = _GridEnsemble.HDBSCAN_cluster(dmap * (dmap < - perc), min_cluster_size=self.settings.min_points_cluster_polar, allow_single_cluster=True)
+            on_sparse = SparseGrid.from_grid(gr)
+            off_sparse = SparseGrid.from_grid(off_gr)
+            frame = common_frame([on_sparse.frame, off_sparse.frame])
+            diff_maps[probe] = on_sparse.reframe(frame) - off_sparse.reframe(frame)
 
-                elif probe in apolar_probes:
-                    # Find the percentile threshold, if specified
-                    perc = np.percentile(dmap[dmap > 0], self.settings.apolar_percentile_threshold)
+            self.common_grid_dimensions = frame_dimensions(frame)
+            self.common_grid_nsteps = frame.nsteps
 
-                    # Find clusters in the target and off-target maps
-                    clust_map_on = _GridEnsemble.HDBSCAN_cluster(dmap * (dmap > perc),
-                                                                 min_cluster_size=self.settings.min_points_cluster_apolar, allow_single_cluster=True)
-                    clust_map_off = _GridEnsemble.HDBSCAN_cluster(dmap * (dmap < -perc),
-                                                                  min_cluster_size=self.settings.min_points_cluster_apolar, allow_single_cluster=True)
+        return diff_maps
 
-                else:
-                    print("Probe type {} not recognised as polar or apolar".format(probe))
-                    continue
+    def _common_frame(self):
+        """
+        :return: grid_geometry.GridFrame of the difference maps (after make_difference_maps)
+        """
+        return GridFrame(origin=tuple(float(x) for x in self.common_grid_dimensions[0]),
+                         nsteps=tuple(int(n) for n in self.common_grid_nsteps),
+                         spacing=float(list(self.target.super_grids.values())[0].spacing))
 
+    def _roi_box(self):
+        """
+        :return: numpy array((lower corner, upper corner)) of settings.region_of_interest, or None if not specified
+        """
+        roi = self.settings.region_of_interest
+        if roi is None:
+            return None
+        if len(roi) > 0 and not hasattr(roi[0], 'atoms'):
+            return np.array(roi, dtype=float)
+        coords = np.array([a.coordinates for item in roi for a in item.atoms if a.atomic_number > 1])
+        return np.array([coords.min(axis=0) - self.settings.roi_padding,
+                         coords.max(axis=0) + self.settings.roi_padding])
+
+    def _crop_to_roi(self, diff_maps):
+        """
+        Crops the difference maps to settings.region_of_interest. Dense maps are cut down to the slices of the common
+        grid within the region (self.roi_slices, views of the full maps); sparse maps keep the points within them.
+        :param diff_maps: dictionary of {probe: numpy array or sparse_grids.SparseGrid}
+        :return: dictionary of {probe: cropped map}
+        """
+        box = self._roi_box()
+        if box is None:
+            self.roi_slices = None
+            return diff_maps
+        self.roi_slices = box_slices(self._common_frame(), box[0], box[1])
+        if self.roi_slices is None:
+            raise ValueError("The region of interest does not overlap the difference maps")
+
+        cropped = {}
+        lower = np.array([s.start for s in self.roi_slices])
+        upper = np.array([s.stop for s in self.roi_slices])
+        for probe, dmap in diff_maps.items():
+            if isinstance(dmap, SparseGrid):
+                points = dmap.points()
+                cropped[probe] = dmap.select(np.all((points >= lower) & (points < upper), axis=1))
+            else:
+                cropped[probe] = dmap[self.roi_slices]
+        return cropped
 
-                #Get the center of mass coordinates for the target and off-target
-                coords = self.get_clusters_center_mass(dmap, clust_map_on)
-                minus_coords = self.get_clusters_center_mass(dmap, clust_map_off)
+    def _cluster_parameters(self, probe):
+        """
+        :param probe: str
+        :return: tuple of (percentile threshold, minimum cluster size), or None if the probe is not recognised
+        """
+        if probe in ['donor', 'acceptor', 'positive', 'negative']:
+            return self.settings.polar_percentile_threshold, self.settings.min_points_cluster_polar
+        elif probe == 'apolar':
+            return self.settings.apolar_percentile_threshold, self.settings.min_points_cluster_apolar
+        else:
+            print("Probe type {} not recognised as polar or apolar".format(probe))
+            return None
 
-                for k in coords.keys():
-                    for i in minus_coords.keys():
-                        dist = self.get_distance(coords[k], minus_coords[i]) * 0.5
-                        # print("Plus clust: {}, minus_clust: {}, distance: {}".format(k, i, dist))
-                        if dist < self.settings.cluster_distance_cutoff:
-                            self.remove_cluster(clust_map_on, k)
-                            self.remove_cluster(clust_map_off, i)
+    def _side_clusters(self, side_map, perc, min_points):
+        """
+        Clusters the points of a map above a threshold.
+        :param side_map: numpy array, or sparse_grids.SparseGrid (sparse backend)
+        :param perc: threshold
+        :param min_points: minimum cluster size
+        :return: tuple of (thresholded map, cluster labels)
+        """
+        if isinstance(side_map, SparseGrid):
+            points = side_map.select(side_map.values > perc)
+        else:
+            points = side_map * (side_map > perc)
+        return points, self.cluster_difference_map(points, min_points)
 
-                # Remove any clusters that don't make the median cutoff
-                for c in set(clust_map_on[clust_map_on > 0]):
-                    med = np.median(dmap[clust_map_on == c])
+    def _cluster_direction(self, dmap, direction, percentile, min_points):
+        """
+        Clusters one probe's difference map for one direction. The target points are those above the percentile
+        threshold of the positive values of direction * dmap, and the off-target points those below minus that
+        threshold. Clustering does not depend on the sign of the values, and neither do the centres of mass, so the
+        off-target side is clustered as positive values.
+        :param dmap: difference map (target - off-target), numpy array or sparse_grids.SparseGrid
+        :param direction: 1 for the selectivity of the target over the off-target, -1 for the reverse
+        :param percentile: percentile threshold
+        :param min_points: minimum cluster size
+        :return: tuple of (values of the target points, target cluster labels, {cluster: labeled_stats.ClusterStats},
+                 {off-target cluster: centre of mass})
+        """
+        signed = dmap if direction == 1 else -dmap
+        values = signed.values if isinstance(signed, SparseGrid) else signed
 
-                    if med < self.settings.minimal_cluster_score:
-                        self.remove_cluster(clust_map_on, c)
+        # Find the percentile threshold, if specified
+        perc = np.percentile(values[values > 0], percentile)
 
-                for c in set(clust_map_off[clust_map_off > 0]):
-                    min_med = np.median(dmap[clust_map_off == c])
+        # Find clusters in the target and off-target maps
+        on_map, clust_on = self._side_clusters(signed, perc, min_points)
+        off_map, clust_off = self._side_clusters(-signed, perc, min_points)
 
-                    if min_med > -self.settings.minimal_cluster_score:
-                        self.remove_cluster(clust_map_off, c)
+        # Get the center of mass coordinates (and medians) for the target and off-target
+        if isinstance(signed, SparseGrid):
+            on_values = clust_on.with_values(on_map.values[np.searchsorted(on_map.indices, clust_on.indices)])
+            on_stats = point_cluster_statistics(clust_on.values, on_values.values, clust_on.points())
+            minus_coords = off_map.centres_of_mass(clust_off)
+            return on_values, clust_on, on_stats, minus_coords
 
-                ge = _GridEnsemble(dimensions=self.common_grid_dimensions,
-                                   shape=self.common_grid_nsteps)
+        on_stats = cluster_statistics(clust_on, signed)
+        minus_coords = self.get_clusters_center_mass(off_map, clust_off)
+        return signed, clust_on, on_stats, minus_coords
 
-                self.selectivity_maps[probe] = ge.as_grid((clust_map_on>0)*dmap)
+    def _cluster_difference_maps(self, directions=(1,)):
+        """
+        Computes the difference maps and clusters the target and off-target points of each probe. Only the filtering
+        of the clusters (see _selective_clusters) depends on minimal_cluster_score and cluster_distance_cutoff, so
+        the output can be filtered with several values of these parameters. With settings.backend="sparse", the
+        percentiles, clustering, centroids and cluster medians are computed on the nonzero points of the difference
+        maps only.
+        :param directions: 1 for the selectivity of the target over the off-target, -1 for the off-target over the target
+        :return: dictionary of {direction: {probe: (values of the target points, target cluster labels,
+                 {cluster: labeled_stats.ClusterStats}, {off-target cluster: centre of mass})}}, as numpy arrays (or
+                 SparseGrids for the sparse backend)
+        """
+        if self.settings.backend == 'sparse':
+            diff_maps = self.make_sparse_difference_maps()
+        else:
+            diff_maps = self.make_difference_maps()
+        diff_maps = self._crop_to_roi(diff_maps)
+        clusters = {d: {} for d in directions}
 
-            except KeyError:
+        for probe in ['donor', 'acceptor', 'apolar', 'positive', 'negative']:
+            if probe not in diff_maps.keys():
+                continue
+            params = self._cluster_parameters(probe)
+            if params is None:
                 continue
+            percentile, min_points = params
+            for d in directions:
+                clusters[d][probe] = self._cluster_direction(diff_maps[probe], d, percentile, min_points)
+
+        return clusters
+
+    def _selective_clusters(self, on_stats, minus_coords, minimal_cluster_score, cluster_distance_cutoff):
+        """
+        :param on_stats: dictionary of {cluster: labeled_stats.ClusterStats} of the target clusters
+        :param minus_coords: dictionary of {cluster: centre of mass} of the off-target clusters
+        :param minimal_cluster_score: see Settings
+        :param cluster_distance_cutoff: see Settings
+        :return: set of the target clusters that are not selective
+        """
+        coords = {c: st.centroid for c, st in on_stats.items()}
+
+        # Target clusters close to an off-target cluster are not selective
+        removed_on, removed_off = self.pair_clusters(coords, minus_coords, cluster_distance_cutoff)
+
+        # Remove any clusters that don't make the median cutoff
+        for c, st in on_stats.items():
+            if c not in removed_on and st.median < minimal_cluster_score:
+                removed_on.add(c)
+        return removed_on
+
+    def _selectivity_grid(self, dmap, clust_map_on, removed_on):
+        """
+        :param dmap: the difference map (values of the clustered target points for the sparse backend)
+        :param clust_map_on: target cluster labels
+        :param removed_on: clusters to remove
+        :return: ccdc grid of the difference map values of the remaining clusters
+        """
+        if isinstance(clust_map_on, SparseGrid):
+            keep = ~np.isin(clust_map_on.values, list(removed_on))
+            return dmap.select(keep).as_grid()
+
+        clust_map_on = self.remove_clusters(clust_map_on, removed_on)
+        selected = (clust_map_on>0)*dmap
+        if self.roi_slices is not None:
+            # Put the cropped map back on the full common grid
+            full = np.zeros(self.common_grid_nsteps)
+            full[self.roi_slices] = selected
+            selected = full
+
+        return grid_from_array(selected, self._common_frame())
+
+    def _filter_clusters(self, clusters, minimal_cluster_score, cluster_distance_cutoff):
+        """
+        :param clusters: dictionary of {probe: clusters}, one direction of the output of _cluster_difference_maps
+        :param minimal_cluster_score: see Settings
+        :param cluster_distance_cutoff: see Settings
+        :return: tuple of (dictionary of {probe: ccdc grid of the selectivity map}, list of dictionaries with the number
+                 of target clusters, selective clusters and selective points of each probe)
+        """
+        selectivity_maps = {}
+        rows = []
+        for probe, (dmap, clust_map_on, on_stats, minus_coords) in clusters.items():
+            removed_on = self._selective_clusters(on_stats, minus_coords, minimal_cluster_score,
+                                                  cluster_distance_cutoff)
+            selectivity_maps[probe] = self._selectivity_grid(dmap, clust_map_on, removed_on)
+            selective = [c for c in on_stats.keys() if c not in removed_on]
+            rows.append({'probe': probe,
+                         'num_clusters': len(on_stats),
+                         'num_selective_clusters': len(selective),
+                         'num_selective_points': sum(on_stats[c].size for c in selective)})
+        return selectivity_maps, rows
+
+    def _settings_key(self, **overrides):
+        """
+        Canonical, JSON-serialisable form of the settings that affect the selectivity maps, for the selectivity cache.
+        The region of interest is replaced by its box, and a clustering function by its qualified name.
+        :param overrides: settings to replace (e.g. minimal_cluster_score in a sweep)
+        :return: dictionary
+        """
+        settings = dict(vars(self.settings), **overrides)
+        for name in ['cache_dir', 'cache_max_bytes']:
+            settings.pop(name, None)
+        box = self._roi_box()
+        settings['region_of_interest'] = box.tolist() if box is not None else None
+        engine = settings['clustering_engine']
+        if callable(engine):
+            settings['clustering_engine'] = '{}.{}'.format(engine.__module__, engine.__qualname__)
+        return settings
+
+    def _selectivity_cache(self):
+        """
+        :return: selectivity_cache.SelectivityCache, or None if settings.cache_dir is not set
+        """
+        if self.settings.cache_dir is None:
+            return None
+        return SelectivityCache(self.settings.cache_dir, max_bytes=self.settings.cache_max_bytes)
+
+    def _cache_key(self, cache, reverse=False, **overrides):
+        """
+        :param cache: selectivity_cache.SelectivityCache
+        :param reverse: if True, the key of the off-target over the target
+        :param overrides: settings to replace (see _settings_key)
+        :return: str
+        """
+        if self._input_digests is None:
+            off_targets = self.off_target if isinstance(self.off_target, (list, tuple)) else [self.off_target]
+            self._input_digests = (grids_digest(self.target.super_grids),
+                                   [grids_digest(r.super_grids) for r in off_targets])
+        target_digest, off_target_digests = self._input_digests
+        if reverse:
+            return cache.make_key(off_target_digests[0], [target_digest], self._settings_key(**overrides))
+        return cache.make_key(target_digest, off_target_digests, self._settings_key(**overrides))
+
+    def _load_cached(self, cache, keys, proteins):
+        """
+        :param cache: selectivity_cache.SelectivityCache
+        :param keys: cache keys
+        :param proteins: protein of the result of each key
+        :return: list of (hotspots result, summary dictionaries) for the keys, or None unless all of them are cached
+        """
+        if not all(key in cache for key in keys):
+            return None
+        loaded = []
+        for key, protein in zip(keys, proteins):
+            grids, common, summary = cache.load(key)
+            self.common_grid_dimensions = frame_dimensions(common)
+            self.common_grid_nsteps = common.nsteps
+            loaded.append((Results(super_grids=grids, protein=protein), summary))
+        return loaded
+
+    def make_selectivity_maps(self):
+        """
+        Creates the selectivity maps for the polar and apolar probes. 
+        :return: 
+        """
+        cache = self._selectivity_cache()
+        if cache is not None:
+            key = self._cache_key(cache)
+            loaded = self._load_cached(cache, [key], [self.target.protein])
+            if loaded is not None:
+                print("Loaded selectivity maps from the cache")
+                self.selectivity_result = loaded[0][0]
+                self.selectivity_maps = self.selectivity_result.super_grids
+                return
+
+        clusters = self._cluster_difference_maps()[1]
+        self.selectivity_maps, rows = self._filter_clusters(clusters, self.settings.minimal_cluster_score,
+                                                            self.settings.cluster_distance_cutoff)
 
         self.selectivity_result = Results(super_grids= self.selectivity_maps,
                                           protein=self.target.protein)
+        if cache is not None:
+            cache.store(key, self.selectivity_maps, self._common_frame(), rows)
+
+    def make_selectivity_maps_both_ways(self):
+        """
+        Creates the selectivity maps of the target over the off-target (as make_selectivity_maps) and of the
+        off-target over the target. Only a single off-target result is supported. The reverse difference map is the
+        negation of the forward one, so it is computed once. Each direction is still clustered on its own, at the
+        percentile threshold of its own positive values.
+        :return: tuple of (hotspots result of the target over the off-target, hotspots result of the off-target over
+                 the target, list of summary dictionaries (see sweep) with a "direction" key)
+        """
+        if isinstance(self.off_target, (list, tuple)):
+            raise ValueError("Selectivity maps in both directions need a single off-target result; "
+                             "got a list of {} off-targets".format(len(self.off_target)))
+        directions = [(1, self.target.protein), (-1, self.off_target.protein)]
+        cache = self._selectivity_cache()
+        loaded = None
+        if cache is not None:
+            keys = [self._cache_key(cache, reverse=(direction == -1)) for direction, _ in directions]
+            loaded = self._load_cached(cache, keys, [protein for _, protein in directions])
+
+        if loaded is None:
+            clusters = self._cluster_difference_maps(directions=(1, -1))
+            loaded = []
+            for i, (direction, protein) in enumerate(directions):
+                selectivity_maps, rows = self._filter_clusters(clusters[direction],
+                                                               self.settings.minimal_cluster_score,
+                                                               self.settings.cluster_distance_cutoff)
+                loaded.append((Results(super_grids=selectivity_maps, protein=protein), rows))
+                if cache is not None:
+                    cache.store(keys[i], selectivity_maps, self._common_frame(), rows)
+
+        results = [result for result, _ in loaded]
+        summary = [dict(row, direction=direction) for (direction, _), (_, rows) in zip(directions, loaded)
+                   for row in rows]
+
+        self.selectivity_maps = results[0].super_grids
+        self.selectivity_result = results[0]
+        return results[0], results[1], summary
+
+    def sweep(self, scores, distances):
+        """
+        Makes the selectivity maps for every combination of minimal_cluster_score and cluster_distance_cutoff. The
+        difference maps are computed and clustered once per probe; each combination only filters the clusters.
+
+        :param scores: list of minimal_cluster_score values
+        :param distances: list of cluster_distance_cutoff values (in angstroms)
+        :return: tuple of (dictionary of {(score, distance): hotspots result of the selectivity maps},
+                 pandas.DataFrame with one row per (score, distance, probe), giving the number of target clusters,
+                 selective clusters and selective points)
+        """
+        combinations = [(score, distance) for score in scores for distance in distances]
+        cache = self._selectivity_cache()
+        loaded = None
+        if cache is not None:
+            keys = [self._cache_key(cache, minimal_cluster_score=score, cluster_distance_cutoff=distance)
+                    for score, distance in combinations]
+            loaded = self._load_cached(cache, keys, [self.target.protein] * len(keys))
+
+        if loaded is None:
+            clusters = self._cluster_difference_maps()[1]
+            loaded = []
+            for i, (score, distance) in enumerate(combinations):
+                selectivity_maps, probe_rows = self._filter_clusters(clusters, score, distance)
+                loaded.append((Results(super_grids=selectivity_maps, protein=self.target.protein), probe_rows))
+                if cache is not None:
+                    cache.store(keys[i], selectivity_maps, self._common_frame(), probe_rows)
+
+        results = {}
+        rows = []
+        for (score, distance), (result, probe_rows) in zip(combinations, loaded):
+            rows.extend([dict(row, minimal_cluster_score=score, cluster_distance_cutoff=distance)
+                         for row in probe_rows])
+            results[(score, distance)] = result
+
+        summary = pd.DataFrame(rows, columns=['minimal_cluster_score', 'cluster_distance_cutoff', 'probe',
+                                              'num_clusters', 'num_selective_clusters', 'num_selective_points'])
+        return results, summary
 
 
 class EnsembleQC():
@@ -0,0 +1,69 @@
+import collections
+import numpy as np
+
+# Statistics of one cluster of a labelled map:
+# size: number of points; centroid: value-weighted centre of mass, in grid indices (as _GridEnsemble.get_center_of_mass);
+# median and max of the values; bbox: numpy array((min (i, j, k), max (i, j, k))) of the grid indices of the points
+ClusterStats = collections.namedtuple('ClusterStats', ['size', 'centroid', 'median', 'max', 'bbox'])
+
+
+def cluster_statistics(cluster_array, value_array):
+    """
+    Computes the statistics of every cluster of a labelled map in one pass: the labelled points are gathered and
+    sorted by label once, and the per-cluster reductions are done with bincount and reduceat, rather than building a
+    full-size mask for each cluster.
+    :param cluster_array: 3D numpy array, labelled by cluster (0 is unlabelled)
+    :param value_array: 3D numpy array of the values (e.g. the hotspot or difference map)
+    :return: dictionary of {label: ClusterStats}, with the labels as they appear in cluster_array
+    """
+    idx = np.flatnonzero(cluster_array > 0)
+    if len(idx) == 0:
+        return {}
+    points = np.column_stack(np.unravel_index(idx, cluster_array.shape))
+    return point_cluster_statistics(cluster_array.ravel()[idx], value_array.ravel()[idx], points)
+
+
+def point_cluster_statistics(labels, values, points):
+    """
+    As cluster_statistics, for clustered points given as lists (e.g. the nonzero points of a sparse_grids.SparseGrid).
+    :param labels: numpy array of the cluster label of each point (all > 0)
+    :param values: numpy array of the value at each point
+    :param points: numpy array of the grid indices (i, j, k) of each point, shape (n, 3)
+    :return: dictionary of {label: ClusterStats}
+    """
+    if len(labels) == 0:
+        return {}
+    points = np.asarray(points)
+    unique_labels, inverse = np.unique(labels, return_inverse=True)
+    sizes = np.bincount(inverse)
+
+    weights = values.astype(np.float64)
+    total = np.bincount(inverse, weights=weights)
+    centroids = np.column_stack([np.bincount(inverse, weights=weights * points[:, d]) for d in range(3)])
+    centroids = centroids / total[:, np.newaxis]
+
+    # Sort by label, then by value: each cluster is a contiguous run, in ascending order of value
+    order = np.lexsort((values, inverse))
+    sorted_values = values[order]
+    sorted_points = points[order]
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    medians = (sorted_values[starts + (sizes - 1) // 2] + sorted_values[starts + sizes // 2]) / 2
+    maxima = sorted_values[starts + sizes - 1]
+    lower = np.minimum.reduceat(sorted_points, starts, axis=0)
+    upper = np.maximum.reduceat(sorted_points, starts, axis=0)
+
+    return {c: ClusterStats(size=int(sizes[n]),
+                            centroid=centroids[n],
+                            median=medians[n],
+                            max=maxima[n],
+                            bbox=np.array([lower[n], upper[n]]))
+            for n, c in enumerate(unique_labels)}
+
+
+def clusters_centre_of_mass(cluster_array, value_array):
+    """
+    :param cluster_array: 3D numpy array, labelled by cluster
+    :param value_array: 3D numpy array of the values used as weights
+    :return: dictionary of {label: numpy array((i, j, k))}, the value-weighted centre of mass of each cluster
+    """
+    return {c: st.centroid for c, st in cluster_statistics(cluster_array, value_array).items()}
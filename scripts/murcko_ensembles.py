@@ -6,10 +6,11 @@ from rdkit import Chem
 from rdkit.Chem import AllChem, Draw
 from rdkit.DataStructs.cDataStructs import BulkTanimotoSimilarity
 from rdkit.Chem.Scaffolds import MurckoScaffold
-from hotspots.hs_io import HotspotReader, HotspotWriter
+from hotspots.hs_io import HotspotWriter
 from hotspots.hs_ensembles import EnsembleResult
 from parameter_run_analysis import visualise_ensmap_cluster_contribs, reduce_clusters
 from calculate_ensemble_maps import ensemble_cluster_summary
+from result_loader import load_results
 
 def get_similar_molecules(mols, cutoff=0.9):
     """
@@ -78,8 +79,9 @@ def plot_murcko_ligands(clust_dict, murcko_image_save_dir, frag_sub_df):
                                         legends=master_labels)
         img.save(str(Path(murcko_image_save_dir, f"cluster_{clust_ind}_ligands.png")))
 
-def hotspot_list_from_subset(subset_df, ens_df_path):
-    hotspot_list = []
+def hotspot_list_from_subset(subset_df, ens_df_path, workers=8):
+    hotspot_paths = []
+    pnames = []
 
     for idx, row in subset_df.iterrows():
         # Find the protein file:
@@ -97,14 +99,11 @@ def hotspot_list_from_subset(subset_df, ens_df_path):
                        'out.zip')
 
         if hs_path.exists():
-            with HotspotReader(str(hs_path)) as hsr:
-                res = hsr.read()
-                res.protein.identifier = pname
-                hotspot_list.append(res)
-            # print('ok')
+            hotspot_paths.append(hs_path)
+            pnames.append(pname)
         else:
             print(f"No hotspot maps found for {pname}. Re-run the case study script")
-    return hotspot_list
+    return load_results(hotspot_paths, identifiers=pnames, workers=workers)
 
 def make_subset_ensemble(clust_subdf, ens_df_path, clust_save_dir):
     cluster_hotspots = hotspot_list_from_subset(clust_subdf, ens_df_path)
@@ -0,0 +1,220 @@
+import json
+import shutil
+import tempfile
+import zlib
+from pathlib import Path
+import numpy as np
+from ccdc.io import MoleculeWriter
+from ccdc.protein import Protein
+from hotspots.grid_extension import _GridEnsemble
+from hotspots.result import Results
+from grid_geometry import GridFrame, grid_frame, box_slices, slice_frame
+from ccp4_maps import grid_from_array
+
+# First bytes of a container file, followed by the byte offset of the index (little-endian uint64)
+MAGIC = b'HSCHUNK1'
+PREAMBLE_BYTES = len(MAGIC) + 8
+
+CHUNK_SHAPE = (32, 32, 32)
+
+
+def _frame_from_meta(meta):
+    return GridFrame(origin=tuple(meta['origin']), nsteps=tuple(meta['nsteps']), spacing=meta['spacing'])
+
+
+class ChunkedResultWriter(object):
+    """
+    Writes a hotspots result to a single chunked container file (e.g. "out.hsc"), as an alternative to the out.zip of
+    whole-box CCP4 maps written by HotspotWriter. Each map is cut into blocks of chunk_shape grid points, and each
+    block is compressed on its own, so that ChunkedResultReader can decompress just the blocks of the probes and region
+    it is asked for. Blocks that are all zero are not stored.
+
+    Layout of the file:
+        MAGIC, byte offset of the index (uint64)
+        compressed blocks (float32, C-order) and the compressed protein (PDB)
+        index (JSON): for each map its frame, the chunk shape and the offset and length of every stored block, and the
+                      offset and length of the protein
+    """
+
+    def __init__(self, path, chunk_shape=CHUNK_SHAPE, compression_level=6):
+        """
+        :param path: path to the container file
+        :param chunk_shape: (nx, ny, nz) grid points per block
+        :param compression_level: zlib compression level (0-9)
+        """
+        self.path = Path(path)
+        self.chunk_shape = tuple(int(n) for n in chunk_shape)
+        self.compression_level = compression_level
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def _write_map(self, f, array, frame):
+        """
+        Writes the nonzero blocks of one map at the current position of f.
+        :return: dictionary of the map's index entry
+        """
+        array = np.asarray(array, dtype=np.float32)
+        blocks = []
+        for corner in np.ndindex(*[int(np.ceil(n / float(c))) for n, c in zip(frame.nsteps, self.chunk_shape)]):
+            block = array[tuple(slice(i * c, (i + 1) * c) for i, c in zip(corner, self.chunk_shape))]
+            if not block.any():
+                continue
+            data = zlib.compress(np.ascontiguousarray(block, dtype='<f4').tobytes(), self.compression_level)
+            blocks.append([int(i) for i in corner] + [f.tell(), len(data)])
+            f.write(data)
+        return {'origin': list(frame.origin),
+                'nsteps': list(frame.nsteps),
+                'spacing': frame.spacing,
+                'chunk_shape': list(self.chunk_shape),
+                'blocks': blocks}
+
+    def write(self, result):
+        """
+        :param result: hotspots result (super_grids, protein and, if present, buriedness)
+        :return:
+        """
+        index = {'maps': {}, 'protein': None}
+        grids = dict(result.super_grids)
+        if getattr(result, 'buriedness', None) is not None:
+            grids['buriedness'] = result.buriedness
+
+        with open(str(self.path), 'wb') as f:
+            f.write(MAGIC + np.zeros(1, dtype='<u8').tobytes())
+            for probe, g in grids.items():
+                index['maps'][probe] = self._write_map(f, _GridEnsemble.array_from_grid(g), grid_frame(g))
+
+            if result.protein is not None:
+                tmp_dir = tempfile.mkdtemp(prefix='result_container_')
+                try:
+                    pdb_path = str(Path(tmp_dir, 'protein.pdb'))
+                    with MoleculeWriter(pdb_path) as writer:
+                        writer.write(result.protein)
+                    data = zlib.compress(Path(pdb_path).read_bytes(), self.compression_level)
+                finally:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                index['protein'] = [f.tell(), len(data)]
+                f.write(data)
+
+            index_offset = f.tell()
+            f.write(json.dumps(index).encode())
+            f.seek(len(MAGIC))
+            f.write(np.array([index_offset], dtype='<u8').tobytes())
+
+
+class ChunkedResultReader(object):
+    """
+    Reads hotspots results written by ChunkedResultWriter. Only the index is read on opening; read() then decompresses
+    only the blocks of the requested probes that overlap the requested box.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path to the container file
+        """
+        self.path = Path(path)
+        self._file = open(str(self.path), 'rb')
+        preamble = self._file.read(PREAMBLE_BYTES)
+        if preamble[:len(MAGIC)] != MAGIC:
+            self._file.close()
+            raise ValueError("{} is not a chunked hotspots result".format(path))
+        self._file.seek(int(np.frombuffer(preamble[len(MAGIC):], dtype='<u8')[0]))
+        self.index = json.loads(self._file.read().decode())
+        self.frames = {p: _frame_from_meta(m) for p, m in self.index['maps'].items()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def probes(self):
+        return [p for p in self.frames.keys() if p != 'buriedness']
+
+    def _read_bytes(self, offset, length):
+        self._file.seek(offset)
+        return zlib.decompress(self._file.read(length))
+
+    def read_array(self, probe, bbox=None):
+        """
+        :param probe: probe name (or "buriedness")
+        :param bbox: (lower corner, upper corner) coordinates of the region to read, or None for the whole map. The map
+                     is cropped to the box by the rule of grid_geometry.box_slices.
+        :return: tuple of (grid_geometry.GridFrame, 3D float32 numpy array), or None if the box misses the map
+        """
+        meta = self.index['maps'][probe]
+        frame = self.frames[probe]
+        chunk_shape = np.array(meta['chunk_shape'])
+        if bbox is None:
+            slices = tuple(slice(0, n) for n in frame.nsteps)
+        else:
+            slices = box_slices(frame, bbox[0], bbox[1])
+            if slices is None:
+                return None
+        start = np.array([s.start for s in slices])
+        stop = np.array([s.stop for s in slices])
+
+        out = np.zeros(stop - start, dtype=np.float32)
+        for block in meta['blocks']:
+            corner = np.array(block[:3])
+            lo = np.maximum(corner * chunk_shape, start)
+            hi = np.minimum((corner + 1) * chunk_shape, stop)
+            if np.any(hi <= lo):
+                continue
+            block_shape = np.minimum((corner + 1) * chunk_shape, frame.nsteps) - corner * chunk_shape
+            values = np.frombuffer(self._read_bytes(block[3], block[4]), dtype='<f4').reshape(block_shape)
+            out[tuple(slice(a, b) for a, b in zip(lo - start, hi - start))] = \
+                values[tuple(slice(a, b) for a, b in zip(lo - corner * chunk_shape, hi - corner * chunk_shape))]
+
+        return slice_frame(frame, slices), out
+
+    def read_protein(self):
+        """
+        :return: ccdc.protein.Protein, or None if the result has no protein
+        """
+        if self.index['protein'] is None:
+            return None
+        tmp_dir = tempfile.mkdtemp(prefix='result_container_')
+        try:
+            pdb_path = Path(tmp_dir, 'protein.pdb')
+            pdb_path.write_bytes(self._read_bytes(*self.index['protein']))
+            return Protein.from_file(str(pdb_path))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def read(self, probes=None, bbox=None, protein=True):
+        """
+        :param probes: list of the probes to read, or None for all of them
+        :param bbox: (lower corner, upper corner) coordinates to crop the maps to, or None for the whole maps
+        :param protein: if False, the protein is not read
+        :return: a :class: 'hotspots.result.Results' instance
+        """
+        probes = self.probes if probes is None else list(probes)
+        super_grids = {}
+        for p in probes:
+            if p not in self.frames:
+                print("Probe {} is not in {}".format(p, self.path))
+                continue
+            read = self.read_array(p, bbox=bbox)
+            if read is None:
+                print("The box does not overlap the {} map of {}".format(p, self.path))
+                continue
+            frame, array = read
+            super_grids[p] = grid_from_array(array, frame)
+
+        buriedness = None
+        if 'buriedness' in self.frames:
+            read = self.read_array('buriedness', bbox=bbox)
+            if read is not None:
+                buriedness = grid_from_array(read[1], read[0])
+
+        return Results(super_grids=super_grids,
+                       protein=self.read_protein() if protein else None,
+                       buriedness=buriedness)
@@ -0,0 +1,142 @@
+import collections
+import shutil
+import tempfile
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+from ccdc.io import MoleculeWriter
+from ccdc.protein import Protein
+from hotspots.hs_io import HotspotReader
+from hotspots.grid_extension import _GridEnsemble
+from hotspots.result import Results
+from grid_geometry import grid_frame
+from ccp4_maps import grid_from_array
+from result_container import ChunkedResultReader
+
+
+def read_result(path, bbox=None):
+    """
+    Reads one hotspots result: an out.zip or result directory (HotspotReader) or a chunked .hsc result
+    (result_container.ChunkedResultReader).
+    :param path: path to the result
+    :param bbox: (lower corner, upper corner) to crop .hsc results to while reading; other results are read whole
+    :return: a :class: 'hotspots.result.Results' instance
+    """
+    if Path(path).suffix == '.hsc':
+        with ChunkedResultReader(str(path)) as reader:
+            return reader.read(bbox=bbox)
+    with HotspotReader(str(path)) as reader:
+        return reader.read()
+
+
+def _pack_result(result):
+    """
+    ccdc grids and proteins cannot be pickled, so results read in worker processes are sent back to the main process as
+    numpy arrays (with their frames) and PDB text.
+    """
+    grids = {p: (grid_frame(g), _GridEnsemble.array_from_grid(g)) for p, g in result.super_grids.items()}
+    buriedness = None
+    if getattr(result, 'buriedness', None) is not None:
+        buriedness = (grid_frame(result.buriedness), _GridEnsemble.array_from_grid(result.buriedness))
+    pdb = None
+    if result.protein is not None:
+        tmp_dir = tempfile.mkdtemp(prefix='result_loader_')
+        try:
+            pdb_path = Path(tmp_dir, 'protein.pdb')
+            with MoleculeWriter(str(pdb_path)) as writer:
+                writer.write(result.protein)
+            pdb = pdb_path.read_bytes()
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return grids, buriedness, pdb
+
+
+def _unpack_result(packed):
+    grids, buriedness, pdb = packed
+    protein = None
+    if pdb is not None:
+        tmp_dir = tempfile.mkdtemp(prefix='result_loader_')
+        try:
+            pdb_path = Path(tmp_dir, 'protein.pdb')
+            pdb_path.write_bytes(pdb)
+            protein = Protein.from_file(str(pdb_path))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return Results(super_grids={p: grid_from_array(array, frame) for p, (frame, array) in grids.items()},
+                   protein=protein,
+                   buriedness=grid_from_array(buriedness[1], buriedness[0]) if buriedness is not None else None)
+
+
+def _read_packed(task):
+    path, bbox = task
+    return _pack_result(read_result(path, bbox=bbox))
+
+
+def _read(task):
+    path, bbox = task
+    return read_result(path, bbox=bbox)
+
+
+def iter_results(result_paths, identifiers=None, workers=4, backend='thread', max_pending=None, bbox=None,
+                 progress=True):
+    """
+    Reads a list of hotspots results on a pool of workers, and yields them in input order as they become available.
+    At most max_pending results are read ahead of the one the caller is waiting for, so a caller that processes and
+    drops each result in turn holds only a bounded number of results in memory.
+
+    :param result_paths: list of paths to the results (out.zip files, result directories or .hsc files)
+    :param identifiers: list of identifiers, one per result, set as the identifier of each result's protein
+    :param workers: number of workers; 1 reads the results one after another in this process
+    :param backend: "thread" (a pool of threads) or "process" (a pool of processes; the grids are sent back as arrays)
+    :param max_pending: maximum number of results read ahead (defaults to 2 x workers)
+    :param bbox: (lower corner, upper corner) to crop .hsc results to while reading (see read_result)
+    :param progress: if True, prints a line for each result loaded
+    :return: generator of hotspots results
+    """
+    result_paths = list(result_paths)
+    if identifiers is not None and len(identifiers) != len(result_paths):
+        raise ValueError("Got {} identifiers for {} results".format(len(identifiers), len(result_paths)))
+    if backend not in ['thread', 'process']:
+        raise ValueError("Unrecognised backend for loading results: {}".format(backend))
+    if max_pending is None:
+        max_pending = 2 * workers
+    n = len(result_paths)
+
+    def finish(i, result):
+        if identifiers is not None and result.protein is not None:
+            result.protein.identifier = identifiers[i]
+        if progress:
+            print("Loaded result {}/{}: {}".format(i + 1, n, result_paths[i]))
+        return result
+
+    tasks = [(str(p), bbox) for p in result_paths]
+    if workers <= 1:
+        for i, task in enumerate(tasks):
+            yield finish(i, _read(task))
+        return
+
+    if backend == 'process':
+        pool, read, unpack = Pool(processes=workers), _read_packed, _unpack_result
+    else:
+        pool, read, unpack = ThreadPool(processes=workers), _read, lambda r: r
+
+    with pool:
+        pending = collections.deque()
+        for i, task in enumerate(tasks):
+            pending.append((i, pool.apply_async(read, (task,))))
+            if len(pending) >= max(max_pending, 1):
+                j, async_result = pending.popleft()
+                yield finish(j, unpack(async_result.get()))
+        while pending:
+            j, async_result = pending.popleft()
+            yield finish(j, unpack(async_result.get()))
+
+
+def load_results(result_paths, identifiers=None, workers=4, backend='thread', max_pending=None, bbox=None,
+                 progress=True):
+    """
+    Reads a list of hotspots results on a pool of workers (see iter_results).
+    :return: list of hotspots results, in input order
+    """
+    return list(iter_results(result_paths, identifiers=identifiers, workers=workers, backend=backend,
+                             max_pending=max_pending, bbox=bbox, progress=progress))
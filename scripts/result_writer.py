@@ -0,0 +1,116 @@
+import time
+import zipfile
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+from hotspots.grid_extension import _GridEnsemble
+from grid_geometry import grid_frame
+from ccp4_maps import ccp4_bytes, write_ccp4
+
+# Compression methods of the archive entries
+COMPRESSION = {'stored': zipfile.ZIP_STORED,
+               'deflated': zipfile.ZIP_DEFLATED,
+               'bzip2': zipfile.ZIP_BZIP2,
+               'lzma': zipfile.ZIP_LZMA}
+
+# Directory of the result files, within out.zip (or within the out directory of an unzipped result), as written by
+# HotspotWriter
+RESULT_DIR = 'hotspot'
+
+
+class StreamingHotspotWriter(object):
+    """
+    Writes hotspots results as CCP4 maps and a PDB protein, in the file layout of HotspotWriter(grid_extension=".ccp4"):
+    a "hotspot" directory holding the maps and protein.pdb, zipped into path/out.zip (or written as path/out/hotspot
+    with zip_results=False), so HotspotReader reads the results back as usual. The maps are encoded in memory on a pool
+    of threads, and each entry is compressed and added to the archive as soon as it is ready, so no map is written to
+    disk twice and no temporary files are made.
+
+    Unlike HotspotWriter, no PyMOL script (pymol_file.py) is written next to the results, so this writer is meant for
+    intermediate results such as binding_site_maps (with fast compression, e.g. compression_level=1). Results that are
+    kept are written with HotspotWriter.
+    """
+
+    def __init__(self, path, grid_extension=".ccp4", zip_results=True, compression='deflated', compression_level=6,
+                 workers=4):
+        """
+        :param path: directory to write the results to (created if needed)
+        :param grid_extension: only ".ccp4" maps can be encoded without ccdc
+        :param zip_results: if True, writes path/out.zip; otherwise writes the files into path/out/hotspot
+        :param compression: compression method of the archive entries (one of COMPRESSION)
+        :param compression_level: 0-9 for "deflated", 1-9 for "bzip2"; not used by "stored" and "lzma"
+        :param workers: number of threads encoding the maps
+        """
+        if grid_extension != ".ccp4":
+            raise ValueError("StreamingHotspotWriter writes .ccp4 maps only; got {}".format(grid_extension))
+        if compression not in COMPRESSION:
+            raise ValueError("Unrecognised compression: {}".format(compression))
+        self.path = Path(path)
+        self.grid_extension = grid_extension
+        self.zip_results = zip_results
+        self.compression = compression
+        self.compression_level = compression_level
+        self.workers = workers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def _entries(self, result):
+        """
+        :return: list of (file name within the result directory, grid or str): the maps, the buriedness map and the
+                 protein of the result
+        """
+        entries = [('{}{}'.format(probe, self.grid_extension), g) for probe, g in result.super_grids.items()]
+        if getattr(result, 'buriedness', None) is not None:
+            entries.append(('buriedness{}'.format(self.grid_extension), result.buriedness))
+        if result.protein is not None:
+            entries.append(('protein.pdb', result.protein.to_string('pdb')))
+        return entries
+
+    def _encode(self, entry):
+        """
+        :return: tuple of (file name, contents as bytes)
+        """
+        name, item = entry
+        if isinstance(item, str):
+            return name, item.encode()
+        return name, ccp4_bytes(_GridEnsemble.array_from_grid(item), grid_frame(item))
+
+    def _write_file(self, entry):
+        name, item = entry
+        out_path = Path(self.path, 'out', RESULT_DIR, name)
+        if isinstance(item, str):
+            out_path.write_text(item)
+        else:
+            write_ccp4(out_path, _GridEnsemble.array_from_grid(item), grid_frame(item))
+
+    def write(self, result):
+        """
+        :param result: hotspots result
+        :return: path to the archive (or to the out directory, with zip_results=False)
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        entries = self._entries(result)
+        with ThreadPool(processes=max(self.workers, 1)) as pool:
+            if not self.zip_results:
+                Path(self.path, 'out', RESULT_DIR).mkdir(parents=True, exist_ok=True)
+                pool.map(self._write_file, entries)
+                return Path(self.path, 'out')
+
+            archive_path = Path(self.path, 'out.zip')
+            date_time = time.localtime(time.time())[:6]
+            with zipfile.ZipFile(str(archive_path), 'w') as archive:
+                directory = zipfile.ZipInfo('{}/'.format(RESULT_DIR), date_time=date_time)
+                # Unix directory mode, and the MS-DOS directory flag
+                directory.external_attr = (0o40755 << 16) | 0x10
+                archive.writestr(directory, b'')
+
+                # imap returns the entries in order, as soon as each one is encoded
+                for name, data in pool.imap(self._encode, entries):
+                    info = zipfile.ZipInfo('{}/{}'.format(RESULT_DIR, name), date_time=date_time)
+                    info.compress_type = COMPRESSION[self.compression]
+                    info.external_attr = 0o644 << 16
+                    archive.writestr(info, data, compresslevel=self.compression_level)
+        return archive_path
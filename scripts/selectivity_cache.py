@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+import numpy as np
+from hotspots.grid_extension import _GridEnsemble
+from grid_geometry import GridFrame, grid_frame
+from sparse_grids import SparseGrid
+from ensemble_cache import EnsembleCache
+
+
+def grids_digest(grids):
+    """
+    :param grids: dictionary of {probe: ccdc.utilities.Grid} (e.g. the super_grids of a hotspots result)
+    :return: sha256 hex digest of the probes, the geometry and the values of the grids
+    """
+    h = hashlib.sha256()
+    for probe in sorted(grids.keys()):
+        f = grid_frame(grids[probe])
+        h.update(json.dumps([probe, list(f.origin), list(f.nsteps), f.spacing]).encode())
+        h.update(np.ascontiguousarray(_GridEnsemble.array_from_grid(grids[probe]), dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+class SelectivityCache(EnsembleCache):
+    """
+    On-disk cache of selectivity maps, so that reruns of the selectivity scripts load the maps instead of recomputing
+    them. Entries are keyed by content hashes of the target and off-target maps and by the selectivity settings, and
+    are evicted least-recently-used first once the cache grows beyond max_bytes (as for EnsembleCache).
+
+    Each entry is a directory holding meta.json (frames, common grid and cluster summary) and maps.npz, with the nonzero
+    points of each selectivity map.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2**30):
+        """
+        :param cache_dir: path to the cache directory (created if needed)
+        :param max_bytes: size limit of the cache on disk
+        """
+        super(SelectivityCache, self).__init__(cache_dir, max_bytes=max_bytes)
+
+    @staticmethod
+    def make_key(target_digest, off_target_digests, settings):
+        """
+        :param target_digest: grids_digest of the target maps
+        :param off_target_digests: list of the grids_digest of the off-target maps
+        :param settings: dictionary of the selectivity settings, JSON-serialisable
+        :return: str
+        """
+        h = hashlib.sha256()
+        h.update(target_digest.encode())
+        for digest in off_target_digests:
+            h.update(digest.encode())
+        h.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def load(self, key):
+        """
+        :param key: cache key
+        :return: tuple of (dictionary of {probe: ccdc.utilities.Grid}, common grid GridFrame, list of summary
+                 dictionaries), or None if the key is not in the cache
+        """
+        if key not in self:
+            return None
+        entry = self._entry(key)
+        meta = json.loads(Path(entry, 'meta.json').read_text())
+        grids = {}
+        with np.load(str(Path(entry, 'maps.npz'))) as maps:
+            for probe, f in meta['frames'].items():
+                frame = GridFrame(origin=tuple(f['origin']), nsteps=tuple(f['nsteps']), spacing=f['spacing'])
+                grids[probe] = SparseGrid(frame, maps['{}_indices'.format(probe)],
+                                          maps['{}_values'.format(probe)]).as_grid()
+        c = meta['common']
+        common = GridFrame(origin=tuple(c['origin']), nsteps=tuple(c['nsteps']), spacing=c['spacing'])
+        # Mark the entry as recently used
+        os.utime(str(Path(entry, 'meta.json')))
+        return grids, common, meta['summary']
+
+    def store(self, key, grids, common, summary=None):
+        """
+        Adds selectivity maps to the cache, then evicts old entries if the cache is over its size limit.
+        :param key: cache key
+        :param grids: dictionary of {probe: ccdc.utilities.Grid}
+        :param common: GridFrame of the common grid of the difference maps
+        :param summary: list of JSON-serialisable dictionaries (e.g. the cluster counts of each probe)
+        :return:
+        """
+        if key in self:
+            return
+        tmp = Path(tempfile.mkdtemp(prefix='.tmp_', dir=str(self.path)))
+        arrays = {}
+        frames = {}
+        for probe, g in grids.items():
+            sparse = SparseGrid.from_grid(g)
+            arrays['{}_indices'.format(probe)] = sparse.indices
+            arrays['{}_values'.format(probe)] = sparse.values
+            frames[probe] = {'origin': list(sparse.frame.origin),
+                             'nsteps': list(sparse.frame.nsteps),
+                             'spacing': sparse.frame.spacing}
+        np.savez_compressed(str(Path(tmp, 'maps.npz')), **arrays)
+        meta = {'frames': frames,
+                'common': {'origin': list(common.origin), 'nsteps': list(common.nsteps), 'spacing': common.spacing},
+                'summary': summary if summary is not None else []}
+        Path(tmp, 'meta.json').write_text(json.dumps(meta, indent=4, default=int))
+        try:
+            tmp.rename(self._entry(key))
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(str(tmp), ignore_errors=True)
+        self.evict()
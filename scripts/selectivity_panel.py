@@ -0,0 +1,86 @@
+from itertools import combinations
+from multiprocessing import Pool
+from pathlib import Path
+import pandas as pd
+from hotspots.hs_io import HotspotReader, HotspotWriter
+from hs_ensembles import SelectivityResult
+
+# Results read by each worker process, by name (see _load_result)
+_worker_results = {}
+_worker_paths = {}
+
+
+def _init_worker(result_paths):
+    _worker_paths.update(result_paths)
+
+
+def _load_result(name):
+    """
+    Reads a result the first time a worker needs it, and keeps it for the worker's later pairs.
+    """
+    if name not in _worker_results:
+        with HotspotReader(str(_worker_paths[name])) as reader:
+            _worker_results[name] = reader.read()
+    return _worker_results[name]
+
+
+def selectivity_path(out_dir, on_target, off_target, settings):
+    """
+    :return: pathlib.Path of the directory holding the selectivity maps of on_target over off_target
+    """
+    return Path(out_dir, "selectivity_{}_over_{}_score_{}_distance_{}".format(on_target, off_target,
+                                                                             settings.minimal_cluster_score,
+                                                                             settings.cluster_distance_cutoff))
+
+
+def _pair_selectivity(task):
+    """
+    Makes and writes the selectivity maps of one unordered pair of results, in both directions.
+    """
+    name_a, name_b, settings, out_dir = task
+    selectivity = SelectivityResult(target_result=_load_result(name_a),
+                                    other_result=_load_result(name_b),
+                                    settings=settings)
+    a_over_b, b_over_a, summary = selectivity.make_selectivity_maps_both_ways()
+
+    for on_target, off_target, result in [(name_a, name_b, a_over_b), (name_b, name_a, b_over_a)]:
+        with HotspotWriter(str(selectivity_path(out_dir, on_target, off_target, settings)), grid_extension=".ccp4",
+                           zip_results=False) as w:
+            w.write(result)
+
+    for row in summary:
+        row['on_target'], row['off_target'] = (name_a, name_b) if row.pop('direction') == 1 else (name_b, name_a)
+    return summary
+
+
+def selectivity_panel(result_paths, out_dir, settings=None, workers=1):
+    """
+    Makes the selectivity maps of every result over every other result (N x (N - 1) maps for N results). Each unordered
+    pair is one task: its difference map is computed once and gives the selectivity maps in both directions (see
+    SelectivityResult.make_selectivity_maps_both_ways). The pairs are run on a pool of worker processes; each worker
+    reads a result the first time it needs it.
+
+    :param result_paths: dictionary of {name: path to the hotspots result (e.g. an ensemble out.zip)}
+    :param out_dir: directory to write the selectivity maps to, one subdirectory per ordered pair (see
+                    selectivity_path)
+    :param settings: SelectivityResult.Settings
+    :param workers: number of worker processes
+    :return: pandas.DataFrame with one row per (on_target, off_target, probe), giving the number of target clusters,
+             selective clusters and selective points
+    """
+    if settings is None:
+        settings = SelectivityResult.Settings()
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    tasks = [(a, b, settings, str(out_dir)) for a, b in combinations(result_paths.keys(), 2)]
+
+    if workers > 1:
+        with Pool(processes=workers, initializer=_init_worker, initargs=(dict(result_paths),)) as pool:
+            summaries = pool.map(_pair_selectivity, tasks, chunksize=1)
+    else:
+        _init_worker(dict(result_paths))
+        summaries = [_pair_selectivity(t) for t in tasks]
+        _worker_results.clear()
+
+    rows = [row for summary in summaries for row in summary]
+    return pd.DataFrame(rows, columns=['on_target', 'off_target', 'probe', 'num_clusters', 'num_selective_clusters',
+                                       'num_selective_points'])
@@ -0,0 +1,267 @@
+import numpy as np
+from hdbscan import HDBSCAN
+from hotspots.grid_extension import _GridEnsemble
+from grid_geometry import grid_frame, common_frame, frame_offset
+from ccp4_maps import grid_from_array
+
+
+class SparseGrid(object):
+    """
+    A map stored as the flat (C-order) indices of its nonzero points and their values, on a grid_geometry.GridFrame.
+    Memory and run time of the operations below scale with the number of nonzero points rather than the box volume.
+    """
+
+    def __init__(self, frame, indices, values):
+        """
+        :param frame: grid_geometry.GridFrame
+        :param indices: sorted flat indices of the nonzero points
+        :param values: values at those points
+        """
+        self.frame = frame
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.indices)
+
+    @staticmethod
+    def from_array(array, frame):
+        """
+        :param array: 3D numpy array with shape frame.nsteps
+        :param frame: grid_geometry.GridFrame
+        :return: SparseGrid
+        """
+        indices = np.flatnonzero(array)
+        return SparseGrid(frame, indices, array.ravel()[indices])
+
+    @staticmethod
+    def from_grid(grid):
+        """
+        :param grid: ccdc.utilities.Grid
+        :return: SparseGrid
+        """
+        return SparseGrid.from_array(_GridEnsemble.array_from_grid(grid), grid_frame(grid))
+
+    def to_array(self):
+        """
+        :return: dense 3D numpy array with shape self.frame.nsteps
+        """
+        array = np.zeros(int(np.prod(self.frame.nsteps)), dtype=np.float32)
+        array[self.indices] = self.values
+        return array.reshape(self.frame.nsteps)
+
+    def as_grid(self):
+        """
+        :return: a :class: 'ccdc.utilities.Grid' instance
+        """
+        return grid_from_array(self.to_array(), self.frame)
+
+    def points(self):
+        """
+        :return: (n, 3) numpy array of the grid indices (i, j, k) of the nonzero points
+        """
+        return np.column_stack(np.unravel_index(self.indices, self.frame.nsteps))
+
+    def select(self, mask):
+        """
+        :param mask: boolean array over the nonzero points
+        :return: SparseGrid with only the points in the mask
+        """
+        return SparseGrid(self.frame, self.indices[mask], self.values[mask])
+
+    def with_values(self, values):
+        """
+        :param values: new values for the same points
+        :return: SparseGrid
+        """
+        return SparseGrid(self.frame, self.indices, values)
+
+    def reframe(self, frame):
+        """
+        Moves the map onto another frame with the same spacing. Points outside the new frame are dropped.
+        :param frame: grid_geometry.GridFrame
+        :return: SparseGrid
+        """
+        if frame == self.frame:
+            return self
+        ijk = self.points() + frame_offset(self.frame, frame)
+        inside = np.all((ijk >= 0) & (ijk < np.array(frame.nsteps)), axis=1)
+        indices = np.ravel_multi_index(tuple(ijk[inside].T), frame.nsteps)
+        return SparseGrid(frame, indices, self.values[inside])
+
+    def __neg__(self):
+        return self.with_values(-self.values)
+
+    def __sub__(self, other):
+        """
+        Point-wise difference of two maps on the same frame.
+        """
+        if other.frame != self.frame:
+            raise ValueError("Sparse grids must be on the same frame to be subtracted")
+        indices = np.union1d(self.indices, other.indices)
+        values = np.zeros(len(indices), dtype=np.float32)
+        values[np.searchsorted(indices, self.indices)] += self.values
+        values[np.searchsorted(indices, other.indices)] -= other.values
+        nonzero = values != 0
+        return SparseGrid(self.frame, indices[nonzero], values[nonzero])
+
+    def hdbscan_cluster(self, **kwargs):
+        """
+        Clusters the nonzero points with HDBSCAN, in the same way as _GridEnsemble.HDBSCAN_cluster does for dense
+        arrays: noise is labelled 0 and clusters are labelled from 1.
+        :param kwargs: passed on to hdbscan.HDBSCAN
+        :return: SparseGrid of cluster labels, holding the clustered points only
+        """
+        if len(self) == 0:
+            return SparseGrid(self.frame, [], [])
+        clusterer = HDBSCAN(**kwargs)
+        clusterer.fit(self.points())
+        labels = clusterer.labels_ + 1
+        return SparseGrid(self.frame, self.indices, labels).select(labels > 0)
+
+    def centres_of_mass(self, labels):
+        """
+        Value-weighted centre of mass (in grid indices) of each cluster.
+        :param labels: SparseGrid of cluster labels on a subset of the points of self
+        :return: dictionary of {label: numpy array((i, j, k))}
+        """
+        weights = self.values[np.searchsorted(self.indices, labels.indices)].astype(np.float64)
+        lab = labels.values.astype(np.int64)
+        pts = labels.points()
+        total = np.bincount(lab, weights=weights)
+        sums = [np.bincount(lab, weights=weights * pts[:, d]) for d in range(3)]
+        return {c: np.array([s[c] / total[c] for s in sums]) for c in np.unique(lab)}
+
+
+class SparseStack(object):
+    """
+    The maps of one probe over an ensemble, stored as COO triplets (structure, flat point index, value) of the nonzero
+    values, sorted by point and then by value. Ensemble statistics are computed per occupied point only.
+    """
+
+    def __init__(self, frame, n_structures, structures, indices, values):
+        order = np.lexsort((values, indices))
+        self._set_sorted(frame, n_structures, np.asarray(structures)[order], np.asarray(indices)[order],
+                         np.asarray(values, dtype=np.float32)[order])
+
+    def _set_sorted(self, frame, n_structures, structures, indices, values):
+        self.frame = frame
+        self.n_structures = n_structures
+        self.structures = structures
+        self.indices = indices
+        self.values = values
+        self.occupied, self.starts, self.counts = np.unique(self.indices, return_index=True, return_counts=True)
+
+    @staticmethod
+    def from_sorted(frame, n_structures, structures, indices, values):
+        """
+        Wraps COO triplets that are already sorted by point and then by value, without sorting them again.
+        :return: SparseStack
+        """
+        stack = SparseStack.__new__(SparseStack)
+        stack._set_sorted(frame, n_structures, np.asarray(structures), np.asarray(indices),
+                          np.asarray(values, dtype=np.float32))
+        return stack
+
+    @staticmethod
+    def from_sparse_grids(sparse_grids, frame=None):
+        """
+        :param sparse_grids: list of SparseGrid, one per structure
+        :param frame: common frame; defaults to the common frame of the input grids
+        :return: SparseStack
+        """
+        if frame is None:
+            frame = common_frame([sg.frame for sg in sparse_grids])
+        sparse_grids = [sg.reframe(frame) for sg in sparse_grids]
+        structures = np.concatenate([np.full(len(sg), s, dtype=np.int32) for s, sg in enumerate(sparse_grids)])
+        indices = np.concatenate([sg.indices for sg in sparse_grids])
+        values = np.concatenate([sg.values for sg in sparse_grids])
+        return SparseStack(frame, len(sparse_grids), structures, indices, values)
+
+    @staticmethod
+    def from_grids(grid_list):
+        """
+        :param grid_list: list of ccdc.utilities.Grid, one per structure
+        :return: SparseStack
+        """
+        return SparseStack.from_sparse_grids([SparseGrid.from_grid(g) for g in grid_list])
+
+    def _at_rank(self, ranks):
+        return self.values[self.starts + np.clip(ranks, 0, self.counts - 1)]
+
+    def frequency(self):
+        """
+        :return: SparseGrid of the percentage of structures with a nonzero value at each occupied point
+        """
+        return SparseGrid(self.frame, self.occupied, self.counts * 100.0 / self.n_structures)
+
+    def summary(self, threshold=None, mode='median'):
+        """
+        Combines the maps over the ensemble (see ensemble_stack.summarise_block for the modes).
+        :param threshold: frequency threshold (percentage), or None
+        :param mode: "median", "mean" or "max"
+        :return: SparseGrid
+        """
+        c = self.counts
+        n = self.n_structures
+        if mode == 'median' and threshold is not None:
+            med = 0.5 * (self._at_rank((c - 1) // 2) + self._at_rank(c // 2))
+            values = np.where(c * 100.0 / n >= threshold, med, 0.0)
+        elif mode == 'median':
+            negatives = np.add.reduceat((self.values < 0).astype(np.int64), self.starts) if len(c) else c
+            zeros = n - c
+            values = 0.0
+            for r in [(n - 1) // 2, n // 2]:
+                ranks = np.where(r < negatives, r, r - zeros)
+                in_zeros = (r >= negatives) & (r < negatives + zeros)
+                values = values + 0.5 * np.where(in_zeros, 0.0, self._at_rank(ranks))
+        elif mode == 'mean':
+            values = (np.add.reduceat(self.values.astype(np.float64), self.starts) if len(c) else c) / n
+        elif mode == 'max':
+            top = self._at_rank(c - 1)
+            values = np.where(c < n, np.maximum(top, 0.0), top)
+        else:
+            raise ValueError("Unrecognised mode for combining grids: {}".format(mode))
+
+        summary = SparseGrid(self.frame, self.occupied, values)
+        return summary.select(summary.values != 0)
+
+    def as_grid(self, array):
+        """
+        :param array: 3D numpy array (or SparseGrid) on the stack frame
+        :return: a :class: 'ccdc.utilities.Grid' instance
+        """
+        if isinstance(array, SparseGrid):
+            return array.as_grid()
+        return grid_from_array(array, self.frame)
+
+    def get_median_frequency_map(self, threshold=0):
+        """
+        :return: 3D numpy array, median of the nonzero values at points that pass the frequency threshold
+        """
+        return self.summary(threshold=threshold, mode='median').to_array()
+
+    def make_summary_grid(self, mode='median'):
+        """
+        :return: a :class: 'ccdc.utilities.Grid' instance, combining all values (zeros included)
+        """
+        return self.summary(threshold=None, mode=mode).as_grid()
+
+    def get_contributing_maps(self, cluster_array):
+        """
+        For each cluster, counts the points at which each structure has a nonzero value.
+        :param cluster_array: 3D numpy array on the stack frame, labelled by cluster
+        :return: dictionary of {cluster: [(structure index, number of points), ...]}, most common first
+        """
+        labels = cluster_array.ravel()[self.indices].astype(np.int64)
+        in_cluster = labels > 0
+        n_labels = int(cluster_array.max()) + 1
+        counts = np.zeros((n_labels, self.n_structures), dtype=np.int64)
+        np.add.at(counts, (labels[in_cluster], self.structures[in_cluster]), 1)
+
+        contribs = {}
+        for c in set(cluster_array[cluster_array > 0]):
+            row = counts[int(c)]
+            order = np.argsort(-row, kind='stable')
+            contribs[c] = [(int(s), int(row[s])) for s in order if row[s] > 0]
+        return contribs
@@ -1,29 +1,28 @@
 from pathlib import Path
 from ccdc.io import MoleculeWriter, MoleculeReader
 from ccdc.protein import Protein
-from hotspots.hs_io import HotspotReader, HotspotWriter
+from hotspots.hs_io import HotspotReader
 from hotspots.wrapper_protoss import *
 from hotspots.hs_utilities import Helper
-from hotspots.hs_ensembles import EnsembleResult
 from hotspots.result import _Scorer
 from hotspots.data import common_solvents
 from hotspots.grid_extension import Grid, _GridEnsemble
 import numpy as np
 import pandas as pd
 from collections import Counter
+from labeled_stats import clusters_centre_of_mass
+from hs_ensembles import EnsembleResult
+from result_loader import iter_results
+from result_writer import StreamingHotspotWriter
 
 def get_clusters_centre_mass(cluster_array, hotspot_map):
     """
-    May not be the best place for it. Check if it isn't already in _GridEnsemble
+    Value-weighted centre of mass of each cluster, computed in one pass (see labeled_stats.cluster_statistics)
     :param cluster_array:
     :param hotspot_map: Note - this is a numpy array!
-    :return:
+    :return: dictionary of {cluster: numpy array((i, j, k))}
     """
-    coords = {}
-    for c in set(cluster_array[cluster_array > 0]):
-        arr = hotspot_map * (cluster_array == c)
-        coords[c] = _GridEnsemble.get_center_of_mass(arr)
-    return coords
+    return clusters_centre_of_mass(cluster_array, hotspot_map)
 
 def find_bs_residues(prot, list_of_ligands):
     """
@@ -314,21 +313,24 @@ def shrink_bs_maps(hotspot_paths, ligand_paths, padding=4.0):
     shrunk_hs_results = []
     shrunk_hs_result_paths = []
 
-    for hs_path in hotspot_paths:
-        with HotspotReader(str(hs_path)) as hs_reader:
-            hs_res = hs_reader.read()
-        probes = hs_res.super_grids.keys()
-
-        # now to shrink the grids for each probe
-        for p in probes:
-            hs_res.super_grids[p] = EnsembleResult.shrink_to_binding_site(in_grid=hs_res.super_grids[p],
-                                                                          new_origin=min_coords,
-                                                                          new_far_corner=max_coords)
+    # Read the results in parallel, in order
+    loaded = iter_results(hotspot_paths, workers=4, bbox=(min_coords, max_coords))
+    for hs_path, hs_res in zip(hotspot_paths, loaded):
+        # Chunked (.hsc) results are cropped to the binding site while they are read
+        if Path(hs_path).suffix != '.hsc':
+            probes = hs_res.super_grids.keys()
+
+            # now to shrink the grids for each probe
+            for p in probes:
+                hs_res.super_grids[p] = EnsembleResult.shrink_to_binding_site(in_grid=hs_res.super_grids[p],
+                                                                              new_origin=min_coords,
+                                                                              new_far_corner=max_coords)
         shrunk_hs_results.append(hs_res)
 
         h_out_dir = Path(hs_path.parent, 'binding_site_maps')
         if not h_out_dir.exists(): h_out_dir.mkdir()
-        with HotspotWriter(str(h_out_dir.resolve()), grid_extension=".ccp4", zip_results=True) as writer:
+        with StreamingHotspotWriter(str(h_out_dir.resolve()), grid_extension=".ccp4", zip_results=True,
+                                    compression_level=1) as writer:
             writer.write(hs_res)
 
         shrunk_hs_result_paths.append(h_out_dir)